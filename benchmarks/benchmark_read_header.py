@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+"""Measure time needed for reading metadata of a segmentation file with many segments.
+
+A synthetic segmentation file with 500 segments (about 5000 header fields) is created and its metadata is read
+using `read_segmentation(..., skip_voxels=True)`. Reading the header with pynrrd (`nrrd.read_header`), which does
+not include processing of the segment fields, is timed for reference.
+
+Usage:
+
+    python benchmarks/benchmark_read_header.py [--segments 500] [--repeat 50]
+"""
+
+import argparse
+import os
+import tempfile
+import timeit
+
+import nrrd
+import numpy as np
+import slicerio
+
+
+def create_segmentation(number_of_segments):
+    """Create a small segmentation with many segments. Terminology entries repeat, as in real segmentations."""
+    segments = []
+    for segment_index in range(number_of_segments):
+        segments.append({
+            "id": f"Segment_{segment_index + 1}",
+            "name": f"structure {segment_index + 1}",
+            "nameAutoGenerated": False,
+            "color": [0.1, 0.5, 0.9],
+            "colorAutoGenerated": False,
+            "labelValue": segment_index % 255 + 1,
+            "layer": segment_index // 255,
+            "extent": [0, 9, 0, 9, 0, 9],
+            "status": "completed",
+            "terminology": {
+                "contextName": "Segmentation category and type - 3D Slicer General Anatomy list",
+                "category": ["SCT", "123037004", "Anatomical Structure"],
+                "type": ["SCT", str(100000 + segment_index % 100), f"Structure type {segment_index % 100}"],
+                "typeModifier": ["SCT", "24028007", "Right"],
+                "anatomicContextName": "Anatomic codes - DICOM master list"}
+            })
+    number_of_layers = (number_of_segments - 1) // 255 + 1
+    voxels = np.zeros([number_of_layers, 10, 10, 10] if number_of_layers > 1 else [10, 10, 10], dtype=np.uint8)
+    return {"voxels": voxels, "ijkToLPS": np.eye(4), "segments": segments}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--segments", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    filename = tempfile.mktemp() + ".seg.nrrd"
+    slicerio.write_segmentation(filename, create_segmentation(args.segments))
+    try:
+        for description, statement in [
+                ("nrrd.read_header", lambda: nrrd.read_header(filename)),
+                ("slicerio.read_segmentation(skip_voxels=True)", lambda: slicerio.read_segmentation(filename, skip_voxels=True)),
+                ]:
+            duration = min(timeit.repeat(statement, number=args.repeat, repeat=3)) / args.repeat
+            print(f"{description:50s} {duration * 1000:8.2f} ms")
+    finally:
+        os.remove(filename)
+
+
+if __name__ == "__main__":
+    main()
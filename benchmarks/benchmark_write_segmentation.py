@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+"""Compare throughput of writing a segmentation with single-threaded (pynrrd) and multi-threaded gzip compression.
+
+Usage:
+
+    python benchmarks/benchmark_write_segmentation.py [--size 512 512 400] [--level 9] [--threads 1 2 4 8]
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import slicerio
+
+
+def create_segmentation(size, number_of_segments=50):
+    """Create a segmentation containing boxes with some noise at the boundary, similar to real segmentations."""
+    rng = np.random.default_rng(0)
+    voxels = np.zeros(size, dtype=np.uint8)
+    segments = []
+    for label_value in range(1, number_of_segments + 1):
+        start = [rng.integers(0, dim // 2) for dim in size]
+        end = [s + rng.integers(dim // 10, dim // 2) for s, dim in zip(start, size)]
+        voxels[start[0]:end[0], start[1]:end[1], start[2]:end[2]] = label_value
+        segments.append({"labelValue": label_value, "name": f"segment {label_value}"})
+    noise = rng.random(size) < 0.01
+    voxels[noise] = 0
+    return {"voxels": voxels, "ijkToLPS": np.eye(4), "segments": segments}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, nargs=3, default=[512, 512, 400])
+    parser.add_argument("--level", type=int, default=9)
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, os.cpu_count() or 1])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    segmentation = create_segmentation(args.size)
+    data_size_mb = segmentation["voxels"].nbytes / 1e6
+    output_filename = tempfile.mktemp() + ".seg.nrrd"
+    print(f"Voxel data: {data_size_mb:.1f} MB, compression level: {args.level}")
+    try:
+        for threads in sorted(set(args.threads)):
+            durations = []
+            for _ in range(args.repeat):
+                start_time = time.perf_counter()
+                slicerio.write_segmentation(output_filename, segmentation, compression_level=args.level, compression_threads=threads)
+                durations.append(time.perf_counter() - start_time)
+            duration = min(durations)
+            file_size_mb = os.path.getsize(output_filename) / 1e6
+            print(f"threads: {threads:3d}  time: {duration:7.3f}s  throughput: {data_size_mb / duration:8.1f} MB/s  file size: {file_size_mb:.2f} MB")
+    finally:
+        if os.path.exists(output_filename):
+            os.remove(output_filename)
+
+
+if __name__ == "__main__":
+    main()
@@ -12,17 +12,27 @@ Bugs and other issues can be reported in the issue tracker: https://www.github.c
 
 """
 
-from .segmentation import extract_segments, read_segmentation, write_segmentation, segment_from_name, segment_names
+from .segmentation import clear_segmentation_cache, collapse_layers, dense_segmentation, extract_segments, read_segmentation, resample_segmentation, write_segmentation, segment_from_name, SegmentIndex, segment_names, segment_statistics, set_segmentation_cache_size, sparse_segmentation, TerminologyMatcher, write_segmentation_nifti
 from .data_helper import get_testdata_file
 from ._version import __version__, __version_info__
 
 __all__ = [
+   'clear_segmentation_cache',
+   'collapse_layers',
+   'dense_segmentation',
    'extract_segments',
    'get_testdata_file',
    'read_segmentation',
+   'resample_segmentation',
    'write_segmentation',
+   'write_segmentation_nifti',
    'segment_from_name',
+   'SegmentIndex',
    'segment_names',
+   'segment_statistics',
+   'set_segmentation_cache_size',
+   'sparse_segmentation',
+   'TerminologyMatcher',
    '__version__',
    '__version_info__'
    ]
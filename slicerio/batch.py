@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+"""Batch processing of many segmentation files.
+
+Each file is read, the requested segments are extracted (optionally), and the result is written to the output directory.
+Files are processed in parallel, in separate processes. Only file names are passed between processes,
+and the number of files that are processed at the same time is limited, therefore memory usage is bounded.
+
+Command-line usage example:
+
+    slicerio-batch "path/to/input/**/*.seg.nrrd" --output-directory path/to/output --mapping mapping.json
+
+where mapping.json contains a list of segment name (or terminology) and label value pairs, for example:
+
+    [["ribs", 1], ["right lung", 3],
+     [{"category": ["SCT", "123037004", "Anatomical Structure"], "type": ["SCT", "39607008", "Lung"], "typeModifier": ["SCT", "7771000", "Left"]}, 4]]
+"""
+
+
+def output_filename(input_filename, output_directory, input_root=None):
+    """Get output file path: file name of the input file, in the output directory, with .seg.nrrd extension.
+
+    :param input_root: if specified then the path of the input file relative to this folder is kept
+        (e.g., `input_root/a/case.nii.gz` is written to `output_directory/a/case.seg.nrrd`)
+    """
+    import os
+    basename = os.path.basename(input_filename)
+    for extension in [".seg.nrrd", ".nrrd", ".nii.gz", ".nii"]:
+        if basename.lower().endswith(extension):
+            basename = basename[:-len(extension)]
+            break
+    if input_root is not None:
+        relative_directory = os.path.relpath(os.path.dirname(os.path.abspath(input_filename)), os.path.abspath(input_root))
+        if relative_directory != os.curdir and not relative_directory.startswith(os.pardir):
+            output_directory = os.path.join(output_directory, relative_directory)
+    return os.path.join(output_directory, basename + ".seg.nrrd")
+
+
+def _glob_root(pattern):
+    """Get the folder part of a glob pattern that does not contain wildcards."""
+    import glob
+    import os
+    root = os.path.dirname(pattern)
+    while glob.has_magic(root):
+        root = os.path.dirname(root)
+    return root or os.curdir
+
+
+def _process_file(input_filename, output_filename, segment_names_to_label_values, compression_level, compression_threads):
+    """Read, extract segments, and write a single segmentation file. Runs in a worker process."""
+    import os
+    from .segmentation import extract_segments, read_segmentation, write_segmentation
+
+    if os.path.abspath(input_filename) == os.path.abspath(output_filename):
+        raise ValueError("Output file would overwrite the input file")
+    os.makedirs(os.path.dirname(output_filename) or os.curdir, exist_ok=True)
+    segmentation = read_segmentation(input_filename)
+    if segment_names_to_label_values is not None:
+        segmentation = extract_segments(segmentation, segment_names_to_label_values)
+    write_segmentation(output_filename, segmentation, compression_level=compression_level, compression_threads=compression_threads)
+    return output_filename
+
+
+def process_segmentations(input_files, output_directory, segment_names_to_label_values=None, processes=None,
+        max_in_flight=None, compression_level=9, progress_callback=None):
+    """Read segmentation files, extract segments, and write the results into the output directory, in parallel.
+
+    :param input_files: list of input file paths or glob patterns (for example, `path/to/**/*.seg.nrrd`)
+    :param output_directory: folder where the output .seg.nrrd files are written. It is created if it does not exist.
+        Files that are found by a glob pattern are written into the same subfolder (relative to the part of the pattern
+        that does not contain wildcards) as the input file. If multiple input files would be written to the same output file
+        then only the first one is processed, the others are reported as errors.
+    :param segment_names_to_label_values: list of segment name (or terminology) and label value pairs, as in `extract_segments`.
+        If None then the segmentation is written without changes (e.g., for converting NIFTI files to .seg.nrrd).
+    :param processes: number of worker processes. If None then the number of CPUs is used.
+        If 1 then files are processed in the current process.
+    :param max_in_flight: maximum number of files that are submitted for processing at the same time.
+        Limits memory usage. Defaults to the number of processes.
+    :param compression_level: gzip compression level of the output files
+    :param progress_callback: function that is called after each processed file with arguments
+        (number of processed files, total number of files, result of the file). See the returned value for the result format.
+    :return: list of results, one for each input file, in input order. Each result is a dict with keys
+        "input", "output" (None if processing failed), and "error" (None if processing succeeded).
+    """
+    from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+    import glob
+    import os
+
+    input_filenames = []
+    output_filenames = []
+    for input_file in input_files:
+        input_file = os.fspath(input_file)
+        if glob.has_magic(input_file):
+            input_root = _glob_root(input_file)
+            for input_filename in sorted(glob.glob(input_file, recursive=True)):
+                input_filenames.append(input_filename)
+                output_filenames.append(output_filename(input_filename, output_directory, input_root))
+        else:
+            input_filenames.append(input_file)
+            output_filenames.append(output_filename(input_file, output_directory))
+
+    os.makedirs(output_directory, exist_ok=True)
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if max_in_flight is None:
+        max_in_flight = processes
+
+    results = [{"input": input_filename, "output": None, "error": None} for input_filename in input_filenames]
+    tasks = []
+    # Input file that each output file is written from, for detecting output file name collisions
+    input_filename_by_output = {}
+    for result, input_filename, output_filepath in zip(results, input_filenames, output_filenames):
+        output_key = os.path.normcase(os.path.abspath(output_filepath))
+        if output_key in input_filename_by_output:
+            result["error"] = f"ValueError: Output file {output_filepath} would overwrite the output of {input_filename_by_output[output_key]}"
+            continue
+        input_filename_by_output[output_key] = input_filename
+        tasks.append((result, (input_filename, output_filepath, segment_names_to_label_values, compression_level, 1)))
+
+    processed_count = 0
+
+    def report(result):
+        nonlocal processed_count
+        processed_count += 1
+        if progress_callback:
+            progress_callback(processed_count, len(results), result)
+
+    for result in results:
+        if result["error"]:
+            # Output file name collision
+            report(result)
+
+    if processes == 1:
+        for result, arguments in tasks:
+            try:
+                result["output"] = _process_file(*arguments)
+            except Exception as e:
+                result["error"] = f"{type(e).__name__}: {str(e)}"
+            report(result)
+        return results
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        pending = {}
+        next_task_index = 0
+        while next_task_index < len(tasks) or pending:
+            # Keep at most max_in_flight files submitted
+            while next_task_index < len(tasks) and len(pending) < max_in_flight:
+                result, arguments = tasks[next_task_index]
+                pending[executor.submit(_process_file, *arguments)] = result
+                next_task_index += 1
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = pending.pop(future)
+                try:
+                    result["output"] = future.result()
+                except Exception as e:
+                    result["error"] = f"{type(e).__name__}: {str(e)}"
+                report(result)
+
+    return results
+
+
+def main(argv=None):
+    """Command-line interface for `process_segmentations`."""
+    import argparse
+    import json
+    import sys
+
+    parser = argparse.ArgumentParser(prog="slicerio-batch",
+        description="Read segmentation files, extract segments, and write them as .seg.nrrd files, using multiple processes.")
+    parser.add_argument("input_files", nargs="+", help="input file paths or glob patterns (e.g., 'path/to/**/*.seg.nrrd')")
+    parser.add_argument("-o", "--output-directory", required=True, help="folder where output files are written")
+    parser.add_argument("-m", "--mapping", help="JSON file containing list of [segment name or terminology, label value] pairs")
+    parser.add_argument("-p", "--processes", type=int, default=None, help="number of worker processes (default: number of CPUs)")
+    parser.add_argument("--max-in-flight", type=int, default=None, help="maximum number of files processed at the same time")
+    parser.add_argument("--compression-level", type=int, default=9, help="gzip compression level (1-9)")
+    args = parser.parse_args(argv)
+
+    segment_names_to_label_values = None
+    if args.mapping:
+        with open(args.mapping) as f:
+            segment_names_to_label_values = [tuple(item) for item in json.load(f)]
+
+    def print_progress(processed_count, total_count, result):
+        status = "failed: " + result["error"] if result["error"] else "done"
+        print(f"[{processed_count}/{total_count}] {result['input']}: {status}", flush=True)
+
+    results = process_segmentations(args.input_files, args.output_directory, segment_names_to_label_values,
+        processes=args.processes, max_in_flight=args.max_in_flight, compression_level=args.compression_level,
+        progress_callback=print_progress)
+
+    failed_results = [result for result in results if result["error"]]
+    print(f"Processed {len(results)} files, {len(failed_results)} failed.")
+    for result in failed_results:
+        print(f"  {result['input']}: {result['error']}", file=sys.stderr)
+    return 1 if failed_results else 0
+
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(main())
@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
 
+import threading
+
+
 def terminology_entry_from_string(terminology_str):
     """Converts a terminology string to a dict.
 
@@ -96,8 +99,44 @@ def generate_unique_segment_id(existing_segment_ids):
             return segment_id
 
 
-def read_segmentation(filename, skip_voxels=False):
-    """Read segmentation metadata from a .seg.nrrd file or NIFTI file and store it in a dict.
+def read_segmentation(filename, skip_voxels=False, memory_map=False, crop_to_segments=None, out=None, sparse=False, sidecar_filename=None, cache=False):
+    """Read segmentation metadata from a .seg.nrrd file, NIFTI file, or Zarr store and store it in a dict.
+
+    :param filename: path of the segmentation file, or path of a Zarr store directory or zip file
+        (written by `write_segmentation`, see `slicerio.segmentation_zarr`)
+    :param skip_voxels: if True then only the metadata is read, "voxels" is set to None
+    :param memory_map: if True and the file is an uncompressed (raw encoding) NRRD file then "voxels"
+        is a copy-on-write `numpy.memmap` that only loads the parts of the file that are accessed.
+        Modifications of the voxels are not written back to the file.
+        Compressed files are read into memory as usual.
+    :param crop_to_segments: list of segment names, terminology dicts, or `TerminologyMatcher` objects. If specified then
+        the voxel array is cropped to the union of the extents of these segments. Only the slices that contain the cropped region are decompressed.
+        "ijkToLPS", "referenceImageExtentOffset" and extent of the segments are updated to match the cropped voxel array.
+    :param out: optional Fortran-contiguous numpy array (with the same shape and dtype as the voxels in the file)
+        that the voxels are read into. It allows reusing a preallocated buffer when reading many files.
+        Compressed voxel data is always decompressed chunk by chunk directly into the voxel array, so that neither
+        the whole compressed data nor a temporary copy of the decompressed data has to be kept in memory.
+    :param sparse: if True then the segmentation is returned in sparse representation (see `sparse_segmentation`):
+        "voxels" is set to None and each segment stores its own binary mask, cropped to the segment's bounding box.
+        Voxel data is read slab by slab, therefore the dense voxel array is never kept in memory.
+    :param sidecar_filename: file that describes the segments of a NIFTI label image. If not specified then
+        a JSON file (`path/to/Segmentation.json`) or Slicer color table file (`path/to/Segmentation.ctbl`)
+        next to the NIFTI file (`path/to/Segmentation.nii.gz`) is used, if it exists. Supported formats:
+
+        - JSON file containing "segments": list of segments in the same format as in the returned segmentation
+          (written by `write_segmentation_nifti`)
+        - JSON file containing "labels": dict of label value -> segment name (or name -> label value, as in
+          nnU-Net dataset.json files). Regions of nnU-Net region-based training (name -> list of label values) are ignored.
+        - Slicer color table file (.ctbl or .txt): each line contains label value, name, red, green, blue, alpha
+          (0-255), and optionally a terminology entry string.
+
+        Segments are listed in the order they appear in the sidecar file. Label values that are present
+        in the voxels but are not described in the sidecar file are added as segments, named "Segment_<label value>".
+    :param cache: if True then the decoded segmentation is kept in memory and subsequent reads of the same file
+        (with unchanged modification time and size) are served from memory, without decompressing the file again.
+        Cached voxels are returned as read-only arrays (use `voxels.copy()` to get a modifiable array).
+        Least recently used segmentations are removed from the cache when the total size of cached voxels exceeds
+        the limit set by `set_segmentation_cache_size`. Cannot be used with `memory_map` and `out`.
 
     Example header:
 
@@ -226,14 +265,23 @@ def read_segmentation(filename, skip_voxels=False):
     import logging
     import nrrd
     import numpy as np
-    import re
+    from .segmentation_zarr import is_zarr_store, read_segmentation_zarr
+
+    if cache:
+        if memory_map or out is not None:
+            raise ValueError("Memory mapping and output array cannot be used with cache")
+        return _read_segmentation_cached(filename, skip_voxels, crop_to_segments, sparse, sidecar_filename)
+
+    if is_zarr_store(filename):
+        if memory_map or out is not None:
+            raise ValueError("Memory mapping and output array are not supported for Zarr stores")
+        segmentation = read_segmentation_zarr(filename, skip_voxels=skip_voxels, crop_to_segments=crop_to_segments)
+        return sparse_segmentation(segmentation) if sparse and not skip_voxels else segmentation
 
     try:
-        if skip_voxels:
-            header = nrrd.read_header(filename)
-            voxels = None
-        else:
-            voxels, header = nrrd.read(filename)
+        with open(filename, "rb") as fh:
+            header, segments_fields = _read_segmentation_header(fh)
+            data_offset = fh.tell()
     except nrrd.errors.NRRDError as e:
 
         # Not a NRRD file, maybe it is a NIFTI file that contains label image.
@@ -247,6 +295,8 @@ def read_segmentation(filename, skip_voxels=False):
                 nifti_image = nib.load(filename)
             except Exception as e:
                 raise IOError(f"Failed to read NIFTI file: {str(e)}")
+            if crop_to_segments is not None or out is not None:
+                raise ValueError("Cropping to segments and output array are only supported for NRRD files")
 
             segmentation = OrderedDict()
 
@@ -256,21 +306,35 @@ def read_segmentation(filename, skip_voxels=False):
             # NIFTI affine is IJK to RAS, we convert it to IJK to LPS
             segmentation["ijkToLPS"] = np.diag([-1, -1, 1, 1]).dot(nifti_image.affine)
 
-            segmentation["voxels"] = None if skip_voxels else nifti_image.get_fdata().astype(np.int16)
-
-            # Add segment for each label value
-            label_values = np.unique(segmentation["voxels"])
-            label_values.sort()
-            # remove zero label (corresponds to background)
-            label_values = label_values[label_values != 0]
-            segments = []
-            for label_value in label_values:
-                segment = OrderedDict()
-                segment["labelValue"] = int(label_value)
-                segment["name"] = f"Segment_{label_value}"
-                segments.append(segment)
-            if segments:
-                segmentation["segments"] = segments
+            segmentation["voxels"] = None if skip_voxels else _read_nifti_voxels(nifti_image)
+
+            # Segment metadata is read from the sidecar file, if available
+            if sidecar_filename is None:
+                sidecar_filename = _find_nifti_sidecar(filename)
+            segments = _read_label_descriptions(sidecar_filename) if sidecar_filename else []
+
+            # Add segment for each label value that is present in the voxels but not described in the sidecar file
+            voxels = segmentation["voxels"]
+            if voxels is not None:
+                described_label_values = set((segment.get("layer", 0), segment["labelValue"]) for segment in segments)
+                layers = [voxels] if voxels.ndim == 3 else [voxels[layer] for layer in range(voxels.shape[0])]
+                for layer, layer_voxels in enumerate(layers):
+                    for label_value in _label_values_in_voxels(layer_voxels):
+                        if label_value == 0 or (layer, label_value) in described_label_values:
+                            # zero label corresponds to background
+                            continue
+                        segment = OrderedDict()
+                        segment["labelValue"] = label_value
+                        if voxels.ndim == 4:
+                            segment["layer"] = layer
+                            segment["name"] = f"Segment_{layer}_{label_value}"
+                        else:
+                            segment["name"] = f"Segment_{label_value}"
+                        segments.append(segment)
+            segmentation["segments"] = segments
+
+            if sparse and not skip_voxels:
+                segmentation = sparse_segmentation(segmentation)
 
             return segmentation
 
@@ -279,8 +343,6 @@ def read_segmentation(filename, skip_voxels=False):
 
     segmentation = OrderedDict()
 
-    segments_fields = {}  # map from segment index to key:value map
-
     multiple_layers = False
     spaceToLps = np.eye(4)
     ijkToSpace = np.eye(4)
@@ -348,24 +410,15 @@ def read_segmentation(filename, skip_voxels=False):
             # Segmentation_ReferenceImageExtentOffset:=0 0 0
             segmentation["referenceImageExtentOffset"] = [int(i) for i in header[header_key].split(" ")]
             continue
-        
-        segment_match = re.match("^Segment([0-9]+)_(.+)", header_key)
-        if segment_match:
-            # Store in segment_fields (segmentation field)
-            segment_index = int(segment_match.groups()[0])
-            segment_key = segment_match.groups()[1]
-            if segment_index not in segments_fields:
-                segments_fields[segment_index] = {}
-            segments_fields[segment_index][segment_key] = header[header_key]
-            continue
-        
+
         segmentation[header_key] = header[header_key]
 
     # Compute voxel to physical transformation matrix
     ijkToLps = np.dot(spaceToLps, ijkToSpace)
     segmentation["ijkToLPS"] = ijkToLps
 
-    segmentation["voxels"] = voxels
+    # Voxels are read after segment metadata is processed (segment extents may be needed for reading)
+    segmentation["voxels"] = None
 
     # Process segment_fields to build segment_info
 
@@ -414,7 +467,7 @@ def read_segmentation(filename, skip_voxels=False):
                 key, value = tag_str.split(":", maxsplit=1)
                 # Process known tags: TerminologyEntry and Segmentation.Status, store all other tags as they are
                 if key == "TerminologyEntry":
-                    segment_info["terminology"] = terminology_entry_from_string(value)
+                    segment_info["terminology"] = _terminology_entry_from_string_cached(value)
                 elif key == "Segmentation.Status":
                     segment_info["status"] = value
                 else:
@@ -425,20 +478,781 @@ def read_segmentation(filename, skip_voxels=False):
 
     segmentation["segments"] = segments_info
 
+    voxel_array_region = None
+    if crop_to_segments is not None:
+        voxel_array_region = _crop_segmentation_metadata(segmentation, header["sizes"][-3:], crop_to_segments)
+
+    if sparse and not skip_voxels:
+        if memory_map or out is not None:
+            raise ValueError("Memory mapping and output array cannot be used with sparse representation")
+        shape = [int(size) for size in header["sizes"][-3:]]
+        if voxel_array_region is not None:
+            shape = [voxel_array_region[axis*2+1] - voxel_array_region[axis*2] + 1 if _isValidExtent(voxel_array_region) else 0
+                for axis in range(3)]
+        try:
+            slabs = _read_nrrd_voxel_slabs(filename, header, data_offset, voxel_array_region)
+            segment_masks = _read_sparse_segment_masks(slabs, segmentation["segments"], multiple_layers)
+        except nrrd.errors.NRRDError as e:
+            raise IOError(f"Failed to read segmentation file: {str(e)}")
+        for segment, (extent, mask) in zip(segmentation["segments"], segment_masks):
+            segment["extent"] = extent
+            segment["mask"] = mask
+        segmentation["voxelsShape"] = shape
+    elif not skip_voxels:
+        try:
+            segmentation["voxels"] = _read_nrrd_voxels(filename, header, data_offset, voxel_array_region, memory_map, out)
+        except nrrd.errors.NRRDError as e:
+            raise IOError(f"Failed to read segmentation file: {str(e)}")
+
     return segmentation
 
 
-def write_segmentation(file, segmentation, compression_level=9, index_order=None):
+def _read_nifti_voxels(nifti_image):
+    """Read voxels of a NIFTI label image, using the smallest integer type that can store all the label values.
+    Integer voxel data without intensity scaling is read directly from the file (without creating a floating-point copy).
     """
-    Extracts segments from a segmentation volume and header.
-    :param segmentation: segmentation metadata and voxels
+    import numpy as np
+
+    data_proxy = nifti_image.dataobj
+    slope = getattr(data_proxy, "slope", 1.0)
+    inter = getattr(data_proxy, "inter", 0.0)
+    if nifti_image.get_data_dtype().kind in "iu" and slope == 1.0 and inter == 0.0:
+        voxels = np.asanyarray(data_proxy)
+    else:
+        # Floating-point or scaled voxel data: convert to single precision (instead of the default double) and round
+        voxels = nifti_image.get_fdata(dtype=np.float32)
+        np.rint(voxels, out=voxels)
+
+    if voxels.size > 0:
+        dtype = _minimal_label_dtype([int(voxels.min()), int(voxels.max())])
+    else:
+        dtype = np.dtype(np.uint8)
+    if voxels.dtype != dtype:
+        voxels = voxels.astype(dtype, order="K")
+    if voxels.ndim == 4:
+        # Multiple layers are stored along the 4th axis of the NIFTI image, segmentation voxel array has layer as first axis
+        voxels = np.moveaxis(voxels, 3, 0)
+    return voxels
+
+
+def _label_values_in_voxels(voxels):
+    """Get sorted list of distinct values in an integer voxel array.
+    Values are counted (using bincount, in chunks) instead of sorting all the voxels.
+    """
+    import numpy as np
+
+    flat_voxels = voxels.ravel(order="K")
+    if flat_voxels.size == 0:
+        return []
+    if voxels.dtype.kind in "iu" and voxels.dtype.itemsize <= 2:
+        # Count bit patterns, all possible values fit in a small histogram
+        index_dtype = np.dtype(f"u{voxels.dtype.itemsize}")
+        histogram_size = np.iinfo(index_dtype).max + 1
+        counts = np.zeros(histogram_size, dtype=np.int64)
+        for start in range(0, flat_voxels.size, _REMAP_CHUNK_SIZE):
+            counts += np.bincount(flat_voxels[start:start + _REMAP_CHUNK_SIZE].view(index_dtype), minlength=histogram_size)
+        # Signed values are restored from their bit patterns
+        return sorted(np.flatnonzero(counts).astype(index_dtype).view(voxels.dtype).tolist())
+
+    min_value, max_value = flat_voxels.min().item(), flat_voxels.max().item()
+    if voxels.dtype.kind not in "iu" or max_value - min_value >= _LABEL_HISTOGRAM_MAX_SIZE:
+        return np.unique(flat_voxels).tolist()
+    # Count values relative to the minimum
+    histogram_size = max_value - min_value + 1
+    counts = np.zeros(histogram_size, dtype=np.int64)
+    for start in range(0, flat_voxels.size, _REMAP_CHUNK_SIZE):
+        chunk = flat_voxels[start:start + _REMAP_CHUNK_SIZE]
+        counts += np.bincount((chunk - min_value).astype(np.intp), minlength=histogram_size)
+    return [int(index) + min_value for index in np.flatnonzero(counts)]
+
+
+# Maximum range of label values that are counted using a histogram
+_LABEL_HISTOGRAM_MAX_SIZE = 2**24
+
+
+def _find_nifti_sidecar(filename):
+    """Get file name of the segment description file next to a NIFTI file, None if not found."""
+    import os
+
+    base_filename = filename[:-len(".nii.gz")] if filename.endswith(".nii.gz") else filename[:-len(".nii")]
+    for extension in [".json", ".ctbl"]:
+        if os.path.exists(base_filename + extension):
+            return base_filename + extension
+    return None
+
+
+def _read_label_descriptions(filename):
+    """Read segment metadata from a JSON or Slicer color table file. See `read_segmentation` for supported formats.
+    :return: list of segments
+    """
+    from collections import OrderedDict
+    import json
+    import logging
+
+    segments = []
+    if filename.lower().endswith(".json"):
+        with open(filename) as f:
+            descriptions = json.load(f)
+        if "segments" in descriptions:
+            for segment_description in descriptions["segments"]:
+                segment = OrderedDict(segment_description)
+                if "labelValue" not in segment:
+                    raise ValueError(f"labelValue is missing from segment description in {filename}")
+                segments.append(segment)
+        elif "labels" in descriptions:
+            for key, value in descriptions["labels"].items():
+                if isinstance(value, list):
+                    # nnU-Net region-based training: name -> list of label values
+                    logging.warning(f"Region '{key}' in {filename} is ignored, regions (lists of label values) are not supported")
+                    continue
+                if isinstance(value, int):
+                    # nnU-Net style: name -> label value
+                    label_value, name = value, key
+                else:
+                    try:
+                        label_value, name = int(key), value
+                    except ValueError:
+                        raise ValueError(f"Invalid label value '{key}' in {filename}")
+                if label_value == 0:
+                    # background
+                    continue
+                segments.append(OrderedDict([("labelValue", label_value), ("name", name)]))
+        else:
+            raise ValueError(f"Segment descriptions are not found in {filename}")
+        return segments
+
+    # Slicer color table: label value, name, red, green, blue, alpha (0-255), optional terminology entry string
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            # Terminology entry string may contain spaces, therefore it is not split
+            fields = line.split(maxsplit=6)
+            label_value = int(fields[0])
+            if label_value == 0 or len(fields) < 2:
+                continue
+            segment = OrderedDict([("labelValue", label_value), ("name", fields[1])])
+            if len(fields) >= 5:
+                segment["color"] = [int(component) / 255.0 for component in fields[2:5]]
+            terminology_str = fields[6] if len(fields) > 6 else ""
+            if "~" in terminology_str:
+                segment["terminology"] = _terminology_entry_from_string_cached(terminology_str)
+            segments.append(segment)
+    return segments
+
+
+def _read_segmentation_header(fh):
+    """Read the NRRD header of a segmentation file.
+
+    The header is tokenized at once: segment fields (Segment<index>_<name>:=<value>) are extracted and grouped
+    by segment index, other custom fields are stored as strings, and only the few standard NRRD fields are parsed by pynrrd.
+    This is much faster than parsing all fields with pynrrd when there are hundreds of segments.
+
+    :param fh: file object opened in binary mode. On return, the file position is at the first byte of data.
+    :return: header (dict of field name -> value), segments_fields (dict of segment index -> dict of segment field name -> value)
+    """
+    import nrrd
+    import re
+
+    start_position = fh.tell()
+    header_bytes = fh.read(_HEADER_READ_SIZE)
+    if not header_bytes.startswith(b"NRRD"):
+        # Checked here to avoid reading through a potentially large non-NRRD file looking for the end of the header
+        raise nrrd.errors.NRRDError(f"Invalid NRRD magic line: {header_bytes[:16]}")
+
+    # Header ends at the first blank line (or at the end of file, in case of detached header)
+    header_end_pattern = re.compile(rb"\n[ \t\r\f\v]*\n")
+    search_start = 0
+    while True:
+        header_end = header_end_pattern.search(header_bytes, search_start)
+        if header_end:
+            header_bytes, header_size = header_bytes[:header_end.start()], header_end.end()
+            break
+        block = fh.read(_HEADER_READ_SIZE)
+        if not block:
+            header_size = len(header_bytes)
+            break
+        search_start = max(len(header_bytes) - 1, 0)
+        header_bytes += block
+    fh.seek(start_position + header_size)
+    header_str = header_bytes.decode("ascii", "ignore")
+
+    # Segment0_Color:=0.501961 0.682353 0.501961
+    segment_field_pattern = re.compile(r"^Segment([0-9]+)_([^:\n]+):=(.*)$", re.MULTILINE)
+    segments_fields = {}  # map from segment index to key:value map
+    for segment_index, key, value in segment_field_pattern.findall(header_str):
+        fields = segments_fields.setdefault(int(segment_index), {})
+        key = key.strip()
+        if key in fields:
+            raise nrrd.errors.NRRDError(f"Duplicate header field: Segment{segment_index}_{key}")
+        fields[key] = value.strip()
+
+    # Remaining fields
+    standard_lines = []
+    custom_fields = {}
+    for line in segment_field_pattern.sub("", header_str).split("\n"):
+        line = line.rstrip()
+        if not line or line.startswith("#"):
+            continue
+        separator_index = line.find(":")
+        if separator_index < 0 or not line.startswith(":=", separator_index):
+            # Magic line and standard fields
+            standard_lines.append(line)
+            continue
+        key = line[:separator_index].strip()
+        if key in custom_fields:
+            raise nrrd.errors.NRRDError(f"Duplicate header field: {key}")
+        custom_fields[key] = line[separator_index + 2:].strip()
+
+    header = nrrd.read_header(standard_lines)
+    for key, value in custom_fields.items():
+        if key in header:
+            raise nrrd.errors.NRRDError(f"Duplicate header field: {key}")
+        header[key] = value
+
+    return header, segments_fields
+
+
+# Number of bytes read at once while looking for the end of NRRD header
+_HEADER_READ_SIZE = 2**16
+
+
+# Parsed terminology entries, indexed by terminology string.
+# The same terminology strings are used in many segments and files, therefore parsing results are reused.
+_TERMINOLOGY_CACHE = {}
+_TERMINOLOGY_CACHE_MAX_SIZE = 10000
+
+
+def _terminology_entry_from_string_cached(terminology_str):
+    """Same as `terminology_entry_from_string` but the result is cached."""
+    terminology = _TERMINOLOGY_CACHE.get(terminology_str)
+    if terminology is None:
+        terminology = terminology_entry_from_string(terminology_str)
+        if len(_TERMINOLOGY_CACHE) >= _TERMINOLOGY_CACHE_MAX_SIZE:
+            _TERMINOLOGY_CACHE.clear()
+        _TERMINOLOGY_CACHE[terminology_str] = terminology
+    # Return a copy, as the caller may modify the returned terminology
+    return {key: value.copy() if type(value) is list else value for key, value in terminology.items()}
+
+
+# Decoded segmentations, indexed by absolute file path, in least recently used first order.
+# Each item contains the file signature (modification time and size), the segmentation, and the size of its voxels.
+_SEGMENTATION_CACHE = {}
+_SEGMENTATION_CACHE_MAX_BYTES = 2**30
+# Limits the number of cached segmentations, including the ones that only contain metadata (voxels are not cached)
+_SEGMENTATION_CACHE_MAX_ENTRIES = 1000
+_SEGMENTATION_CACHE_LOCK = threading.Lock()
+
+
+def set_segmentation_cache_size(max_bytes, max_entries=None):
+    """Set the maximum total size of voxel arrays kept in memory by `read_segmentation(..., cache=True)`.
+
+    Least recently used segmentations are removed from the cache to stay within the limits.
+    Segmentations with voxels larger than the limit are not cached (only their metadata).
+
+    :param max_bytes: maximum size in bytes. 0 disables caching of voxels.
+    :param max_entries: maximum number of cached segmentations (including the ones that are cached without voxels,
+        such as segmentations read with `skip_voxels=True`). If None then the current limit (default: 1000) is kept.
     """
+    global _SEGMENTATION_CACHE_MAX_BYTES, _SEGMENTATION_CACHE_MAX_ENTRIES
+    with _SEGMENTATION_CACHE_LOCK:
+        _SEGMENTATION_CACHE_MAX_BYTES = max_bytes
+        if max_entries is not None:
+            _SEGMENTATION_CACHE_MAX_ENTRIES = max_entries
+        _evict_cached_segmentations()
+
+
+def clear_segmentation_cache():
+    """Remove all segmentations from the cache used by `read_segmentation(..., cache=True)`."""
+    with _SEGMENTATION_CACHE_LOCK:
+        _SEGMENTATION_CACHE.clear()
+
+
+def _evict_cached_segmentations():
+    """Remove least recently used segmentations until cached voxels fit into the size limit
+    and the number of cached segmentations is within the limit. Must be called with the lock held."""
+    total_bytes = sum(cached_bytes for _, _, cached_bytes in _SEGMENTATION_CACHE.values())
+    while total_bytes > _SEGMENTATION_CACHE_MAX_BYTES or len(_SEGMENTATION_CACHE) > _SEGMENTATION_CACHE_MAX_ENTRIES:
+        _, _, cached_bytes = _SEGMENTATION_CACHE.pop(next(iter(_SEGMENTATION_CACHE)))
+        total_bytes -= cached_bytes
+
+
+def _read_segmentation_cached(filename, skip_voxels, crop_to_segments, sparse, sidecar_filename):
+    """Read segmentation using the decoded segmentation cache. See `read_segmentation` for parameters."""
+    from collections import OrderedDict
+    import copy
+    import os
+
+    if skip_voxels and crop_to_segments is not None:
+        # Size of the voxel array is needed for cropping, which is not stored in metadata-only cache items
+        return read_segmentation(filename, skip_voxels=True, crop_to_segments=crop_to_segments, sidecar_filename=sidecar_filename)
+
+    path = os.path.abspath(os.fspath(filename))
+    signature = _segmentation_cache_signature(path, sidecar_filename)
+
+    with _SEGMENTATION_CACHE_LOCK:
+        cached_item = _SEGMENTATION_CACHE.get(path)
+        if cached_item is not None and cached_item[0] == signature and (skip_voxels or cached_item[1]["voxels"] is not None):
+            # Move to the end to mark as most recently used
+            _SEGMENTATION_CACHE[path] = _SEGMENTATION_CACHE.pop(path)
+            cached_segmentation = cached_item[1]
+        else:
+            cached_segmentation = None
+
+    if cached_segmentation is None:
+        cached_segmentation = read_segmentation(filename, skip_voxels=skip_voxels, sidecar_filename=sidecar_filename)
+        voxels = cached_segmentation["voxels"]
+        cached_bytes = voxels.nbytes if voxels is not None else 0
+        with _SEGMENTATION_CACHE_LOCK:
+            _SEGMENTATION_CACHE.pop(path, None)
+            if cached_bytes > _SEGMENTATION_CACHE_MAX_BYTES:
+                # Too large to be cached, only keep the metadata
+                _SEGMENTATION_CACHE[path] = (signature, OrderedDict(cached_segmentation, voxels=None), 0)
+            else:
+                if voxels is not None:
+                    # Prevent modification of the cached voxels through the returned arrays
+                    voxels.flags.writeable = False
+                _SEGMENTATION_CACHE[path] = (signature, cached_segmentation, cached_bytes)
+            _evict_cached_segmentations()
+
+    # Return a copy of the metadata, as the caller may modify it
+    segmentation = OrderedDict()
+    for key, value in cached_segmentation.items():
+        segmentation[key] = None if key == "voxels" else copy.deepcopy(value)
+    if skip_voxels:
+        return segmentation
+
+    voxels = cached_segmentation["voxels"]
+    if crop_to_segments is not None:
+        region = _crop_segmentation_metadata(segmentation, voxels.shape[-3:], crop_to_segments)
+        voxels = voxels[(Ellipsis,) + _extent_region(region)]
+    segmentation["voxels"] = voxels.view()
+    if sparse:
+        segmentation = sparse_segmentation(segmentation)
+    return segmentation
+
+
+def _segmentation_cache_signature(path, sidecar_filename):
+    """Get a value that changes when the segmentation file (or the sidecar file of a NIFTI file) is modified."""
+    import os
+
+    file_stat = os.stat(path)
+    # Segment descriptions of NIFTI files may be read from a sidecar file, which may change independently
+    sidecar_signature = None
+    if path.endswith((".nii", ".nii.gz")):
+        used_sidecar_filename = sidecar_filename if sidecar_filename is not None else _find_nifti_sidecar(path)
+        if used_sidecar_filename is not None and os.path.exists(used_sidecar_filename):
+            sidecar_stat = os.stat(used_sidecar_filename)
+            sidecar_signature = (os.path.abspath(os.fspath(used_sidecar_filename)), sidecar_stat.st_mtime_ns, sidecar_stat.st_size)
+    return (file_stat.st_mtime_ns, file_stat.st_size, sidecar_filename, sidecar_signature)
+
+
+def _crop_segmentation_metadata(segmentation, shape, segment_names_or_terminologies):
+    """Update segmentation metadata so that it describes a voxel array cropped to the union of the specified segments' extents.
+    :param segmentation: segmentation metadata, it is updated in-place
+    :param shape: shape of the spatial axes of the original voxel array
+    :param segment_names_or_terminologies: list of segment names, terminology dicts, or `TerminologyMatcher` objects
+    :return: the cropped region (first and last voxel index along each spatial axis) in the original voxel array
+    """
+    full_extent = [0, shape[0]-1, 0, shape[1]-1, 0, shape[2]-1]
+    extents = []
+    segment_index = SegmentIndex(segmentation)
+    for segment_name_or_terminology in segment_names_or_terminologies:
+        segments = segment_index.segments_from_name_or_terminology(segment_name_or_terminology)
+        if not segments:
+            raise ValueError(f"Segment not found: {segment_name_or_terminology}")
+        extents += [segment["extent"] if "extent" in segment else full_extent for segment in segments]
+
+    return _crop_segmentation_metadata_to_region(segmentation, shape, _union_of_extents(extents))
+
+
+def _crop_segmentation_metadata_to_region(segmentation, shape, region):
+    """Update segmentation metadata so that it describes a voxel array cropped to the specified region.
+    :param segmentation: segmentation metadata, it is updated in-place
+    :param shape: shape of the spatial axes of the original voxel array
+    :param region: first and last voxel index along each spatial axis, it is clipped to the voxel array
+    :return: the clipped region in the original voxel array
+    """
+    import numpy as np
+
+    full_extent = [0, shape[0]-1, 0, shape[1]-1, 0, shape[2]-1]
+
+    # Clip the region to the voxel array
+    clipped_region = []
+    for axis in range(3):
+        clipped_region.append(max(region[axis*2], 0))
+        clipped_region.append(min(region[axis*2+1], shape[axis]-1))
+    region = clipped_region
+    if not _isValidExtent(region):
+        # None of the segments contain any voxels
+        region = [0, -1, 0, -1, 0, -1]
+    offset = region[0::2]
+
+    # Origin of the cropped array
+    ijkToLPS = np.array(segmentation["ijkToLPS"], dtype=float)
+    ijkToLPS[0:3, 3] = ijkToLPS.dot(offset + [1])[0:3]
+    segmentation["ijkToLPS"] = ijkToLPS
+
+    # Position of the cropped array in the reference image
+    reference_offset = segmentation.get("referenceImageExtentOffset", [0, 0, 0])
+    segmentation["referenceImageExtentOffset"] = [reference_offset[axis] + offset[axis] for axis in range(3)]
+
+    # Segment extents are relative to the voxel array
+    cropped_shape = [region[axis*2+1] - region[axis*2] + 1 for axis in range(3)]
+    for segment in segmentation["segments"]:
+        extent = segment["extent"] if "extent" in segment else full_extent
+        if not _isValidExtent(extent):
+            continue
+        cropped_extent = []
+        for axis in range(3):
+            cropped_extent.append(max(extent[axis*2] - offset[axis], 0))
+            cropped_extent.append(min(extent[axis*2+1] - offset[axis], cropped_shape[axis]-1))
+        segment["extent"] = cropped_extent if _isValidExtent(cropped_extent) else [0, -1, 0, -1, 0, -1]
+
+    return region
+
+
+# NRRD pixel type names and corresponding numpy data types
+_NRRD_TYPES = {
+    "signed char": "i1", "int8": "i1", "int8_t": "i1",
+    "uchar": "u1", "unsigned char": "u1", "uint8": "u1", "uint8_t": "u1",
+    "short": "i2", "short int": "i2", "signed short": "i2", "signed short int": "i2", "int16": "i2", "int16_t": "i2",
+    "ushort": "u2", "unsigned short": "u2", "unsigned short int": "u2", "uint16": "u2", "uint16_t": "u2",
+    "int": "i4", "signed int": "i4", "int32": "i4", "int32_t": "i4",
+    "uint": "u4", "unsigned int": "u4", "uint32": "u4", "uint32_t": "u4",
+    "longlong": "i8", "long long": "i8", "long long int": "i8", "signed long long": "i8", "signed long long int": "i8",
+    "int64": "i8", "int64_t": "i8",
+    "ulonglong": "u8", "unsigned long long": "u8", "unsigned long long int": "u8", "uint64": "u8", "uint64_t": "u8",
+    "float": "f4", "double": "f8",
+}
+
+
+def _nrrd_dtype(header):
+    """Get numpy data type of the voxels stored in a NRRD file from the parsed header."""
+    import numpy as np
+    dtype = np.dtype(_NRRD_TYPES[header["type"]])
+    if dtype.itemsize > 1:
+        dtype = dtype.newbyteorder("<" if header.get("endian", "little") == "little" else ">")
+    return dtype
+
+
+def _read_nrrd_voxels(filename, header, data_offset, region=None, memory_map=False, out=None):
+    """Read the voxel array of a NRRD file.
+    :param filename: NRRD file name
+    :param header: parsed NRRD header
+    :param data_offset: position of the first byte of data in the file
+    :param region: first and last voxel index along each spatial axis (same format as segment extent).
+        If specified then only this region of the voxel array is returned. Slices (along the last axis)
+        that are outside of the region are not decompressed.
+    :param memory_map: map raw encoded voxels to the file content instead of reading them into memory
+    :param out: Fortran-contiguous array that receives the voxels. If not specified then a new array is allocated.
+    :return: voxel array
+    """
+    import nrrd
     import numpy as np
 
+    sizes = [int(size) for size in header["sizes"]]
+    dtype = _nrrd_dtype(header)
+    byte_skip = header.get("byte skip", header.get("byteskip", 0))
+    attached_data = not any(key in header for key in ["data file", "datafile", "line skip", "lineskip"])
+
+    if region is not None:
+        if _isValidExtent(region):
+            shape = sizes[:-3] + [region[axis*2+1] - region[axis*2] + 1 for axis in range(3)]
+        else:
+            shape = sizes[:-3] + [0, 0, 0]
+    else:
+        shape = sizes
+    if out is not None:
+        if memory_map:
+            raise ValueError("Output array cannot be specified for memory mapped voxels")
+        if list(out.shape) != shape or out.dtype != dtype:
+            raise ValueError(f"Output array must have shape {tuple(shape)} and dtype {dtype}")
+        if not out.flags["F_CONTIGUOUS"] or not out.flags["WRITEABLE"]:
+            raise ValueError("Output array must be a writable Fortran-contiguous array")
+
+    if region is not None and not _isValidExtent(region):
+        return out if out is not None else np.zeros(shape, dtype=dtype)
+
+    if attached_data and header["encoding"] == "raw":
+        voxels = _memory_map_nrrd_voxels(filename, header, data_offset)
+        if region is not None:
+            voxels = voxels[..., region[0]:region[1]+1, region[2]:region[3]+1, region[4]:region[5]+1]
+        if memory_map:
+            return voxels
+        if out is None:
+            return np.array(voxels, order="F")
+        np.copyto(out, voxels)
+        return out
+
+    if attached_data and header["encoding"] in ["gzip", "gz"] and byte_skip >= 0:
+        # Decompress directly into the voxel array, without keeping the whole compressed or decompressed data in memory
+        first_slice, last_slice = (0, sizes[-1] - 1) if region is None else (region[4], region[5])
+        slice_shape = sizes[:-1] + [last_slice - first_slice + 1]
+        slice_size = int(np.prod(sizes[:-1])) * dtype.itemsize
+        # NRRD stores the fastest varying axis first, therefore the flat buffer is shaped in reverse axis order
+        if region is None and out is not None:
+            buffer = out.T
+        else:
+            buffer = np.empty(slice_shape[::-1], dtype=dtype)
+        with open(filename, "rb") as fh:
+            fh.seek(data_offset)
+            _gunzip_into(fh, buffer, skip_bytes=byte_skip + first_slice * slice_size)
+        voxels = buffer.T
+        if region is None:
+            return out if out is not None else voxels
+        voxels = voxels[..., region[0]:region[1]+1, region[2]:region[3]+1, :]
+    else:
+        # Other encodings and layouts are read entirely using pynrrd
+        with open(filename, "rb") as fh:
+            fh.seek(data_offset)
+            voxels = nrrd.read_data(header, fh, filename)
+        if region is not None:
+            voxels = voxels[..., region[0]:region[1]+1, region[2]:region[3]+1, region[4]:region[5]+1]
+
+    if out is not None:
+        np.copyto(out, voxels)
+        return out
+    if region is not None:
+        voxels = np.array(voxels, order="F")
+    return voxels
+
+
+def _read_nrrd_voxel_slabs(filename, header, data_offset, region=None):
+    """Generator that reads the voxel array of a NRRD file in slabs (groups of slices along the last axis),
+    so that the whole voxel array does not have to be kept in memory.
+    :param filename: NRRD file name
+    :param header: parsed NRRD header
+    :param data_offset: position of the first byte of data in the file
+    :param region: first and last voxel index along each spatial axis (same format as segment extent).
+        If specified then only this region of the voxel array is read.
+    :return: yields (index of first slice of the slab in the region, voxel array of the slab).
+        The slab array is only valid until the next slab is read.
+    """
+    import nrrd
+    import numpy as np
+
+    sizes = [int(size) for size in header["sizes"]]
+    dtype = _nrrd_dtype(header)
+    if region is None:
+        region = [0, sizes[-3]-1, 0, sizes[-2]-1, 0, sizes[-1]-1]
+    if not _isValidExtent(region):
+        return
+    ij_region = (Ellipsis, slice(region[0], region[1]+1), slice(region[2], region[3]+1), slice(None))
+    slice_size = int(np.prod(sizes[:-1]))
+    slices_per_slab = max(_READ_CHUNK_SIZE // max(slice_size * dtype.itemsize, 1), 1)
+    byte_skip = header.get("byte skip", header.get("byteskip", 0))
+    attached_data = not any(key in header for key in ["data file", "datafile", "line skip", "lineskip"])
+
+    if attached_data and header["encoding"] in ["gzip", "gz"] and byte_skip >= 0:
+        # NRRD stores the fastest varying axis first, therefore the flat buffer is shaped in reverse axis order
+        buffer = np.empty([slices_per_slab] + sizes[:-1][::-1], dtype=dtype)
+        with open(filename, "rb") as fh:
+            fh.seek(data_offset)
+            chunks = _gunzip_chunks(fh, skip_bytes=byte_skip + region[4] * slice_size * dtype.itemsize)
+            pending = b""
+            for first_slice in range(region[4], region[5]+1, slices_per_slab):
+                slab_buffer = buffer[:min(slices_per_slab, region[5] + 1 - first_slice)]
+                pending = _read_chunks_into(chunks, slab_buffer, pending)
+                yield first_slice - region[4], slab_buffer.T[ij_region]
+        return
+
+    if attached_data and header["encoding"] == "raw":
+        voxels = _memory_map_nrrd_voxels(filename, header, data_offset)
+    else:
+        # Other encodings and layouts are read entirely using pynrrd
+        with open(filename, "rb") as fh:
+            fh.seek(data_offset)
+            voxels = nrrd.read_data(header, fh, filename)
+    for first_slice in range(region[4], region[5]+1, slices_per_slab):
+        last_slice = min(first_slice + slices_per_slab, region[5] + 1)
+        yield first_slice - region[4], np.asarray(voxels[ij_region[:-1] + (slice(first_slice, last_slice),)])
+
+
+def _read_sparse_segment_masks(slabs, segments, multiple_layers):
+    """Get binary mask of each segment, cropped to the segment's bounding box, from voxel array slabs.
+    :param slabs: iterator of (index of first slice, slab voxel array), as returned by `_read_nrrd_voxel_slabs`
+    :param segments: list of segments
+    :param multiple_layers: True if the voxel array is 4D
+    :return: list of (extent, mask) for each segment
+    """
+    import numpy as np
+
+    # Segment indices for each layer and label value: layer_label_segments[layer][label_value] = [segment_index, ...]
+    layer_label_segments = {}
+    for segment_index, segment in enumerate(segments):
+        layer = segment.get("layer", 0) if multiple_layers else 0
+        layer_label_segments.setdefault(layer, {}).setdefault(segment["labelValue"], []).append(segment_index)
+
+    # Parts of the segment masks, in each slab: (offset, mask)
+    segment_mask_parts = [[] for segment in segments]
+    for first_slice, slab in slabs:
+        for layer, label_segments in layer_label_segments.items():
+            layer_slab = slab[layer] if multiple_layers else slab
+            label_values = sorted(label_segments)
+            for label_value, axis_counts in zip(label_values, _label_axis_histograms(layer_slab, label_values)):
+                if not axis_counts[0].any():
+                    continue
+                # Only compare voxels within the bounding box of the label in this slab
+                bounds = [(np.flatnonzero(counts)[0], np.flatnonzero(counts)[-1] + 1) for counts in axis_counts]
+                mask = layer_slab[tuple(slice(start, stop) for start, stop in bounds)] == label_value
+                offset = (bounds[0][0], bounds[1][0], bounds[2][0] + first_slice)
+                for segment_index in label_segments[label_value]:
+                    segment_mask_parts[segment_index].append((offset, mask))
+
+    # Assemble the parts
+    segment_masks = []
+    for mask_parts in segment_mask_parts:
+        if not mask_parts:
+            segment_masks.append(([0, -1, 0, -1, 0, -1], _empty_mask()))
+            continue
+        extent = []
+        for axis in range(3):
+            extent += [int(min(offset[axis] for offset, mask in mask_parts)),
+                int(max(offset[axis] + mask.shape[axis] for offset, mask in mask_parts)) - 1]
+        segment_mask = np.zeros([extent[axis*2+1] - extent[axis*2] + 1 for axis in range(3)], dtype=bool, order="F")
+        for offset, mask in mask_parts:
+            start = [offset[axis] - extent[axis*2] for axis in range(3)]
+            segment_mask[tuple(slice(start[axis], start[axis] + mask.shape[axis]) for axis in range(3))] = mask
+        mask_parts.clear()
+        segment_masks.append((extent, segment_mask))
+    return segment_masks
+
+
+def _memory_map_nrrd_voxels(filename, header, data_offset):
+    """Map the voxel array of a raw encoded NRRD file with attached header to the file content
+    without loading the voxels into memory.
+    """
+    import numpy as np
+    import os
+
+    dtype = _nrrd_dtype(header)
+    shape = tuple(int(size) for size in header["sizes"])
+    byte_skip = header.get("byte skip", header.get("byteskip", 0))
+    if byte_skip == -1:
+        # Data is at the end of the file
+        data_offset = os.path.getsize(filename) - dtype.itemsize * int(np.prod(shape))
+    else:
+        data_offset += byte_skip
+
+    # NRRD stores the fastest varying axis first, which corresponds to Fortran order
+    return np.memmap(filename, dtype=dtype, mode="c", offset=data_offset, shape=shape, order="F")
+
+
+# Maximum number of bytes that is read from file or decompressed at once
+_READ_CHUNK_SIZE = 2**22
+
+
+def _gunzip_into(fh, buffer, skip_bytes=0):
+    """Decompress gzip data from a file directly into a buffer.
+    Decompression stops as soon as the buffer is filled, the rest of the file is not read.
+    Multi-member gzip streams are supported.
+    :param fh: file object positioned at the start of the gzip data
+    :param buffer: C-contiguous writable array that receives the decompressed data
+    :param skip_bytes: number of decompressed bytes to discard before filling the buffer
+    """
+    _read_chunks_into(_gunzip_chunks(fh, skip_bytes), buffer)
+
+
+def _gunzip_chunks(fh, skip_bytes=0):
+    """Generator that decompresses gzip data from a file in chunks of at most _READ_CHUNK_SIZE bytes.
+    Multi-member gzip streams are supported.
+    :param fh: file object positioned at the start of the gzip data
+    :param skip_bytes: number of decompressed bytes to discard before the first chunk
+    """
+    import zlib
+
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    compressed = b""
+    while True:
+        if not compressed:
+            compressed = fh.read(_READ_CHUNK_SIZE)
+            if not compressed:
+                return
+        if skip_bytes > 0:
+            data = decompressor.decompress(compressed, min(skip_bytes, _READ_CHUNK_SIZE))
+            skip_bytes -= len(data)
+        else:
+            data = decompressor.decompress(compressed, _READ_CHUNK_SIZE)
+            if data:
+                yield data
+        compressed = decompressor.unconsumed_tail
+        if decompressor.eof:
+            # Continue with the next member of the gzip stream
+            compressed = decompressor.unused_data
+            decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+
+
+def _read_chunks_into(chunks, buffer, pending=b""):
+    """Fill a buffer with data from an iterator of byte chunks.
+    :param chunks: iterator of bytes objects
+    :param buffer: C-contiguous writable array that receives the data
+    :param pending: data that was left over from the previous call, it is used before reading new chunks
+    :return: part of the last chunk that did not fit into the buffer
+    """
+    output = memoryview(buffer).cast("B")
+    filled = 0
+    pending = memoryview(pending)
+    while filled < len(output):
+        if not len(pending):
+            pending = memoryview(next(chunks, b""))
+            if not len(pending):
+                raise IOError("Unexpected end of compressed voxel data")
+        size = min(len(pending), len(output) - filled)
+        output[filled:filled + size] = pending[:size]
+        filled += size
+        pending = pending[size:]
+    return pending
+
+
+def write_segmentation(file, segmentation, compression_level=9, index_order=None, compression_threads=1, compute_extent=False):
+    """
+    Writes segmentation metadata and voxels to a .seg.nrrd file.
+    :param file: output file name or file object. If the file name ends with .nii or .nii.gz then the segmentation
+        is written to a NIFTI file using `write_segmentation_nifti`. If the file name ends with .zarr or .zarr.zip then
+        the segmentation is written to a chunked Zarr store using `slicerio.segmentation_zarr.write_segmentation_zarr`.
+    :param segmentation: segmentation metadata and voxels. Segmentation in sparse representation
+        is converted to a voxel array (see `dense_segmentation`) before writing.
+    :param compression_level: gzip compression level (1 = fastest, 9 = smallest file)
+    :param index_order: index order of the voxel array, 'F' (default) or 'C'. NIFTI files only support 'F'.
+    :param compression_threads: number of threads used for gzip compression. The voxel buffer is split into chunks
+        that are compressed in parallel and written as a single standard gzip stream.
+        If None then the number of CPUs is used. If 1 (default) then data is compressed by pynrrd in the calling thread.
+    :param compute_extent: if True then the extent of each segment is computed from the voxels (tight bounding box
+        of the segment's voxels) and written instead of the extent specified in the segment metadata.
+        This allows applications to load only the relevant region of small segments.
+        The input segmentation is not modified.
+    """
+    import numpy as np
+    import os
+
+    if isinstance(file, (str, os.PathLike)) and os.fspath(file).endswith((".nii", ".nii.gz")):
+        if index_order not in [None, 'F']:
+            raise ValueError(f"Index order {index_order} is not supported for NIFTI files (voxels are always stored in 'F' order)")
+        if compute_extent:
+            segmentation = _segmentation_with_computed_extents(segmentation)
+        write_segmentation_nifti(file, segmentation, compression_level=compression_level, compression_threads=compression_threads)
+        return
+    if isinstance(file, (str, os.PathLike)) and os.fspath(file).endswith((".zarr", ".zarr.zip")):
+        from .segmentation_zarr import write_segmentation_zarr
+        if compute_extent:
+            segmentation = _segmentation_with_computed_extents(segmentation)
+        write_segmentation_zarr(file, segmentation, compression_level=compression_level, threads=compression_threads)
+        return
+
+    if _is_sparse(segmentation):
+        segmentation = dense_segmentation(segmentation)
     voxels = segmentation["voxels"]
     if voxels is None:
         raise ValueError("Segmentation does not contain voxels")
 
+    segment_extents = None
+    if compute_extent:
+        # Extents of all segments are computed in a single pass over each layer
+        statistics = segment_statistics(segmentation)
+        segment_extents = [segment_stats["extent"] for segment_stats in statistics]
+
     # Copy non-segmentation fields to the extracted header
     output_header = {}
 
@@ -500,8 +1314,7 @@ def write_segmentation(file, segmentation, compression_level=9, index_order=None
         #   [ 0.        ,  1.        ,  0.        ],
         #   [ 0.        ,  0.        , -1.        ],
         #   [-1.29999542,  0.        ,  0.        ]]))
-        nan_column = np.array()
-        space_directions = np.row_stack(([np.nan, np.nan, np.nan], space_directions))
+        space_directions = np.vstack(([np.nan, np.nan, np.nan], space_directions))
     elif dims != 3:
         raise ValueError("Unsupported number of dimensions: " + str(dims))
 
@@ -600,7 +1413,10 @@ def write_segmentation(file, segmentation, compression_level=9, index_order=None
             # If user has not specified layer, set it to 0
             output_header[f"Segment{output_segment_index}_Layer"] = "0"
 
-        if "extent" not in segment:
+        if segment_extents is not None:
+            # Tight extent computed from the voxels
+            output_header[f"Segment{output_segment_index}_Extent"] = ' '.join([str(i) for i in segment_extents[output_segment_index]])
+        elif "extent" not in segment:
             # If user has not specified extent, set it to the full extent
             output_shape = voxels.shape[-3:]
             output_header[f"Segment{output_segment_index}_Extent"] = f"0 {output_shape[0]-1} 0 {output_shape[1]-1} 0 {output_shape[2]-1}"
@@ -612,16 +1428,379 @@ def write_segmentation(file, segmentation, compression_level=9, index_order=None
     # Write segmentation to file
     if index_order is None:
         index_order = 'F'
+    if compression_threads is None:
+        compression_threads = os.cpu_count() or 1
+    if compression_threads > 1 and output_header["encoding"] in ["gzip", "gz"]:
+        _write_nrrd_gzip_parallel(file, voxels, output_header, compression_level, index_order, compression_threads)
+        return
     import nrrd
     nrrd.write(file, voxels, output_header, compression_level=compression_level, index_order=index_order)
 
 
+def _segmentation_with_computed_extents(segmentation):
+    """Get a shallow copy of the segmentation, with extent of each segment set to the tight bounding box of its voxels."""
+    statistics = segment_statistics(segmentation)
+    segments = [dict(segment, extent=segment_stats["extent"]) for segment, segment_stats in zip(segmentation["segments"], statistics)]
+    return dict(segmentation, segments=segments)
+
+
+def write_segmentation_nifti(filename, segmentation, merge_layers=False, compression_level=9, compression_threads=None, write_sidecar=True):
+    """Write segmentation to a NIFTI label image file (.nii or .nii.gz) and segment metadata to a JSON sidecar file.
+
+    Voxels are converted to the smallest integer type that can store all label values and are compressed
+    slab by slab while writing, therefore a converted copy of the whole voxel array is never created.
+    The file can be read by `read_segmentation`, nibabel, ITK, 3D Slicer, etc.
+
+    :param filename: output file name, ending with .nii or .nii.gz (compressed)
+    :param segmentation: segmentation metadata and voxels (or segmentation in sparse representation)
+    :param merge_layers: if False then a segmentation that contains multiple layers is written as a 4D image
+        (the 4th axis is the layer). If True then all layers are merged into a 3D image: segments that are listed
+        later overwrite the earlier ones, and segments get new label values if label values are not unique.
+    :param compression_level: gzip compression level (1 = fastest, 9 = smallest file)
+    :param compression_threads: number of threads used for gzip compression. If None then the number of CPUs is used.
+    :param write_sidecar: write segment metadata (in the same format as "segments" in the segmentation)
+        into a JSON file next to the image file (`path/to/Segmentation.json` for `path/to/Segmentation.nii.gz`).
+        `read_segmentation` reads segment metadata from this file.
+    """
+    import json
+    import numpy as np
+    import os
+
+    filename = os.fspath(filename)
+    if filename.endswith(".nii.gz"):
+        compressed = True
+    elif filename.endswith(".nii"):
+        compressed = False
+    else:
+        raise ValueError("NIFTI file name must end with .nii or .nii.gz")
+
+    if _is_sparse(segmentation):
+        segmentation = dense_segmentation(segmentation)
+    voxels = segmentation["voxels"]
+    if voxels is None:
+        raise ValueError("Segmentation does not contain voxels")
+    dims = len(voxels.shape)
+    if dims not in [3, 4]:
+        raise ValueError("Unsupported number of dimensions: " + str(dims))
+    if dims == 4 and merge_layers:
+        segmentation = _merge_layers(segmentation)
+        voxels = segmentation["voxels"]
+        dims = 3
+
+    dtype = _minimal_label_dtype([int(voxels.min()), int(voxels.max())] if voxels.size else [])
+    # NIFTI affine is IJK to RAS
+    ijkToRAS = np.diag([-1, -1, 1, 1]).dot(np.array(segmentation["ijkToLPS"], dtype=float))
+    layers = [voxels] if dims == 3 else [voxels[layer] for layer in range(voxels.shape[0])]
+    image_shape = list(voxels.shape[-3:]) + ([len(layers)] if dims == 4 else [])
+    header = _nifti1_header(image_shape, dtype, ijkToRAS)
+
+    def data_chunks():
+        # NIFTI stores the first axis fastest varying, the 4th axis (layer) slowest varying
+        yield header
+        slice_size = int(np.prod(voxels.shape[-3:-1])) * dtype.itemsize
+        slices_per_chunk = max(_COMPRESSION_CHUNK_SIZE // max(slice_size, 1), 1)
+        for layer_voxels in layers:
+            for first_slice in range(0, layer_voxels.shape[2], slices_per_chunk):
+                chunk = np.asarray(layer_voxels[:, :, first_slice:first_slice + slices_per_chunk], dtype=dtype, order="F")
+                yield memoryview(chunk.T).cast("B")
+
+    with open(filename, "wb") as fh:
+        if compressed:
+            if compression_threads is None:
+                compression_threads = os.cpu_count() or 1
+            _write_gzip_chunks(fh, data_chunks(), compression_level, compression_threads)
+        else:
+            for chunk in data_chunks():
+                fh.write(chunk)
+
+    if write_sidecar:
+        segments = []
+        for segment in segmentation["segments"]:
+            segment = {key: segment[key] for key in segment if key != "mask"}
+            if dims == 3:
+                segment["layer"] = 0
+            segments.append(segment)
+        sidecar_filename = filename[:-len(".nii.gz")] if compressed else filename[:-len(".nii")]
+        with open(sidecar_filename + ".json", "w") as f:
+            json.dump({"segments": segments}, f, indent=2, default=lambda value: value.tolist())
+
+
+def _merge_layers(segmentation):
+    """Merge all layers of a segmentation into a single layer. Segments listed later overwrite the earlier ones.
+    Segments get new label values (1, 2, ...) if the label values are not unique.
+    """
+    merged_segmentation = sparse_segmentation(segmentation)
+    segments = merged_segmentation["segments"]
+    unique_label_values = len(set(segment["labelValue"] for segment in segments)) == len(segments)
+    for segment_index, segment in enumerate(segments):
+        segment["layer"] = 0
+        if not unique_label_values:
+            segment["labelValue"] = segment_index + 1
+    return dense_segmentation(merged_segmentation)
+
+
+# NIFTI data type codes of numpy types
+_NIFTI_TYPES = {"u1": 2, "i2": 4, "i4": 8, "f4": 16, "f8": 64, "i1": 256, "u2": 512, "u4": 768, "i8": 1024, "u8": 1280}
+
+
+def _nifti1_header(shape, dtype, ijkToRAS):
+    """Create NIFTI-1 single file (.nii) header, including the (empty) extension flag.
+    :param shape: image size along each axis (3 or 4 values)
+    :param dtype: voxel type
+    :param ijkToRAS: voxel to physical (RAS) transformation matrix
+    :return: 352 bytes
+    """
+    import numpy as np
+    import struct
+
+    dtype = np.dtype(dtype)
+    directions = ijkToRAS[0:3, 0:3]
+    spacing = np.linalg.norm(directions, axis=0)
+
+    # Quaternion representation of the axis directions (qform), only possible for orthogonal axes
+    qform_code = 0
+    quaternion = [0.0, 0.0, 0.0]
+    qfac = 1.0
+    if np.all(spacing > 0):
+        rotation = directions / spacing
+        if np.allclose(rotation.T.dot(rotation), np.eye(3), atol=1e-4):
+            qform_code = 1
+            if np.linalg.det(rotation) < 0:
+                qfac = -1.0
+                rotation[:, 2] = -rotation[:, 2]
+            quaternion = _rotation_to_quaternion(rotation)
+
+    dim = [len(shape)] + list(shape) + [1] * (7 - len(shape))
+    pixdim = [qfac] + list(spacing) + [1.0] * 4
+    return struct.pack("<i10s18sihcB8h3f4h8f3fhBB4f2i80s24s2h6f12f16s4s",
+        348, b"", b"", 0, 0, b"r", 0,
+        *dim,
+        0.0, 0.0, 0.0,
+        0, _NIFTI_TYPES[dtype.str[1:]], dtype.itemsize * 8, 0,
+        *pixdim,
+        352.0, 1.0, 0.0,  # vox_offset, scl_slope, scl_inter
+        0, 0, 2,  # slice_end, slice_code, xyzt_units (millimeter)
+        0.0, 0.0, 0.0, 0.0,  # cal_max, cal_min, slice_duration, toffset
+        0, 0,
+        b"slicerio segmentation", b"",
+        qform_code, 1,  # sform code: scanner coordinates
+        *quaternion, *ijkToRAS[0:3, 3],
+        *ijkToRAS[0, 0:4], *ijkToRAS[1, 0:4], *ijkToRAS[2, 0:4],
+        b"", b"n+1\x00") + b"\x00\x00\x00\x00"
+
+
+def _rotation_to_quaternion(rotation):
+    """Get quaternion (b, c, d components, with non-negative a) from a 3x3 rotation matrix (as in nifti1_io.c)."""
+    import math
+
+    r = rotation
+    a = r[0, 0] + r[1, 1] + r[2, 2] + 1.0
+    if a > 0.5:
+        a = 0.5 * math.sqrt(a)
+        b = 0.25 * (r[2, 1] - r[1, 2]) / a
+        c = 0.25 * (r[0, 2] - r[2, 0]) / a
+        d = 0.25 * (r[1, 0] - r[0, 1]) / a
+    else:
+        xd = 1.0 + r[0, 0] - (r[1, 1] + r[2, 2])
+        yd = 1.0 + r[1, 1] - (r[0, 0] + r[2, 2])
+        zd = 1.0 + r[2, 2] - (r[0, 0] + r[1, 1])
+        if xd > 1.0:
+            b = 0.5 * math.sqrt(xd)
+            c = 0.25 * (r[0, 1] + r[1, 0]) / b
+            d = 0.25 * (r[0, 2] + r[2, 0]) / b
+            a = 0.25 * (r[2, 1] - r[1, 2]) / b
+        elif yd > 1.0:
+            c = 0.5 * math.sqrt(yd)
+            b = 0.25 * (r[0, 1] + r[1, 0]) / c
+            d = 0.25 * (r[1, 2] + r[2, 1]) / c
+            a = 0.25 * (r[0, 2] - r[2, 0]) / c
+        else:
+            d = 0.5 * math.sqrt(zd)
+            b = 0.25 * (r[0, 2] + r[2, 0]) / d
+            c = 0.25 * (r[1, 2] + r[2, 1]) / d
+            a = 0.25 * (r[1, 0] - r[0, 1]) / d
+        if a < 0.0:
+            b, c, d = -b, -c, -d
+    return [b, c, d]
+
+
+# Size of voxel data chunks that are compressed independently when writing with multiple threads
+_COMPRESSION_CHUNK_SIZE = 2**22
+
+# Size of the deflate window, the last bytes of each chunk are used as dictionary for compressing the next chunk
+_DEFLATE_WINDOW_SIZE = 2**15
+
+
+def _write_nrrd_gzip_parallel(file, voxels, header, compression_level, index_order, threads):
+    """Write NRRD file with gzip encoding, compressing chunks of the voxel array in parallel (see `_write_gzip_chunks`)."""
+    import numpy as np
+
+    header_bytes = _nrrd_header_bytes(voxels, header, index_order)
+
+    # Get the voxel buffer in file order without copying if possible
+    if index_order == 'F':
+        data = np.asfortranarray(voxels).T
+    else:
+        data = np.ascontiguousarray(voxels)
+    data = memoryview(data).cast("B")
+    chunks = (data[start:start + _COMPRESSION_CHUNK_SIZE] for start in range(0, len(data), _COMPRESSION_CHUNK_SIZE))
+
+    def write(fh):
+        fh.write(header_bytes)
+        _write_gzip_chunks(fh, chunks, compression_level, threads)
+
+    if isinstance(file, (str, bytes)) or hasattr(file, "__fspath__"):
+        with open(file, "wb") as fh:
+            write(fh)
+    else:
+        write(file)
+
+
+def _nrrd_header_bytes(voxels, header, index_order):
+    """Create the NRRD header for writing the voxel array (with the encoding specified in the header).
+
+    Type, dimension, sizes, and endianness are set from the voxel array. Standard NRRD fields are formatted using
+    the public formatting functions of pynrrd and written in the same order as pynrrd writes them,
+    all other fields are written as custom fields (key:=value).
+
+    :param voxels: voxel array
+    :param header: header fields (as assembled by `write_segmentation`)
+    :param index_order: index order of the voxel array, 'F' or 'C'
+    :return: header as bytes, including the closing empty line
+    """
+    import nrrd
+
+    nrrd_types = {"i1": "int8", "u1": "uint8", "i2": "int16", "u2": "uint16", "i4": "int32", "u4": "uint32",
+        "i8": "int64", "u8": "uint64", "f4": "float", "f8": "double"}
+    if voxels.dtype.str[1:] not in nrrd_types:
+        raise ValueError(f"Unsupported voxel type: {voxels.dtype}")
+
+    def format_quoted_string_list(values):
+        return " ".join(f'"{value}"' for value in values)
+
+    def format_string_list(values):
+        return " ".join(values)
+
+    standard_field_formatters = [
+        ("type", str),
+        ("dimension", nrrd.format_number),
+        ("space", str),
+        ("sizes", nrrd.format_number_list),
+        ("space directions", nrrd.format_optional_matrix),
+        ("kinds", format_string_list),
+        ("endian", str),
+        ("encoding", str),
+        ("min", nrrd.format_number),
+        ("max", nrrd.format_number),
+        ("oldmin", nrrd.format_number),
+        ("old min", nrrd.format_number),
+        ("oldmax", nrrd.format_number),
+        ("old max", nrrd.format_number),
+        ("content", str),
+        ("sample units", str),
+        ("spacings", nrrd.format_number_list),
+        ("thicknesses", nrrd.format_number_list),
+        ("axis mins", nrrd.format_number_list),
+        ("axismins", nrrd.format_number_list),
+        ("axis maxs", nrrd.format_number_list),
+        ("axismaxs", nrrd.format_number_list),
+        ("centerings", format_string_list),
+        ("labels", format_quoted_string_list),
+        ("units", format_quoted_string_list),
+        ("space units", format_quoted_string_list),
+        ("space origin", nrrd.format_optional_vector),
+        ("measurement frame", nrrd.format_optional_matrix),
+        ]
+    # These fields describe the layout of data in another file or the coordinate system that is already
+    # specified by the space field, they are not valid for the written file
+    ignored_fields = ["space dimension", "data file", "datafile", "lineskip", "line skip", "byteskip", "byte skip"]
+
+    header = dict(header)
+    header["type"] = nrrd_types[voxels.dtype.str[1:]]
+    header["dimension"] = voxels.ndim
+    header["sizes"] = list(voxels.shape) if index_order == 'F' else list(voxels.shape[::-1])
+    if voxels.dtype.itemsize > 1:
+        header["endian"] = "little" if voxels.dtype.str[0] == "<" else "big"
+    else:
+        header.pop("endian", None)
+
+    lines = ["NRRD0004", "# Complete NRRD file format specification at:", "# http://teem.sourceforge.net/nrrd/format.html"]
+    for field, format_value in standard_field_formatters:
+        if field in header:
+            lines.append(f"{field}: {format_value(header[field])}")
+    standard_fields = set(field for field, _ in standard_field_formatters)
+    for field, value in header.items():
+        if field not in standard_fields and field not in ignored_fields:
+            lines.append(f"{field}:={value}")
+    return ("\n".join(lines) + "\n\n").encode("ascii")
+
+
+def _write_gzip_chunks(fh, chunks, compression_level, threads):
+    """Compress data chunks and write them to a file as a single gzip member.
+
+    Similarly to pigz, if multiple threads are used then each chunk is compressed into a raw deflate stream
+    (primed with the end of the previous chunk) in parallel, so that the concatenated chunks form a single gzip member
+    that any gzip reader (pynrrd, nibabel, Slicer) can decompress. Only a limited number of chunks are kept in memory
+    at the same time, therefore the chunks can be generated while the data is written.
+
+    :param fh: file object to write to
+    :param chunks: iterable of bytes-like objects
+    :param compression_level: gzip compression level
+    :param threads: number of compression threads
+    """
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+    import struct
+    import zlib
+
+    # gzip member header: magic, deflate method, no flags, no modification time, extra flags, unknown OS
+    extra_flags = 2 if compression_level == 9 else (4 if compression_level == 1 else 0)
+    fh.write(b"\x1f\x8b\x08\x00\x00\x00\x00\x00" + bytes([extra_flags]) + b"\xff")
+    crc = 0
+    size = 0
+
+    if threads <= 1:
+        compressor = zlib.compressobj(compression_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        for chunk in chunks:
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            fh.write(compressor.compress(chunk))
+        fh.write(compressor.flush(zlib.Z_FINISH))
+        fh.write(struct.pack("<II", crc, size & 0xffffffff))
+        return
+
+    def compress_chunk(chunk, dictionary, last):
+        if dictionary is not None:
+            compressor = zlib.compressobj(compression_level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary)
+        else:
+            compressor = zlib.compressobj(compression_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        # Non-final chunks end at a byte boundary without marking the end of the deflate stream
+        return compressor.compress(chunk) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = deque()
+        dictionary = None
+        chunk = None
+        for next_chunk in chunks:
+            if chunk is not None:
+                pending.append(executor.submit(compress_chunk, chunk, dictionary, False))
+                dictionary = bytes(chunk[-_DEFLATE_WINDOW_SIZE:])
+                while len(pending) > 2 * threads:
+                    fh.write(pending.popleft().result())
+            chunk = next_chunk
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+        pending.append(executor.submit(compress_chunk, chunk if chunk is not None else b"", dictionary, True))
+        while pending:
+            fh.write(pending.popleft().result())
+    fh.write(struct.pack("<II", crc, size & 0xffffffff))
+
+
 def segment_from_name(segmentation, segment_name):
-    segments = segmentation["segments"]
-    for segment in segments:
-        if segment_name == segment["name"]:
-            return segment
-    raise KeyError("segment not found by name " + segment_name)
+    segments = segments_from_name(segmentation, segment_name)
+    if not segments:
+        raise KeyError("segment not found by name " + segment_name)
+    return segments[0]
 
 
 def segments_from_name(segmentation, segment_name):
@@ -634,6 +1813,8 @@ def segments_from_name(segmentation, segment_name):
 
 
 def segments_from_terminology(segmentation, terminology):
+    if isinstance(terminology, TerminologyMatcher):
+        return terminology.filter_segments(segmentation["segments"])
     found_segments = []
     segments = segmentation["segments"]
     for segment in segments:
@@ -642,6 +1823,151 @@ def segments_from_terminology(segmentation, terminology):
                 found_segments.append(segment)
     return found_segments
 
+
+class SegmentIndex:
+    """Index of segments of a segmentation, for finding segments by name, ID, or terminology in constant time.
+
+    Segments are indexed by name, by ID, and by terminology (coding scheme designator and code value of category,
+    type, type modifier, anatomic region, and anatomic region modifier). Creating an index is useful if many
+    segments are looked up in the same segmentation. The index is not updated when the segments are modified.
+
+    :param segmentation: segmentation (only "segments" is used)
+    """
+
+    def __init__(self, segmentation):
+        self.segments = segmentation["segments"]
+        # Position of segments in the segment list, by name, ID, and terminology key
+        self._positions_by_name = {}
+        self._position_by_id = {}
+        self._positions_by_terminology = {}
+        for position, segment in enumerate(self.segments):
+            self._positions_by_name.setdefault(segment["name"], []).append(position)
+            if "id" in segment:
+                self._position_by_id.setdefault(segment["id"], position)
+            if "terminology" in segment:
+                self._positions_by_terminology.setdefault(_terminology_key(segment["terminology"]), []).append(position)
+
+    def segments_from_name(self, segment_name):
+        """Get list of segments that have the specified name."""
+        return [self.segments[position] for position in self._positions_by_name.get(segment_name, [])]
+
+    def segment_from_id(self, segment_id):
+        """Get segment by ID. Raises KeyError if not found."""
+        if segment_id not in self._position_by_id:
+            raise KeyError("segment not found by ID " + segment_id)
+        return self.segments[self._position_by_id[segment_id]]
+
+    def segments_from_terminology(self, terminology):
+        """Get list of segments that have matching terminology (see `terminology_entry_matches`).
+        :param terminology: terminology dict or `TerminologyMatcher`
+        """
+        if isinstance(terminology, TerminologyMatcher):
+            # Each distinct terminology of the segments is checked once
+            positions = [position for key, key_positions in self._positions_by_terminology.items()
+                if terminology._matches_key(key) for position in key_positions]
+            return [self.segments[position] for position in sorted(positions)]
+        return [self.segments[position] for position in self._positions_by_terminology.get(_terminology_key(terminology), [])]
+
+    def segments_from_name_or_terminology(self, segment_name_or_terminology):
+        """Get list of segments by name (if a string is specified) or by terminology (if a dict or `TerminologyMatcher` is specified)."""
+        if type(segment_name_or_terminology) is str:
+            return self.segments_from_name(segment_name_or_terminology)
+        return self.segments_from_terminology(segment_name_or_terminology)
+
+
+def _terminology_key(terminology):
+    """Get hashable key of terminology entry. Two terminology entries have the same key if `terminology_entry_matches` is True for them.
+    Codes are represented by coding scheme designator and code value (code meaning is ignored).
+    """
+    def code(name):
+        return (terminology[name][0], terminology[name][1]) if name in terminology else None
+    anatomic_region = code("anatomicRegion")
+    # Anatomic region modifier is only taken into account if anatomic region is specified
+    anatomic_region_modifier = code("anatomicRegionModifier") if anatomic_region is not None else None
+    return ((terminology["category"][0], terminology["category"][1]), (terminology["type"][0], terminology["type"][1]),
+        code("typeModifier"), anatomic_region, anatomic_region_modifier)
+
+
+_TERMINOLOGY_FIELDS = ["category", "type", "typeModifier", "anatomicRegion", "anatomicRegionModifier"]
+
+
+class TerminologyMatcher:
+    """Compiled terminology query, for finding segments with matching terminology in many segment lists quickly.
+
+    Each query is a terminology dict (in the same format as "terminology" in segments). A field value of "*"
+    (instead of a code) is a wildcard, which matches any code and also matches if the field is not specified.
+    Fields that are not wildcards are matched the same way as in `terminology_entry_matches`. For example, kidney
+    with any laterality::
+
+        matcher = TerminologyMatcher({"category": ["SCT", "123037004", "Anatomical Structure"],
+            "type": ["SCT", "64033007", "Kidney"], "typeModifier": "*"})
+
+    Queries are compiled into sets of terminology keys (one set for each combination of wildcard fields),
+    therefore checking a terminology takes a few set lookups, regardless of the number of queries.
+    A matcher can be used instead of a terminology dict in `SegmentIndex.segments_from_terminology`,
+    `segments_from_terminology`, `extract_segments`, `read_segmentation` (`crop_to_segments`),
+    and `slicerio.segmentation_index.find_segments`.
+
+    :param terminologies: terminology dict or list of terminology dicts. A terminology matches if it matches any of them.
+    """
+
+    def __init__(self, terminologies):
+        import operator
+        if isinstance(terminologies, dict):
+            terminologies = [terminologies]
+        # Projected terminology keys, by positions of the non-wildcard fields in the key
+        keys_by_positions = {}
+        for terminology in terminologies:
+            if terminology.get("anatomicRegion") == "*" and "anatomicRegionModifier" not in terminology:
+                # Any anatomic region implies any anatomic region modifier
+                terminology = dict(terminology, anatomicRegionModifier="*")
+            positions = tuple(position for position, field in enumerate(_TERMINOLOGY_FIELDS) if terminology.get(field) != "*")
+            key = [(terminology[field][0], terminology[field][1]) if terminology.get(field, "*") != "*" else None
+                for field in _TERMINOLOGY_FIELDS]
+            if "anatomicRegion" not in terminology:
+                # Anatomic region modifier is only taken into account if anatomic region is specified (same as in `_terminology_key`)
+                key[4] = None
+            keys_by_positions.setdefault(positions, set()).add(tuple(key[position] for position in positions))
+        self._projected_keys = []
+        for positions, keys in keys_by_positions.items():
+            # operator.itemgetter returns a single value (not a tuple) if a single position is specified
+            project = operator.itemgetter(*positions) if len(positions) > 1 else (lambda key, positions=positions: tuple(key[position] for position in positions))
+            self._projected_keys.append((project, keys))
+        # Category and type codes (coding scheme designator, code value) that all matching terminologies have,
+        # None if there is a query with wildcard category or type.
+        self.category_and_type_codes = None
+        if all(positions[:2] == (0, 1) for positions in keys_by_positions):
+            self.category_and_type_codes = {key[:2] for keys in keys_by_positions.values() for key in keys}
+        self._type_code_values = {code[1][1] for code in self.category_and_type_codes} if self.category_and_type_codes is not None else None
+
+    def matches(self, terminology):
+        """Check if a terminology dict matches the query."""
+        return self._matches_key(_terminology_key(terminology))
+
+    def _matches_key(self, terminology_key):
+        return any(project(terminology_key) in keys for project, keys in self._projected_keys)
+
+    def filter_segments(self, segments):
+        """Get list of segments that have terminology matching the query.
+        Each distinct terminology is only checked once, regardless of how many segments have it.
+        """
+        matching_keys = {}
+        found_segments = []
+        for segment in segments:
+            if "terminology" not in segment:
+                continue
+            terminology = segment["terminology"]
+            if self._type_code_values is not None and terminology["type"][1] not in self._type_code_values:
+                # Quick rejection by type code value, without computing the terminology key
+                continue
+            key = _terminology_key(terminology)
+            if key not in matching_keys:
+                matching_keys[key] = self._matches_key(key)
+            if matching_keys[key]:
+                found_segments.append(segment)
+        return found_segments
+
+
 def terminology_code_matches(code1, code2):
     # Coding scheme designator
     if code1[0] != code2[0]:
@@ -674,7 +2000,7 @@ def terminology_entry_matches(terminology1, terminology2):
         # Optional anatomic region modifier
         if "anatomicRegionModifier" in terminology1 and "anatomicRegionModifier" in terminology2:
             # Both have anatomic region modifier
-            if not terminology_code_matches(terminology1["anatomicRegionModifier"][0], terminology2["anatomicRegionModifier"][0]):
+            if not terminology_code_matches(terminology1["anatomicRegionModifier"], terminology2["anatomicRegionModifier"]):
                 return False
         elif "anatomicRegionModifier" in terminology1 or "anatomicRegionModifier" in terminology2:
             # Only one of the two has anatomic region modifier
@@ -687,11 +2013,7 @@ def terminology_entry_matches(terminology1, terminology2):
 
 
 def segment_id_from_name(segmentation, segment_name):
-    segments = segmentation["segments"]
-    for segment in segments:
-        if segment_name == segments["name"]:
-            return segments["id"]
-    raise KeyError("Segment not found by name " + segment_name)
+    return segment_from_name(segmentation, segment_name)["id"]
 
 
 def segment_names(segmentation):
@@ -706,30 +2028,39 @@ def extract_segments(segmentation, segment_names_to_label_values, minimalExtent=
     """
     Extracts segments from a segmentation volume and header.
     Segmentation is collapsed into a 3D volume, if there were overlapping segments then the ones listed later in the segment_names_to_label_values list will overwrite the earlier ones.
+    Voxels of each input layer are relabeled in a single lookup table pass, regardless of the number of extracted segments.
+    Voxel type of the output is the smallest integer type that can store all the output label values.
     :param voxels: 3D or 4D array of voxel values
     :param header: dictionary of NRRD header fields
     :param segmentation_metadata: dictionary of segmentation metadata
-    :param segment_names_to_label_values: list of segment name to label value pairs
+    :param segment_names_to_label_values: list of segment name to label value pairs. Instead of a segment name,
+        a terminology dict or `TerminologyMatcher` can be specified.
     :param minimalExtent: if True then only the minimal extent of the segment is stored. False is recommended for compatibility with older Slicer versions.
     :return: 3D array of extracted voxels, dictionary of extracted header fields
+
+    If the segmentation is in sparse representation (see `sparse_segmentation`) then the extracted segmentation
+    is in sparse representation, too, with all segments in layer 0. Voxels of segments that are overwritten
+    by segments listed later are removed from the masks, so that the masks do not overlap.
     """
 
     from collections import OrderedDict
     import copy
     import numpy as np
 
+    if _is_sparse(segmentation):
+        return _extract_sparse_segments(segmentation, segment_names_to_label_values)
+
     voxels = segmentation["voxels"]
     if voxels is None:
         raise ValueError("Segmentation does not contain voxels")
 
-    # Create empty array from last 3 dimensions (output will be flattened to a 3D array)
+    # Output will be flattened to a 3D array (last 3 dimensions of the input)
     output_shape = voxels.shape[-3:]
-    output_voxels = np.zeros(output_shape, dtype=voxels.dtype)
 
     # Crete independent copy of the input image and segmentation
     output_segmentation = OrderedDict()
 
-    output_segmentation["voxels"] = output_voxels
+    output_segmentation["voxels"] = None  # voxels are set after the segments are processed
     
     for key in segmentation:
         if key == "voxels":
@@ -742,17 +2073,18 @@ def extract_segments(segmentation, segment_names_to_label_values, minimalExtent=
     output_segments = []
     output_segmentation["segments"] = output_segments
 
-    # Copy extracted segments
+    # Collect the label remapping of each input layer.
+    # Each layer's map contains input label value -> (priority, output label value). Priority is the index
+    # of the mapping entry (+1), which is used for letting later entries overwrite earlier ones.
     dims = len(voxels.shape)
+    if dims not in [3, 4]:
+        raise ValueError("Voxel array dimension is invalid")
+    layer_label_maps = {}
+    segment_index = SegmentIndex(segmentation)
     for output_segment_index, segment_name_to_label_value in enumerate(segment_names_to_label_values):
-        if type(segment_name_to_label_value[0]) is str:
-            # Find segment from terminology
-            segments = segments_from_name(segmentation, segment_name_to_label_value[0])
-        else:
-            segments = segments_from_terminology(segmentation, segment_name_to_label_value[0])
+        segments = segment_index.segments_from_name_or_terminology(segment_name_to_label_value[0])
         if not segments:
             raise ValueError(f"Segment not found: {segment_name_to_label_value[0]}")
-        segment_id = segments[0]["id"]
         output_segment = copy.deepcopy(segments[0])
         output_label_value = segment_name_to_label_value[1]
         output_segment["labelValue"] = output_label_value
@@ -760,16 +2092,9 @@ def extract_segments(segmentation, segment_names_to_label_values, minimalExtent=
 
         unionOfAllExtents = [0, -1, 0, -1, 0, -1]
         for segment in segments:
-            # Copy relabeled voxel data
-            input_label_value = segment["labelValue"]
-            if dims == 3:
-                segment_voxel_positions = np.where(voxels[:, :, :] == input_label_value)
-            elif dims == 4:
-                inputLayer = segment["layer"]
-                segment_voxel_positions = np.where(voxels[inputLayer, :, :, :] == input_label_value)
-            else:
-                raise ValueError("Voxel array dimension is invalid")
-            output_voxels[segment_voxel_positions] = output_label_value
+            input_layer = segment["layer"] if dims == 4 else 0
+            label_map = layer_label_maps.setdefault(input_layer, {})
+            label_map[segment["labelValue"]] = (output_segment_index + 1, output_label_value)
             if minimalExtent:
                 if "extent" in segment:
                     extent = segment["extent"]
@@ -794,7 +2119,806 @@ def extract_segments(segmentation, segment_names_to_label_values, minimalExtent=
 
         output_segments.append(output_segment)
 
+    # Use the smallest integer type that can store the output label values (e.g., uint8 for less than 256 labels)
+    output_dtype = _minimal_label_dtype([label_value for _, label_value in segment_names_to_label_values])
+
+    # Copy relabeled voxel data, with a single lookup table pass over each input layer
+    if len(layer_label_maps) == 1:
+        # All extracted segments are in the same layer, there cannot be any overlap between them
+        [(input_layer, label_map)] = layer_label_maps.items()
+        layer_voxels = voxels if dims == 3 else voxels[input_layer, :, :, :]
+        output_label_map = {input_label: output_label for input_label, (_, output_label) in label_map.items()}
+        output_voxels = _remap_labels(layer_voxels, output_label_map, output_dtype)
+    else:
+        output_voxels = np.zeros(output_shape, dtype=output_dtype, order="F" if voxels.flags["F_CONTIGUOUS"] else "C")
+    if len(layer_label_maps) > 1:
+        # Segments may overlap, keep the label of the segment that was listed later in the mapping.
+        priority_dtype = np.uint16 if len(segment_names_to_label_values) < np.iinfo(np.uint16).max else np.uint32
+        output_priorities = np.zeros(output_shape, dtype=priority_dtype)
+        for input_layer in sorted(layer_label_maps):
+            label_map = layer_label_maps[input_layer]
+            layer_voxels = voxels[input_layer, :, :, :]
+            priority_map = {input_label: priority for input_label, (priority, _) in label_map.items()}
+            output_label_map = {input_label: output_label for input_label, (_, output_label) in label_map.items()}
+            layer_priorities = _remap_labels(layer_voxels, priority_map, priority_dtype)
+            overwrite = layer_priorities > output_priorities
+            np.copyto(output_voxels, _remap_labels(layer_voxels, output_label_map, output_dtype), where=overwrite)
+            np.copyto(output_priorities, layer_priorities, where=overwrite)
+    output_segmentation["voxels"] = output_voxels
+
+    return output_segmentation
+
+def _extract_sparse_segments(segmentation, segment_names_to_label_values):
+    """Extract segments from a segmentation in sparse representation. See `extract_segments`."""
+    from collections import OrderedDict
+    import copy
+    import numpy as np
+
+    output_segments = []
+    segment_index = SegmentIndex(segmentation)
+    for segment_name_to_label_value in segment_names_to_label_values:
+        segments = segment_index.segments_from_name_or_terminology(segment_name_to_label_value[0])
+        if not segments:
+            raise ValueError(f"Segment not found: {segment_name_to_label_value[0]}")
+        output_segment = copy.deepcopy({key: segments[0][key] for key in segments[0] if key != "mask"})
+        output_segment["labelValue"] = segment_name_to_label_value[1]
+        output_segment["layer"] = 0  # Output is a single layer
+
+        # Merge the masks of all matching segments
+        segments = [segment for segment in segments if _isValidExtent(segment["extent"])]
+        if not segments:
+            output_segment["extent"] = [0, -1, 0, -1, 0, -1]
+            output_segment["mask"] = _empty_mask()
+        elif len(segments) == 1:
+            output_segment["extent"] = list(segments[0]["extent"])
+            output_segment["mask"] = segments[0]["mask"].copy()
+        else:
+            extent = []
+            for axis in range(3):
+                extent += [min(segment["extent"][axis*2] for segment in segments), max(segment["extent"][axis*2+1] for segment in segments)]
+            mask = np.zeros([extent[axis*2+1] - extent[axis*2] + 1 for axis in range(3)], dtype=bool)
+            for segment in segments:
+                mask[_extent_region(_relative_extent(segment["extent"], extent))] |= segment["mask"]
+            output_segment["extent"] = extent
+            output_segment["mask"] = mask
+        output_segments.append(output_segment)
+
+    # Segments that are listed later overwrite the earlier ones
+    for segment_index, segment in enumerate(output_segments):
+        for later_segment in output_segments[segment_index+1:]:
+            extent, later_extent = segment["extent"], later_segment["extent"]
+            overlap = []
+            for axis in range(3):
+                overlap += [max(extent[axis*2], later_extent[axis*2]), min(extent[axis*2+1], later_extent[axis*2+1])]
+            if _isValidExtent(overlap):
+                segment["mask"][_extent_region(_relative_extent(overlap, extent))] &= ~later_segment["mask"][_extent_region(_relative_extent(overlap, later_extent))]
+
+    output_segmentation = OrderedDict()
+    for key in segmentation:
+        if key == "segments":
+            output_segmentation[key] = output_segments
+        else:
+            output_segmentation[key] = copy.deepcopy(segmentation[key])
+    return output_segmentation
+
+
+def _relative_extent(extent, reference_extent):
+    """Get extent relative to the origin of the reference extent."""
+    return [extent[axis*2+bound] - reference_extent[axis*2] for axis in range(3) for bound in range(2)]
+
+
+def segment_statistics(segmentation, update_extent=False):
+    """Compute voxel count, volume, centroid and bounding box of all segments.
+
+    Statistics of all segments in a layer are computed in a single pass over the layer's voxels,
+    using histograms of label values along each axis.
+
+    :param segmentation: segmentation metadata and voxels, or segmentation in sparse representation
+    :param update_extent: if True then "extent" of each segment is set to the computed tight bounding box.
+    :return: list of statistics, one dict for each segment (in the same order as in segmentation["segments"]), containing:
+        "id" (segment ID, if available), "voxelCount", "volumeMm3" (volume in cubic millimeters),
+        "centroid" (center of mass in LPS coordinate system, None for empty segments),
+        "extent" (tight bounding box in voxel coordinates, as [i_min, i_max, j_min, j_max, k_min, k_max];
+        [0, -1, 0, -1, 0, -1] for empty segments).
+    """
+    import numpy as np
+
+    ijkToLPS = np.array(segmentation["ijkToLPS"], dtype=float)
+    voxel_volume = abs(np.linalg.det(ijkToLPS[0:3, 0:3]))
+    if _is_sparse(segmentation):
+        segment_axis_counts = [_mask_axis_counts(segment["extent"], segment["mask"], segmentation["voxelsShape"])
+            for segment in segmentation["segments"]]
+    else:
+        segment_axis_counts = _segment_axis_counts(segmentation)
+
+    statistics = []
+    for segment, axis_counts in zip(segmentation["segments"], segment_axis_counts):
+        segment_stats = {}
+        if "id" in segment:
+            segment_stats["id"] = segment["id"]
+        voxel_count = int(axis_counts[0].sum())
+        segment_stats["voxelCount"] = voxel_count
+        segment_stats["volumeMm3"] = voxel_count * voxel_volume
+        if voxel_count > 0:
+            centroid_ijk = [np.dot(np.arange(len(counts)), counts) / voxel_count for counts in axis_counts]
+            segment_stats["centroid"] = ijkToLPS.dot(centroid_ijk + [1.0])[0:3].tolist()
+            extent = []
+            for counts in axis_counts:
+                nonzero_indices = np.flatnonzero(counts)
+                extent += [int(nonzero_indices[0]), int(nonzero_indices[-1])]
+        else:
+            segment_stats["centroid"] = None
+            extent = [0, -1, 0, -1, 0, -1]
+        segment_stats["extent"] = extent
+        if update_extent:
+            segment["extent"] = list(extent)
+        statistics.append(segment_stats)
+
+    return statistics
+
+
+def _segment_axis_counts(segmentation):
+    """Count voxels of each segment along each axis, in a single pass over each layer of the voxel array.
+    :return: list containing [i_counts, j_counts, k_counts] for each segment
+    """
+    voxels = segmentation["voxels"]
+    if voxels is None:
+        raise ValueError("Segmentation does not contain voxels")
+    dims = len(voxels.shape)
+    if dims not in [3, 4]:
+        raise ValueError("Voxel array dimension is invalid")
+
+    # Group label values by layer
+    layer_label_values = {}
+    for segment in segmentation["segments"]:
+        layer = segment.get("layer", 0) if dims == 4 else 0
+        layer_label_values.setdefault(layer, set()).add(segment["labelValue"])
+
+    # Voxel count along each axis, for each label value: label_histograms[layer][label_value] = [i_counts, j_counts, k_counts]
+    label_histograms = {}
+    for layer, label_values in layer_label_values.items():
+        layer_voxels = voxels if dims == 3 else voxels[layer, :, :, :]
+        label_values = sorted(label_values)
+        histograms = _label_axis_histograms(layer_voxels, label_values)
+        label_histograms[layer] = {label_value: histograms[label_index] for label_index, label_value in enumerate(label_values)}
+
+    return [label_histograms[segment.get("layer", 0) if dims == 4 else 0][segment["labelValue"]]
+        for segment in segmentation["segments"]]
+
+
+def _mask_axis_counts(extent, mask, shape):
+    """Count voxels of a segment mask (covering the extent of the segment) along each axis of the voxel array.
+    :return: [i_counts, j_counts, k_counts]
+    """
+    import numpy as np
+
+    axis_counts = []
+    for axis in range(3):
+        counts = np.zeros(shape[axis], dtype=np.int64)
+        if _isValidExtent(extent):
+            counts[extent[axis*2]:extent[axis*2+1]+1] = np.count_nonzero(mask, axis=tuple(a for a in range(3) if a != axis))
+        axis_counts.append(counts)
+    return axis_counts
+
+
+def sparse_segmentation(segmentation):
+    """Convert segmentation to sparse representation.
+
+    In sparse representation "voxels" is None, "voxelsShape" contains the shape of the (3D) voxel array,
+    and each segment contains a "mask": a boolean array that covers the segment's "extent"
+    (the mask of a segment with extent [i_min, i_max, j_min, j_max, k_min, k_max] has shape
+    [i_max-i_min+1, j_max-j_min+1, k_max-k_min+1]). "layer" and "labelValue" of the segments are kept,
+    they are used when the segmentation is converted back to dense representation.
+    Segments that are small compared to the whole volume require much less memory in this representation.
+
+    `read_segmentation` can read directly into sparse representation, and `extract_segments`, `segment_statistics`,
+    `collapse_layers`, and `write_segmentation` accept segmentations in sparse representation.
+
+    :param segmentation: segmentation metadata and voxels
+    :return: new segmentation in sparse representation. Extent of each segment is set to its tight bounding box.
+    """
+    from collections import OrderedDict
+    import copy
+
+    if _is_sparse(segmentation):
+        return copy.deepcopy(segmentation)
+    voxels = segmentation["voxels"]
+    if voxels is None:
+        raise ValueError("Segmentation does not contain voxels")
+    dims = len(voxels.shape)
+    if dims not in [3, 4]:
+        raise ValueError("Voxel array dimension is invalid")
+
+    # Bounding boxes of all segments are computed in a single pass over each layer
+    segment_extents = [segment_stats["extent"] for segment_stats in segment_statistics(segmentation)]
+
+    output_segments = []
+    for segment, extent in zip(segmentation["segments"], segment_extents):
+        output_segment = copy.deepcopy(segment)
+        output_segment["extent"] = extent
+        layer_voxels = voxels if dims == 3 else voxels[segment.get("layer", 0)]
+        if _isValidExtent(extent):
+            output_segment["mask"] = layer_voxels[_extent_region(extent)] == segment["labelValue"]
+        else:
+            output_segment["mask"] = _empty_mask()
+        output_segments.append(output_segment)
+
+    output_segmentation = OrderedDict()
+    for key in segmentation:
+        if key == "voxels":
+            output_segmentation[key] = None
+            output_segmentation["voxelsShape"] = list(voxels.shape[-3:])
+        elif key == "segments":
+            output_segmentation[key] = output_segments
+        else:
+            output_segmentation[key] = copy.deepcopy(segmentation[key])
+    return output_segmentation
+
+
+def dense_segmentation(segmentation):
+    """Convert segmentation from sparse representation (see `sparse_segmentation`) to a voxel array.
+
+    Each segment's mask is written into the segment's layer with the segment's label value. If segments overlap
+    within a layer then segments listed later overwrite the earlier ones. Voxels is a 3D array if all segments
+    are in layer 0, otherwise a 4D array (layer is the first axis).
+
+    :param segmentation: segmentation in sparse representation
+    :return: new segmentation, which contains the voxel array
+    """
+    from collections import OrderedDict
+    import copy
+    import numpy as np
+
+    if not _is_sparse(segmentation):
+        return copy.deepcopy(segmentation)
+
+    shape = tuple(segmentation["voxelsShape"])
+    segments = segmentation["segments"]
+    number_of_layers = max([segment.get("layer", 0) for segment in segments], default=0) + 1
+    dtype = _minimal_label_dtype([segment["labelValue"] for segment in segments])
+    if number_of_layers > 1:
+        voxels = np.zeros((number_of_layers,) + shape, dtype=dtype, order="F")
+    else:
+        voxels = np.zeros(shape, dtype=dtype, order="F")
+
+    output_segments = []
+    for segment in segments:
+        extent = segment["extent"]
+        if _isValidExtent(extent):
+            layer_voxels = voxels[segment.get("layer", 0)] if number_of_layers > 1 else voxels
+            layer_voxels[_extent_region(extent)][segment["mask"]] = segment["labelValue"]
+        output_segment = copy.deepcopy({key: segment[key] for key in segment if key != "mask"})
+        output_segments.append(output_segment)
+
+    output_segmentation = OrderedDict()
+    for key in segmentation:
+        if key == "voxels":
+            output_segmentation[key] = voxels
+        elif key == "voxelsShape":
+            continue
+        elif key == "segments":
+            output_segmentation[key] = output_segments
+        else:
+            output_segmentation[key] = copy.deepcopy(segmentation[key])
     return output_segmentation
 
+
+def _is_sparse(segmentation):
+    """Check if segmentation is in sparse representation (see `sparse_segmentation`)."""
+    return segmentation.get("voxels") is None and "voxelsShape" in segmentation
+
+
+def _extent_region(extent):
+    """Get tuple of slices that can be used for indexing the region of the voxel array that the extent covers."""
+    return tuple(slice(extent[axis*2], extent[axis*2+1]+1) for axis in range(3))
+
+
+def _empty_mask():
+    import numpy as np
+    return np.zeros((0, 0, 0), dtype=bool)
+
+
+def collapse_layers(segmentation, masks=None):
+    """Store segments in as few layers as possible, without overwriting each other.
+
+    Segments are assigned to layers greedily, in the order they are listed: each segment is added to the first layer
+    where it does not overlap with any segment that is already in that layer, or to a new layer if it overlaps with
+    all existing layers. This is similar to "Collapse labelmaps" in 3D Slicer. Fewer layers mean smaller files,
+    faster writing, and less memory needed for loading the segmentation.
+
+    :param segmentation: segmentation metadata and voxels (3D or 4D voxel array), or segmentation in sparse representation
+    :param masks: optional list of binary masks (3D arrays, one for each segment in segmentation["segments"]).
+        If specified then segment voxels are taken from the masks and segmentation["voxels"] is ignored.
+    :return: new segmentation. Voxels is a 3D array if all segments fit into a single layer, otherwise a 4D array.
+        "layer", "labelValue" (1, 2, ... within each layer), and "extent" (tight bounding box) of the segments are updated.
+    """
+    from collections import OrderedDict
+    import copy
+    import numpy as np
+
+    input_segments = segmentation["segments"]
+    if masks is not None:
+        if len(masks) != len(input_segments):
+            raise ValueError(f"Number of masks ({len(masks)}) does not match the number of segments ({len(input_segments)})")
+        if not masks:
+            raise ValueError("No masks are specified")
+        shape = np.shape(masks[0])
+        if any(np.shape(mask) != shape for mask in masks):
+            raise ValueError("All masks must have the same shape")
+        segment_extents = []
+        for mask in masks:
+            extent = []
+            for axis in range(3):
+                nonzero_indices = np.flatnonzero(np.any(mask, axis=tuple(a for a in range(3) if a != axis)))
+                extent += [int(nonzero_indices[0]), int(nonzero_indices[-1])] if len(nonzero_indices) else [0, -1]
+            segment_extents.append(extent if _isValidExtent(extent) else [0, -1, 0, -1, 0, -1])
+    elif _is_sparse(segmentation):
+        shape = tuple(segmentation["voxelsShape"])
+        segment_extents = [segment["extent"] for segment in input_segments]
+    else:
+        voxels = segmentation["voxels"]
+        if voxels is None:
+            raise ValueError("Segmentation does not contain voxels")
+        dims = len(voxels.shape)
+        if dims not in [3, 4]:
+            raise ValueError("Voxel array dimension is invalid")
+        shape = voxels.shape[-3:]
+        # Bounding boxes of all segments are computed in a single pass over each layer
+        segment_extents = [segment_stats["extent"] for segment_stats in segment_statistics(segmentation)]
+
+    def segment_mask(segment_index, region):
+        """Get binary mask of the segment in the region (tuple of slices)."""
+        if masks is not None:
+            return np.asarray(masks[segment_index][region], dtype=bool)
+        segment = input_segments[segment_index]
+        if "mask" in segment:
+            # Sparse representation, the mask covers the segment's extent
+            return segment["mask"]
+        layer_voxels = voxels if dims == 3 else voxels[segment.get("layer", 0)]
+        return layer_voxels[region] == segment["labelValue"]
+
+    output_layers = []  # voxel array of each output layer
+    output_layer_segment_counts = []
+    output_segments = []
+    for segment_index, segment in enumerate(input_segments):
+        extent = segment_extents[segment_index]
+        region = _extent_region(extent)
+        mask = segment_mask(segment_index, region) if _isValidExtent(extent) else None
+
+        # Find the first layer where the segment does not overlap with other segments
+        for layer, layer_voxels in enumerate(output_layers):
+            if mask is None or not np.any(layer_voxels[region][mask]):
+                break
+        else:
+            layer = len(output_layers)
+            layer_voxels = np.zeros(shape, dtype=np.uint8, order="F")
+            output_layers.append(layer_voxels)
+            output_layer_segment_counts.append(0)
+
+        # Label values are assigned sequentially within each layer
+        output_layer_segment_counts[layer] += 1
+        label_value = output_layer_segment_counts[layer]
+        if label_value > np.iinfo(layer_voxels.dtype).max:
+            layer_voxels = layer_voxels.astype(np.uint16 if label_value <= np.iinfo(np.uint16).max else np.uint32, order="F")
+            output_layers[layer] = layer_voxels
+        if mask is not None:
+            layer_voxels[region][mask] = label_value
+
+        output_segment = copy.deepcopy({key: segment[key] for key in segment if key != "mask"})
+        output_segment["labelValue"] = label_value
+        output_segment["layer"] = layer
+        output_segment["extent"] = list(extent)
+        output_segments.append(output_segment)
+
+    if len(output_layers) <= 1:
+        output_voxels = output_layers[0] if output_layers else np.zeros(shape, dtype=np.uint8, order="F")
+    else:
+        # Layer is the first (fastest varying) axis, as in 4D arrays read from .seg.nrrd files
+        output_voxels = np.zeros((len(output_layers),) + tuple(shape), dtype=np.result_type(*output_layers), order="F")
+        for layer in range(len(output_layers)):
+            output_voxels[layer] = output_layers[layer]
+            output_layers[layer] = None  # release memory
+
+    output_segmentation = OrderedDict()
+    output_segmentation["voxels"] = output_voxels
+    for key in segmentation:
+        if key in ["voxels", "voxelsShape"]:
+            continue
+        elif key == "segments":
+            output_segmentation[key] = output_segments
+        else:
+            output_segmentation[key] = copy.deepcopy(segmentation[key])
+    return output_segmentation
+
+
+def resample_segmentation(segmentation, reference, interpolation="nearest", minimal_extent=False, threads=None):
+    """Resample segmentation to the voxel grid of a reference image or segmentation.
+
+    Label values, layers, and all other segment metadata are preserved. Only the voxels that are within the bounding box
+    of the segments (transformed to the reference grid) are computed, in slabs along the last axis, using multiple threads.
+
+    :param segmentation: segmentation metadata and voxels, or segmentation in sparse representation
+    :param reference: geometry of the output voxel grid: a segmentation (dense or sparse) or a dict that contains "ijkToLPS"
+        and "voxelsShape" (shape of the 3D voxel array), and optionally "referenceImageExtentOffset".
+    :param interpolation: "nearest" (nearest neighbor) or "linear". In "linear" mode the mask of each segment is resampled
+        using trilinear interpolation and each voxel gets the label value of the segment that has the highest interpolated
+        value in the layer, or remains background if the background has a higher value. This produces smoother boundaries
+        when resampling to a finer grid. In sparse representation each segment is resampled independently: a voxel
+        belongs to the segment if the interpolated value is larger than 0.5.
+    :param minimal_extent: if True then the output voxel array is cropped to the union of the segments' bounding boxes
+        ("ijkToLPS" and "referenceImageExtentOffset" are updated accordingly).
+    :param threads: number of threads used for resampling. If None then the number of CPUs is used.
+    :return: new segmentation in the reference voxel grid, in the same representation (dense or sparse) as the input.
+        Extent of each segment is set to its tight bounding box.
+    """
+    from collections import OrderedDict
+    from concurrent.futures import ThreadPoolExecutor
+    import copy
+    import os
+    import numpy as np
+
+    if interpolation not in ["nearest", "linear"]:
+        raise ValueError(f"Unsupported interpolation: {interpolation}")
+    if reference.get("voxels") is not None:
+        output_shape = tuple(reference["voxels"].shape[-3:])
+    elif "voxelsShape" in reference:
+        output_shape = tuple(reference["voxelsShape"])
+    else:
+        raise ValueError("Reference does not contain voxels or voxelsShape")
+    output_ijkToLPS = np.array(reference["ijkToLPS"], dtype=float)
+    # Transforms from output voxel coordinates to input voxel coordinates and back
+    output_to_input = np.linalg.inv(np.array(segmentation["ijkToLPS"], dtype=float)).dot(output_ijkToLPS)
+    input_to_output = np.linalg.inv(output_to_input)
+    sparse = _is_sparse(segmentation)
+    if threads is None:
+        threads = os.cpu_count() or 1
+
+    output_segments = [copy.deepcopy({key: segment[key] for key in segment if key != "mask"}) for segment in segmentation["segments"]]
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        if sparse:
+            input_shape = segmentation["voxelsShape"]
+            full_extent = [0, input_shape[0]-1, 0, input_shape[1]-1, 0, input_shape[2]-1]
+            def resample_segment(segment):
+                extent = segment.get("extent", full_extent)
+                if not _isValidExtent(extent):
+                    return [0, -1, 0, -1, 0, -1], _empty_mask()
+                region = _resampling_output_region(input_to_output, extent, interpolation, output_shape)
+                if not _isValidExtent(region):
+                    return [0, -1, 0, -1, 0, -1], _empty_mask()
+                source = _resampling_source(segment["mask"], extent, True, interpolation, region)
+                mask = np.zeros([region[axis*2+1] - region[axis*2] + 1 for axis in range(3)], dtype=bool, order="F")
+                _resample_slab([source], output_to_input, region, interpolation, mask)
+                # Crop the mask to its tight bounding box
+                mask_extent = []
+                for axis in range(3):
+                    nonzero_indices = np.flatnonzero(np.any(mask, axis=tuple(a for a in range(3) if a != axis)))
+                    if not len(nonzero_indices):
+                        return [0, -1, 0, -1, 0, -1], _empty_mask()
+                    mask_extent += [int(nonzero_indices[0]), int(nonzero_indices[-1])]
+                mask = np.asfortranarray(mask[_extent_region(mask_extent)])
+                return [region[axis//2*2] + mask_extent[axis] for axis in range(6)], mask
+            for output_segment, (extent, mask) in zip(output_segments, executor.map(resample_segment, segmentation["segments"])):
+                output_segment["extent"] = extent
+                output_segment["mask"] = mask
+            output_voxels = None
+        else:
+            voxels = segmentation["voxels"]
+            if voxels is None:
+                raise ValueError("Segmentation does not contain voxels")
+            dims = len(voxels.shape)
+            if dims not in [3, 4]:
+                raise ValueError("Voxel array dimension is invalid")
+            # Extents stored in the file may be larger than the segments, tight bounding boxes are computed in a single pass over each layer
+            segment_extents = [segment_stats["extent"] for segment_stats in segment_statistics(segmentation)]
+            output_voxels = np.zeros(voxels.shape[:-3] + output_shape, dtype=voxels.dtype, order="F")
+            futures = []
+            for layer in range(voxels.shape[0] if dims == 4 else 1):
+                layer_voxels = voxels[layer] if dims == 4 else voxels
+                layer_output_voxels = output_voxels[layer] if dims == 4 else output_voxels
+                layer_segment_indices = [segment_index for segment_index, segment in enumerate(segmentation["segments"])
+                    if (segment.get("layer", 0) if dims == 4 else 0) == layer]
+                layer_segments = [segmentation["segments"][segment_index] for segment_index in layer_segment_indices]
+                layer_extents = [segment_extents[segment_index] for segment_index in layer_segment_indices]
+                if interpolation == "nearest":
+                    # Label values are copied from the union of the bounding boxes of the layer's segments
+                    union_extent = _union_of_extents(layer_extents)
+                    if not _isValidExtent(union_extent):
+                        continue
+                    region = _resampling_output_region(input_to_output, union_extent, interpolation, output_shape)
+                    if not _isValidExtent(region):
+                        continue
+                    sources = [_resampling_source(layer_voxels[_extent_region(union_extent)], union_extent, None, interpolation, region)]
+                else:
+                    # Each segment's mask is interpolated separately
+                    sources = []
+                    for segment, extent in zip(layer_segments, layer_extents):
+                        if not _isValidExtent(extent):
+                            continue
+                        segment_region = _resampling_output_region(input_to_output, extent, interpolation, output_shape)
+                        if not _isValidExtent(segment_region):
+                            continue
+                        mask = layer_voxels[_extent_region(extent)] == segment["labelValue"]
+                        sources.append(_resampling_source(mask, extent, segment["labelValue"], interpolation, segment_region))
+                    region = _union_of_extents([source[3] for source in sources])
+                if not _isValidExtent(region):
+                    continue
+                slab_size = max(1, _RESAMPLE_CHUNK_SIZE // ((region[1] - region[0] + 1) * (region[3] - region[2] + 1)))
+                for slab_start in range(region[4], region[5] + 1, slab_size):
+                    slab = region[0:4] + [slab_start, min(slab_start + slab_size - 1, region[5])]
+                    futures.append(executor.submit(_resample_slab, sources, output_to_input, slab, interpolation,
+                        layer_output_voxels[_extent_region(slab)]))
+            for future in futures:
+                future.result()
+
+    output_segmentation = OrderedDict()
+    for key in segmentation:
+        if key == "voxels":
+            output_segmentation[key] = output_voxels
+        elif key == "voxelsShape":
+            output_segmentation[key] = list(output_shape)
+        elif key == "segments":
+            output_segmentation[key] = output_segments
+        elif key in ["ijkToLPS", "referenceImageExtentOffset"]:
+            continue
+        else:
+            output_segmentation[key] = copy.deepcopy(segmentation[key])
+    output_segmentation["ijkToLPS"] = output_ijkToLPS
+    output_segmentation["referenceImageExtentOffset"] = list(reference.get("referenceImageExtentOffset", [0, 0, 0]))
+
+    if not sparse:
+        segment_statistics(output_segmentation, update_extent=True)
+    if minimal_extent:
+        region = _crop_segmentation_metadata_to_region(output_segmentation, output_shape,
+            _union_of_extents([segment["extent"] for segment in output_segments]))
+        if sparse:
+            output_segmentation["voxelsShape"] = [region[axis*2+1] - region[axis*2] + 1 for axis in range(3)]
+        else:
+            output_segmentation["voxels"] = np.asfortranarray(output_voxels[(Ellipsis,) + _extent_region(region)])
+
+    return output_segmentation
+
+
+# Maximum number of voxels resampled at once
+_RESAMPLE_CHUNK_SIZE = 2**20
+
+
+def _union_of_extents(extents):
+    """Get the bounding box of all the valid extents ([0, -1, 0, -1, 0, -1] if there are none)."""
+    union_extent = [0, -1, 0, -1, 0, -1]
+    for extent in extents:
+        if not _isValidExtent(extent):
+            continue
+        if _isValidExtent(union_extent):
+            for axis in range(3):
+                union_extent[axis*2] = min(union_extent[axis*2], extent[axis*2])
+                union_extent[axis*2+1] = max(union_extent[axis*2+1], extent[axis*2+1])
+        else:
+            union_extent = list(extent)
+    return union_extent
+
+
+def _resampling_source(array, extent, label_value, interpolation, output_region):
+    """Get (array, offset, label value, output region) tuple describing input voxels for `_resample_slab`.
+    For linear interpolation the array is a binary mask, it is converted to float and padded by one zero voxel on each side.
+    Label value is only used for linear interpolation.
+    """
+    import numpy as np
+    offset = extent[0::2]
+    if interpolation == "linear":
+        padded = np.zeros([size + 2 for size in array.shape], dtype=np.float32, order="F")
+        padded[1:-1, 1:-1, 1:-1] = array
+        return (padded, [value - 1 for value in offset], label_value, output_region)
+    return (array, offset, label_value, output_region)
+
+
+def _resampling_output_region(input_to_output, extent, interpolation, output_shape):
+    """Get the region of the output voxel array that the input extent (transformed to the output grid) may affect."""
+    import itertools
+    import numpy as np
+    # Nearest neighbor uses input voxels within half voxel distance, linear interpolation uses neighbor voxels
+    margin = 0.5 if interpolation == "nearest" else 1.0
+    corners = np.array([[extent[axis*2 + bit] + (margin if bit else -margin) for axis, bit in enumerate(bits)] + [1.0]
+        for bits in itertools.product([0, 1], repeat=3)])
+    output_corners = corners.dot(input_to_output.T)[:, 0:3]
+    region = []
+    for axis in range(3):
+        region.append(max(int(np.floor(output_corners[:, axis].min())), 0))
+        region.append(min(int(np.ceil(output_corners[:, axis].max())), output_shape[axis] - 1))
+    return region if _isValidExtent(region) else [0, -1, 0, -1, 0, -1]
+
+
+def _resample_slab(sources, output_to_input, slab, interpolation, out):
+    """Resample input voxels into a region of the output voxel array.
+    :param sources: list of (array, offset, label value, output region) tuples (see `_resampling_source`).
+        Only the intersection of the output region of each source and the slab is computed.
+    :param slab: region of the output voxel array that is computed (first and last voxel index along each spatial axis)
+    :param out: array that the resampled voxels of the slab are written into (same shape as the slab)
+    """
+    import itertools
+    import numpy as np
+
+    # Input voxel coordinates of output voxels, computed separably for each output axis
+    axis_coordinates = [np.arange(slab[axis*2], slab[axis*2+1] + 1, dtype=float) for axis in range(3)]
+
+    def input_coordinates(region):
+        slices = [slice(region[axis*2] - slab[axis*2], region[axis*2+1] - slab[axis*2] + 1) for axis in range(3)]
+        i = axis_coordinates[0][slices[0], np.newaxis, np.newaxis]
+        j = axis_coordinates[1][np.newaxis, slices[1], np.newaxis]
+        k = axis_coordinates[2][np.newaxis, np.newaxis, slices[2]]
+        return [output_to_input[axis, 0] * i + output_to_input[axis, 1] * j + output_to_input[axis, 2] * k + output_to_input[axis, 3]
+            for axis in range(3)], tuple(slices)
+
+    def slab_region(output_region):
+        region = []
+        for axis in range(3):
+            region += [max(output_region[axis*2], slab[axis*2]), min(output_region[axis*2+1], slab[axis*2+1])]
+        return region
+
+    if interpolation == "nearest":
+        for array, offset, label_value, output_region in sources:
+            region = slab_region(output_region)
+            if not _isValidExtent(region):
+                continue
+            coordinates, slices = input_coordinates(region)
+            indices = []
+            valid = None
+            for axis in range(3):
+                index = np.floor(coordinates[axis] - offset[axis] + 0.5).astype(np.intp)
+                axis_valid = (index >= 0) & (index < array.shape[axis])
+                valid = axis_valid if valid is None else valid & axis_valid
+                np.clip(index, 0, array.shape[axis] - 1, out=index)
+                indices.append(index)
+            values = array[tuple(indices)]
+            values[~valid] = 0
+            out[slices] = values
+        return
+
+    # Linear interpolation: label of the segment with the highest interpolated mask value
+    shape = out.shape
+    total = np.zeros(shape, dtype=np.float32)
+    best = np.zeros(shape, dtype=np.float32)
+    best_label = np.zeros(shape, dtype=out.dtype)
+    for array, offset, label_value, output_region in sources:
+        region = slab_region(output_region)
+        if not _isValidExtent(region):
+            continue
+        coordinates, slices = input_coordinates(region)
+        base_indices = []
+        fractions = []
+        valid = None
+        for axis in range(3):
+            position = coordinates[axis] - offset[axis]
+            index = np.floor(position)
+            fractions.append((position - index).astype(np.float32))
+            index = index.astype(np.intp)
+            # The array is padded by zeros, therefore voxels whose neighbors are all outside of the array are zero
+            axis_valid = (index >= 0) & (index < array.shape[axis] - 1)
+            valid = axis_valid if valid is None else valid & axis_valid
+            np.clip(index, 0, array.shape[axis] - 2, out=index)
+            base_indices.append(index)
+        value = np.zeros(valid.shape, dtype=np.float32)
+        for bits in itertools.product([0, 1], repeat=3):
+            weight = None
+            for axis, bit in enumerate(bits):
+                axis_weight = fractions[axis] if bit else 1.0 - fractions[axis]
+                weight = axis_weight if weight is None else weight * axis_weight
+            value += weight * array[tuple(base_indices[axis] + bit for axis, bit in enumerate(bits))]
+        value[~valid] = 0
+        total[slices] += value
+        better = value > best[slices]
+        best[slices] = np.where(better, value, best[slices])
+        best_label[slices] = np.where(better, np.asarray(label_value, dtype=out.dtype), best_label[slices])
+    # Background value is 1 - total
+    out[...] = np.where(best > 1.0 - total, best_label, out)
+
+
+# Maximum number of voxels processed at once when computing label statistics
+_STATISTICS_CHUNK_SIZE = 2**21
+
+
+def _label_axis_histograms(voxels, label_values):
+    """Count voxels of each label value along each axis of a 3D array, in a single pass over the voxels.
+    :param voxels: 3D array of label values
+    :param label_values: sorted list of label values
+    :return: list containing [i_counts, j_counts, k_counts] for each label value (voxel counts along each axis)
+    """
+    import numpy as np
+
+    shape = voxels.shape
+    number_of_labels = len(label_values)
+    # Label values are replaced by label index + 1 (0 = not counted)
+    index_dtype = np.uint8 if number_of_labels < 255 else np.uint32
+    label_index_map = {label_value: label_index + 1 for label_index, label_value in enumerate(label_values)}
+
+    histograms = [np.zeros(number_of_labels * size, dtype=np.int64) for size in shape]
+    slices_per_chunk = max(_STATISTICS_CHUNK_SIZE // max(shape[0] * shape[1], 1), 1)
+    for first_slice in range(0, shape[2], slices_per_chunk):
+        chunk = voxels[:, :, first_slice:first_slice + slices_per_chunk]
+        label_indices = _remap_labels(chunk, label_index_map, index_dtype)
+        memory_order = "F" if label_indices.flags["F_CONTIGUOUS"] else "C"
+        label_indices = label_indices.ravel(order=memory_order)
+        # Only voxels of the selected labels are counted (typically a small fraction of all voxels)
+        positions = np.flatnonzero(label_indices)
+        label_indices = label_indices[positions].astype(np.intp) - 1
+        position_indices = np.unravel_index(positions, chunk.shape, order=memory_order)
+        del positions
+        for axis in range(3):
+            axis_index = position_indices[axis] + first_slice if axis == 2 else position_indices[axis]
+            # Histogram bin: label index * axis size + position along the axis
+            histograms[axis] += np.bincount(label_indices * shape[axis] + axis_index, minlength=len(histograms[axis]))
+
+    return [[histograms[axis].reshape(number_of_labels, shape[axis])[label_index] for axis in range(3)]
+        for label_index in range(number_of_labels)]
+
+
+def _remap_labels(voxels, label_map, dtype):
+    """Map voxel values to new values using a lookup table, in a single pass over the voxels.
+    :param voxels: array of input label values
+    :param label_map: dict of input label value -> output value. Voxels with values not in the map are set to 0.
+    :param dtype: data type of the returned array
+    :return: array of remapped values with the same shape (and memory layout) as voxels
+    """
+    import numpy as np
+
+    # Process the voxels in memory order (Fortran-ordered arrays are transposed), in chunks along the slowest
+    # varying axis, so that temporary arrays (such as indices that numpy creates for the table lookup) remain small.
+    transposed = voxels.ndim > 1 and voxels.strides[0] < voxels.strides[-1]
+    source = voxels.T if transposed else voxels
+    output = np.zeros(source.shape, dtype=dtype)
+    if voxels.dtype.kind in "iu":
+        # Labels that cannot be represented by the voxel type do not occur in the voxels
+        value_range = np.iinfo(voxels.dtype)
+        label_map = {input_label: output_value for input_label, output_value in label_map.items()
+            if value_range.min <= input_label <= value_range.max}
+    if not label_map or output.size == 0:
+        return output.T if transposed else output
+
+    lut = None
+    if voxels.dtype.kind in "iu" and voxels.dtype.itemsize <= 2:
+        # The table can cover all possible voxel values. Signed values are indexed by their unsigned
+        # bit pattern, so that the table lookup does not require an offset (and a temporary copy of the voxels).
+        index_dtype = np.dtype(f"u{voxels.dtype.itemsize}")
+        lut = np.zeros(np.iinfo(index_dtype).max + 1, dtype=dtype)
+        for input_label, output_value in label_map.items():
+            lut[np.array(input_label, dtype=voxels.dtype).view(index_dtype)] = output_value
+        source = source.view(index_dtype)
+    else:
+        # Large value range, look up the values in the sorted list of input labels
+        input_labels = np.array(sorted(label_map), dtype=voxels.dtype)
+        output_values = np.array([label_map[input_label] for input_label in sorted(label_map)], dtype=dtype)
+
+    rows_per_chunk = max(_REMAP_CHUNK_SIZE // max(output[0].size, 1), 1)
+    for start in range(0, source.shape[0], rows_per_chunk):
+        chunk = slice(start, start + rows_per_chunk)
+        if lut is not None:
+            # All indices are valid, "clip" mode allows numpy to write directly into the output array
+            np.take(lut, source[chunk], out=output[chunk], mode="clip")
+        else:
+            chunk_voxels = source[chunk]
+            positions = np.searchsorted(input_labels, chunk_voxels)
+            np.minimum(positions, len(input_labels) - 1, out=positions)
+            np.copyto(output[chunk], output_values[positions], where=(input_labels[positions] == chunk_voxels))
+
+    return output.T if transposed else output
+
+
+# Maximum number of voxels processed at once when remapping label values
+_REMAP_CHUNK_SIZE = 2**20
+
+
+def _minimal_label_dtype(label_values):
+    """Get the smallest integer type that can store all the label values and 0 (background).
+    Unsigned type is used if none of the label values are negative.
+    """
+    import numpy as np
+
+    min_value = min(min(label_values, default=0), 0)
+    max_value = max(max(label_values, default=0), 0)
+    for dtype in ([np.uint8, np.uint16, np.uint32, np.uint64] if min_value >= 0 else [np.int8, np.int16, np.int32, np.int64]):
+        if np.iinfo(dtype).min <= min_value and max_value <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    raise ValueError(f"Label values are out of range: {min_value} - {max_value}")
+
+
 def _isValidExtent(extent):
     return extent[0] <= extent[1] and extent[2] <= extent[3] and extent[4] <= extent[5]
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+"""Persistent index of segment metadata of many segmentation files.
+
+The index is stored in a SQLite database file. It allows finding files that contain a given segment
+without reading and parsing the header of every segmentation file. Only files that have been changed
+(modification time or size) since the last update are read again when the index is updated.
+"""
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS segments (
+    path TEXT NOT NULL REFERENCES files(path) ON DELETE CASCADE,
+    segment_index INTEGER NOT NULL,
+    id TEXT,
+    name TEXT,
+    label_value INTEGER,
+    layer INTEGER,
+    category_scheme TEXT,
+    category_code TEXT,
+    type_scheme TEXT,
+    type_code TEXT,
+    metadata TEXT NOT NULL,
+    PRIMARY KEY (path, segment_index)
+);
+CREATE INDEX IF NOT EXISTS segments_name ON segments(name);
+CREATE INDEX IF NOT EXISTS segments_type ON segments(type_scheme, type_code, category_scheme, category_code);
+"""
+
+
+def _connect(index_filename):
+    import sqlite3
+    connection = sqlite3.connect(index_filename)
+    connection.execute("PRAGMA foreign_keys = ON")
+    connection.executescript(_SCHEMA)
+    return connection
+
+
+def update_index(index_filename, files_or_directory, pattern="*.seg.nrrd", recursive=True):
+    """Add segment metadata of segmentation files to the index or update it if the files have changed.
+
+    Only the file headers are read. Files that have not changed since the last update (same modification time and size)
+    are not read again. If a directory is specified then files that were previously indexed in that directory
+    but no longer exist are removed from the index.
+
+    :param index_filename: SQLite database file name. It is created if it does not exist yet.
+    :param files_or_directory: directory path or list of segmentation file paths
+    :param pattern: file name pattern of segmentation files in the directory
+    :param recursive: search subdirectories of the directory, too
+    :return: dict with number of "updated", "unchanged", "removed", and "failed" files.
+    """
+    import glob
+    import logging
+    import os
+    from .segmentation import read_segmentation
+
+    if isinstance(files_or_directory, (str, os.PathLike)) and os.path.isdir(files_or_directory):
+        directory = os.path.abspath(files_or_directory)
+        search_pattern = os.path.join(directory, "**", pattern) if recursive else os.path.join(directory, pattern)
+        paths = sorted(glob.glob(search_pattern, recursive=recursive))
+    else:
+        directory = None
+        if isinstance(files_or_directory, (str, os.PathLike)):
+            files_or_directory = [files_or_directory]
+        paths = [os.path.abspath(path) for path in files_or_directory]
+
+    result = {"updated": 0, "unchanged": 0, "removed": 0, "failed": 0}
+    connection = _connect(index_filename)
+    try:
+        indexed_files = {row[0]: (row[1], row[2]) for row in connection.execute("SELECT path, mtime_ns, size FROM files")}
+
+        if directory is not None:
+            existing_paths = set(paths)
+            directory_prefix = os.path.join(directory, "")
+            removed_paths = [path for path in indexed_files if path.startswith(directory_prefix) and path not in existing_paths]
+        else:
+            removed_paths = [path for path in paths if path in indexed_files and not os.path.exists(path)]
+            paths = [path for path in paths if os.path.exists(path)]
+
+        for path in removed_paths:
+            with connection:
+                connection.execute("DELETE FROM files WHERE path = ?", (path,))
+        result["removed"] = len(removed_paths)
+
+        for path in paths:
+            stat = os.stat(path)
+            if indexed_files.get(path) == (stat.st_mtime_ns, stat.st_size):
+                result["unchanged"] += 1
+                continue
+            try:
+                segmentation = read_segmentation(path, skip_voxels=True)
+            except Exception as e:
+                logging.warning(f"Failed to read segmentation file {path}: {str(e)}")
+                result["failed"] += 1
+                continue
+            with connection:
+                connection.execute("DELETE FROM files WHERE path = ?", (path,))
+                connection.execute("INSERT INTO files (path, mtime_ns, size) VALUES (?, ?, ?)", (path, stat.st_mtime_ns, stat.st_size))
+                connection.executemany(
+                    "INSERT INTO segments (path, segment_index, id, name, label_value, layer,"
+                    " category_scheme, category_code, type_scheme, type_code, metadata) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    [_segment_row(path, segment_index, segment) for segment_index, segment in enumerate(segmentation.get("segments", []))])
+            result["updated"] += 1
+    finally:
+        connection.close()
+
+    return result
+
+
+def _segment_row(path, segment_index, segment):
+    import json
+    terminology = segment.get("terminology", {})
+    category = terminology.get("category", [None, None])
+    segment_type = terminology.get("type", [None, None])
+    return (path, segment_index, segment.get("id"), segment.get("name"), segment.get("labelValue"), segment.get("layer"),
+        category[0], category[1], segment_type[0], segment_type[1], json.dumps(segment))
+
+
+def find_segments(index_filename, name=None, terminology=None):
+    """Find segments in the index by name and/or terminology.
+
+    Terminology is matched the same way as in `extract_segments`: coding scheme designator and code value of category,
+    type, and (if specified in any of the two) type modifier, anatomic region and anatomic region modifier must match.
+    A `slicerio.segmentation.TerminologyMatcher` can be used for finding segments that match any of multiple
+    terminologies or for ignoring some terminology fields.
+
+    :param index_filename: SQLite database file name
+    :param name: segment name
+    :param terminology: terminology dict or `slicerio.segmentation.TerminologyMatcher`
+    :return: list of (file path, segment) tuples. Segment is a dict in the same format as in `read_segmentation`.
+    """
+    import json
+    from .segmentation import TerminologyMatcher
+
+    matcher = None
+    if terminology is not None:
+        matcher = terminology if isinstance(terminology, TerminologyMatcher) else TerminologyMatcher(terminology)
+
+    query = "SELECT path, metadata FROM segments"
+    conditions = []
+    parameters = []
+    if name is not None:
+        conditions.append("name = ?")
+        parameters.append(name)
+    if matcher is not None and matcher.category_and_type_codes is not None:
+        # Narrow down the candidates in the database, remaining fields are checked by the matcher
+        if not matcher.category_and_type_codes:
+            return []
+        codes = sorted(matcher.category_and_type_codes)
+        conditions.append("(" + " OR ".join(["(category_scheme = ? AND category_code = ? AND type_scheme = ? AND type_code = ?)"] * len(codes)) + ")")
+        for category, segment_type in codes:
+            parameters.extend([category[0], category[1], segment_type[0], segment_type[1]])
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY path, segment_index"
+
+    found_segments = []
+    connection = _connect(index_filename)
+    try:
+        for path, metadata in connection.execute(query, parameters):
+            segment = json.loads(metadata)
+            if matcher is not None and ("terminology" not in segment or not matcher.matches(segment["terminology"])):
+                continue
+            found_segments.append((path, segment))
+    finally:
+        connection.close()
+    return found_segments
+
+
+def find_files(index_filename, name=None, terminology=None):
+    """Get list of indexed segmentation files that contain a segment with the specified name and/or terminology.
+    See `find_segments` for details.
+    """
+    found_files = []
+    for path, segment in find_segments(index_filename, name, terminology):
+        if not found_files or found_files[-1] != path:
+            found_files.append(path)
+    return found_files
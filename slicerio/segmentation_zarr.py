@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+
+"""Chunked storage of segmentations in Zarr format.
+
+The voxel array is split into chunks that are compressed independently, therefore chunks can be read and written
+in parallel, and a region of the segmentation can be read without decompressing the rest of the voxels.
+Chunks that contain only background (zero) voxels are not stored at all.
+
+The store is written in Zarr version 2 format (https://zarr-specs.readthedocs.io/en/latest/v2/v2.0.html)
+without requiring the zarr package. The store is a directory (`path/to/Segmentation.zarr`) or a zip file
+(`path/to/Segmentation.zarr.zip`), which can be opened by zarr, tensorstore, etc. Segmentation metadata
+(everything except the voxels) is stored in the array attributes, in the same format as `read_segmentation` returns it.
+"""
+
+# Default shape of voxel array chunks
+DEFAULT_CHUNK_SHAPE = (128, 128, 128)
+
+
+def is_zarr_store(path):
+    """Check if the path is a segmentation Zarr store (directory or zip file)."""
+    import os
+    import zipfile
+
+    path = os.fspath(path)
+    if os.path.isdir(path):
+        return os.path.exists(os.path.join(path, ".zarray"))
+    if path.lower().endswith(".zip") and zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as zip_file:
+            return ".zarray" in zip_file.namelist()
+    return False
+
+
+def write_segmentation_zarr(path, segmentation, chunk_shape=None, compression_level=5, threads=None):
+    """Write segmentation to a Zarr store.
+
+    :param path: output directory path, or zip file path (if ends with .zip). Existing store at this path is replaced.
+    :param segmentation: segmentation metadata and voxels (or segmentation in sparse representation)
+    :param chunk_shape: size of chunks along the i, j, k axes. Default is `DEFAULT_CHUNK_SHAPE`.
+        For segmentations with multiple layers, each chunk contains all the layers.
+    :param compression_level: zlib compression level (1 = fastest, 9 = smallest file)
+    :param threads: number of threads used for compressing and writing chunks. If None then the number of CPUs is used.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from collections import deque
+    import json
+    import os
+    import shutil
+    import zipfile
+    import zlib
+    import numpy as np
+    from .segmentation import _is_sparse, dense_segmentation
+
+    path = os.fspath(path)
+    if _is_sparse(segmentation):
+        segmentation = dense_segmentation(segmentation)
+    voxels = segmentation["voxels"]
+    if voxels is None:
+        raise ValueError("Segmentation does not contain voxels")
+    if voxels.ndim not in [3, 4]:
+        raise ValueError("Unsupported number of dimensions: " + str(voxels.ndim))
+    if chunk_shape is None:
+        chunk_shape = DEFAULT_CHUNK_SHAPE
+    chunk_shape = [int(size) for size in chunk_shape]
+    if len(chunk_shape) != 3 or min(chunk_shape) < 1:
+        raise ValueError("Chunk shape must contain 3 positive values")
+    if threads is None:
+        threads = os.cpu_count() or 1
+
+    layers = voxels.shape[:-3]
+    array_chunk_shape = list(layers) + chunk_shape
+    array_metadata = {
+        "zarr_format": 2,
+        "shape": list(voxels.shape),
+        "chunks": array_chunk_shape,
+        "dtype": voxels.dtype.str,
+        "compressor": {"id": "zlib", "level": compression_level},
+        "fill_value": 0,
+        "order": "F",
+        "filters": None,
+        "dimension_separator": ".",
+    }
+    attributes = {key: value for key, value in segmentation.items() if key != "voxels"}
+
+    def compress_chunk(chunk_index):
+        """Get compressed chunk data (None if the chunk only contains background)."""
+        region = tuple(slice(chunk_index[axis] * chunk_shape[axis], (chunk_index[axis] + 1) * chunk_shape[axis]) for axis in range(3))
+        chunk_voxels = voxels[(Ellipsis,) + region]
+        if not chunk_voxels.any():
+            return None
+        # Edge chunks are padded to the full chunk size
+        chunk = np.zeros(array_chunk_shape, dtype=voxels.dtype, order="F")
+        chunk[(Ellipsis,) + tuple(slice(0, size) for size in chunk_voxels.shape[-3:])] = chunk_voxels
+        return zlib.compress(memoryview(chunk.T).cast("B"), compression_level)
+
+    def chunk_key(chunk_index):
+        return ".".join(["0"] * len(layers) + [str(index) for index in chunk_index])
+
+    chunk_counts = [-(-voxels.shape[-3 + axis] // chunk_shape[axis]) for axis in range(3)]
+    chunk_indices = np.ndindex(*chunk_counts)
+
+    if path.lower().endswith(".zip"):
+        with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_STORED, allowZip64=True) as zip_file:
+            zip_file.writestr(".zarray", json.dumps(array_metadata, indent=2))
+            zip_file.writestr(".zattrs", json.dumps(attributes, indent=2, default=_json_value))
+            # Chunks are compressed in parallel and written into the zip file in the main thread
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                pending = deque()
+                for chunk_index in chunk_indices:
+                    pending.append((chunk_index, executor.submit(compress_chunk, chunk_index)))
+                    while pending and (len(pending) > 2 * threads or pending[0][1].done()):
+                        chunk_index, compressed_chunk = pending.popleft()
+                        if compressed_chunk.result() is not None:
+                            zip_file.writestr(chunk_key(chunk_index), compressed_chunk.result())
+                while pending:
+                    chunk_index, compressed_chunk = pending.popleft()
+                    if compressed_chunk.result() is not None:
+                        zip_file.writestr(chunk_key(chunk_index), compressed_chunk.result())
+        return
+
+    if os.path.exists(path):
+        if not is_zarr_store(path):
+            raise ValueError(f"Output path exists and it is not a Zarr store: {path}")
+        shutil.rmtree(path)
+    os.makedirs(path)
+    with open(os.path.join(path, ".zarray"), "w") as f:
+        json.dump(array_metadata, f, indent=2)
+    with open(os.path.join(path, ".zattrs"), "w") as f:
+        json.dump(attributes, f, indent=2, default=_json_value)
+
+    def write_chunk(chunk_index):
+        compressed_chunk = compress_chunk(chunk_index)
+        if compressed_chunk is not None:
+            with open(os.path.join(path, chunk_key(chunk_index)), "wb") as f:
+                f.write(compressed_chunk)
+
+    # Each chunk is stored in a separate file, therefore chunks can be compressed and written concurrently
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for _ in executor.map(write_chunk, chunk_indices):
+            pass
+
+
+def read_segmentation_zarr(path, skip_voxels=False, crop_to_segments=None, threads=None):
+    """Read segmentation from a Zarr store.
+
+    :param path: directory path or zip file path of the store
+    :param skip_voxels: if True then only the metadata is read, "voxels" is set to None
+    :param crop_to_segments: list of segment names, terminology dicts, or `TerminologyMatcher` objects. If specified then
+        the voxel array is cropped to the union of the extents of these segments. Only the chunks that intersect with the cropped region are read.
+        "ijkToLPS", "referenceImageExtentOffset" and extent of the segments are updated to match the cropped voxel array.
+    :param threads: number of threads used for reading and decompressing chunks. If None then the number of CPUs is used.
+    :return: segmentation, in the same format as `read_segmentation` returns it
+    """
+    from collections import OrderedDict
+    from concurrent.futures import ThreadPoolExecutor
+    import json
+    import os
+    import zipfile
+    import zlib
+    import numpy as np
+    from .segmentation import _crop_segmentation_metadata, _isValidExtent
+
+    path = os.fspath(path)
+    zip_file = zipfile.ZipFile(path) if not os.path.isdir(path) else None
+    try:
+        def read_key(key):
+            """Get content of the key, None if the key does not exist (chunk only contains fill value)."""
+            if zip_file is not None:
+                try:
+                    return zip_file.read(key)
+                except KeyError:
+                    return None
+            try:
+                with open(os.path.join(path, key), "rb") as f:
+                    return f.read()
+            except FileNotFoundError:
+                return None
+
+        array_metadata = json.loads(read_key(".zarray"))
+        attributes = json.loads(read_key(".zattrs") or b"{}", object_pairs_hook=OrderedDict)
+        if array_metadata.get("zarr_format") != 2:
+            raise IOError("Only Zarr format version 2 is supported")
+        compressor = array_metadata.get("compressor")
+        if array_metadata.get("filters") or (compressor is not None and compressor.get("id") not in ["zlib", "gzip"]):
+            raise IOError(f"Unsupported Zarr compressor or filters: {compressor}, {array_metadata.get('filters')}")
+        shape = array_metadata["shape"]
+        array_chunk_shape = array_metadata["chunks"]
+        if len(shape) not in [3, 4] or (len(shape) == 4 and array_chunk_shape[0] != shape[0]):
+            raise IOError("Voxel array must be 3D or 4D (with all layers in each chunk)")
+        dtype = np.dtype(array_metadata["dtype"])
+        order = array_metadata.get("order", "C")
+        separator = array_metadata.get("dimension_separator", ".")
+        fill_value = array_metadata.get("fill_value") or 0
+
+        segmentation = OrderedDict(attributes)
+        segmentation["ijkToLPS"] = np.array(attributes.get("ijkToLPS", np.eye(4)), dtype=float)
+        segmentation["voxels"] = None
+        segmentation.setdefault("segments", [])
+
+        region = [0, shape[-3]-1, 0, shape[-2]-1, 0, shape[-1]-1]
+        if crop_to_segments is not None:
+            region = _crop_segmentation_metadata(segmentation, shape[-3:], crop_to_segments)
+        if skip_voxels:
+            return segmentation
+
+        layers = shape[:-3]
+        chunk_shape = array_chunk_shape[-3:]
+        if not _isValidExtent(region):
+            segmentation["voxels"] = np.zeros(layers + [0, 0, 0], dtype=dtype, order="F")
+            return segmentation
+        voxels = np.full(layers + [region[axis*2+1] - region[axis*2] + 1 for axis in range(3)], fill_value, dtype=dtype, order="F")
+        first_chunk = [region[axis*2] // chunk_shape[axis] for axis in range(3)]
+        last_chunk = [region[axis*2+1] // chunk_shape[axis] for axis in range(3)]
+
+        def read_chunk(chunk_index):
+            key = separator.join(["0"] * len(layers) + [str(index) for index in chunk_index])
+            data = read_key(key)
+            if data is None:
+                return
+            if compressor is not None:
+                data = zlib.decompress(data, zlib.MAX_WBITS | 32)  # zlib or gzip stream
+            chunk = np.frombuffer(data, dtype=dtype).reshape(array_chunk_shape, order=order)
+            # Copy the part of the chunk that is in the region
+            chunk_start = [chunk_index[axis] * chunk_shape[axis] for axis in range(3)]
+            source = []
+            target = []
+            for axis in range(3):
+                start = max(region[axis*2], chunk_start[axis])
+                stop = min(region[axis*2+1] + 1, chunk_start[axis] + chunk_shape[axis])
+                source.append(slice(start - chunk_start[axis], stop - chunk_start[axis]))
+                target.append(slice(start - region[axis*2], stop - region[axis*2]))
+            voxels[(Ellipsis,) + tuple(target)] = chunk[(Ellipsis,) + tuple(source)]
+
+        if threads is None:
+            threads = os.cpu_count() or 1
+        chunk_indices = [tuple(first_chunk[axis] + index[axis] for axis in range(3))
+            for index in np.ndindex(*[last_chunk[axis] - first_chunk[axis] + 1 for axis in range(3)])]
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            for _ in executor.map(read_chunk, chunk_indices):
+                pass
+        segmentation["voxels"] = voxels
+        return segmentation
+    finally:
+        if zip_file is not None:
+            zip_file.close()
+
+
+def _json_value(value):
+    """Convert numpy values to types that can be written to JSON."""
+    return value.tolist()
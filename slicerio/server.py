@@ -7,45 +7,595 @@ import requests
 # It can be modified before starting the server if the default port number is not desirable.
 SERVER_PORT = 2016
 
+
+class BatchRequestError(RuntimeError):
+    """Raised by batch requests after all the requests are completed, if any of them failed.
+
+    :ivar results: dict of results of successful requests, keyed by input
+    :ivar errors: dict of exceptions of failed requests, keyed by input
+    """
+
+    def __init__(self, results, errors):
+        self.results = results
+        self.errors = errors
+        message = f"{len(errors)} of {len(results) + len(errors)} requests failed: "
+        message += "; ".join(f"{key}: {error}" for key, error in list(errors.items())[:5])
+        if len(errors) > 5:
+            message += "; ..."
+        super().__init__(message)
+
+
+class SlicerClient:
+    """Client for the Slicer web server API.
+
+    All requests are sent using the same HTTP session, which keeps connections to the server alive,
+    therefore issuing many requests (e.g., node queries) does not require opening a new connection for each request.
+
+    Example:
+
+        with slicerio.server.SlicerClient(port=2016) as client:
+            for node_id in client.node_ids(class_name="vtkMRMLScalarVolumeNode"):
+                print(client.node_properties(id=node_id))
+
+    :param host: host name or IP address of the Slicer web server
+    :param port: port number of the Slicer web server. If None then `SERVER_PORT` is used.
+    :param timeout: request timeout in seconds, or (connect timeout, read timeout) tuple. None means no timeout.
+    :param pool_size: maximum number of connections kept alive (relevant if the client is used from multiple threads)
+    """
+
+    def __init__(self, host="127.0.0.1", port=None, timeout=None, pool_size=10):
+        self.host = host
+        self.port = port if port is not None else SERVER_PORT
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Close all connections of the client."""
+        self.session.close()
+
+    @property
+    def url(self):
+        """Base URL of the server."""
+        return f"http://{self.host}:{self.port}"
+
+    def _request(self, method, path, query=None, timeout=None, data=None):
+        api_url = self.url + path
+        if query:
+            api_url += "?" + query
+        return self.session.request(method, api_url, data=data, timeout=timeout if timeout is not None else self.timeout)
+
+    def start_server(self, slicer_executable=None, timeoutSec=60):
+        """Starts Slicer server at the client's port and waits until it responds.
+        Requires slicer_executable argument or `SLICER_EXECUTABLE` environment variable to be set to a Slicer executable (version 5.2 or later).
+        :param slicer_executable: Slicer application main executable.
+        """
+        import os
+        import subprocess
+        if not slicer_executable:
+            if 'SLICER_EXECUTABLE' not in os.environ:
+                raise ValueError('SLICER_EXECUTABLE environment variable is not specified')
+            slicer_executable = os.environ['SLICER_EXECUTABLE']
+        p = subprocess.Popen([slicer_executable, "--python-code", f"wslogic = getModuleLogic('WebServer'); wslogic.port={self.port}; wslogic.addDefaultRequestHandlers(); wslogic.start()"])
+        self.wait_for_server(timeoutSec)
+        return p
+
+    def wait_for_server(self, timeoutSec=60, initial_interval=0.05, max_interval=1.0):
+        """Wait until the server responds.
+        The server is polled with exponentially increasing intervals, so that a server that starts quickly is found
+        without delay, while a slowly starting application is not flooded with requests.
+        :param timeoutSec: maximum waiting time in seconds
+        :param initial_interval: waiting time before the second poll, in seconds
+        :param max_interval: maximum waiting time between polls, in seconds
+        """
+        import time
+        deadline = time.monotonic() + timeoutSec
+        interval = initial_interval
+        while not self.is_server_running():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise requests.exceptions.ConnectTimeout("Timeout while waiting for application to start")
+            time.sleep(min(interval, remaining))
+            interval = min(interval * 2, max_interval)
+
+    def stop_server(self):
+        """Stop Slicer server.
+        """
+        response = self._request("DELETE", "/system")
+        return response.json()
+
+    def is_server_running(self):
+        """Check if Slicer server is running.
+        Returns true if a responsive Slicer instance is found with Web Server and Slicer API enabled.
+        """
+        try:
+            response = self._request("GET", "/slicer/system/version", timeout=3)
+            if 'applicationName' in response.json():
+                # Found a responsive Slicer
+                return True
+        except Exception as e:
+            logging.debug("Application is not available: "+str(e))
+        return False
+
+    def node_remove(self, name=None, id=None, class_name=None):
+        """Remove data nodes from the Slicer server.
+        Nodes can be selected using name, id, and/or class_name.
+        """
+        response = self._request("DELETE", "/slicer/mrml", _node_query_parameters(name, id, class_name))
+        _report_error(response)
+
+    def node_reload(self, name=None, id=None, class_name=None):
+        """Reload the node from that file it was originally loaded from.
+        This can be used for updating a node that was loaded using `file_load()`,
+        to prevent proliferation of displayed nodes.
+        Nodes can be selected using name, id, and/or class_name.
+        """
+        response = self._request("PUT", "/slicer/mrml", _node_query_parameters(name, id, class_name))
+        _report_error(response)
+
+    def node_properties(self, name=None, id=None, class_name=None):
+        """Get properties of data nodes on the Slicer server.
+        Nodes can be selected using name, id, and/or class_name.
+        """
+        response = self._request("GET", "/slicer/mrml/properties", _node_query_parameters(name, id, class_name))
+        _report_error(response)
+        response_json = response.json()
+        properties = [response_json[key] for key in response_json]
+        return properties
+
+    def node_ids(self, name=None, id=None, class_name=None):
+        """Get list of ids of nodes availalbe on the Slicer server.
+        Nodes can be selected using name, id, and/or class_name.
+        """
+        response = self._request("GET", "/slicer/mrml/ids", _node_query_parameters(name, id, class_name))
+        _report_error(response)
+        return response.json()
+
+    def node_names(self, name=None, id=None, class_name=None):
+        """Get list of names of nodes availalbe on the Slicer server.
+        Nodes can be selected using name, id, and/or class_name.
+        """
+        response = self._request("GET", "/slicer/mrml/names", _node_query_parameters(name, id, class_name))
+        _report_error(response)
+        return response.json()
+
+    def file_save(self, file_path, name=None, id=None, class_name=None, properties=None):
+        """Save node into file on the Slicer server.
+        :param path: local filename or URL of the file to write
+        :param properties: dictionary of additional properties. For example, `useCompression` specifies if the written file will be compressed.
+        """
+        response = self._request("GET", "/slicer/mrml/file", _file_save_query_parameters(file_path, name, id, properties))
+        _report_error(response)
+
+    def file_load(self, file_path, file_type=None, properties=None, auto_start=True, timeout_sec=60, slicer_executable=None):
+        """Load a file into the Slicer server.
+        See `slicerio.server.file_load` for description of the parameters.
+        :return: list of loaded node IDs (they can be used in further queries).
+        """
+        api_path, query = _file_load_request(file_path, file_type, properties)
+
+        retry_after_starting_server = True
+        try:
+            response = self._request("POST", api_path, query)
+            retry_after_starting_server = False
+        except requests.exceptions.ConnectionError as e:
+            if not auto_start:
+                raise
+
+        if retry_after_starting_server:
+            # Try again, with starting a server first
+            server_process = self.start_server(slicer_executable, timeout_sec)
+            response = self._request("POST", api_path, query)
+
+        _report_error(response)
+
+        response_json = response.json()
+        return response_json["loadedNodeIDs"] if "loadedNodeIDs" in response_json else []
+
+    def _run_batch(self, function, queries, max_workers):
+        """Call function for each query concurrently and collect results and errors, keyed by the input.
+        :param queries: list of queries or dict of key -> query. Queries in a list are used as keys,
+            dict queries are keyed by the tuple of their sorted items (e.g., `(("class_name", "vtkMRMLScalarVolumeNode"),)`).
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        if not isinstance(queries, dict):
+            queries = {(tuple(sorted(query.items())) if isinstance(query, dict) else query): query for query in queries}
+        results = {}
+        errors = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {key: executor.submit(function, query) for key, query in queries.items()}
+            for key, future in futures.items():
+                try:
+                    results[key] = future.result()
+                except Exception as e:
+                    errors[key] = e
+        if errors:
+            raise BatchRequestError(results, errors)
+        return results
+
+    def node_properties_batch(self, queries, max_workers=4):
+        """Get properties of data nodes for many node queries, using concurrent requests over the persistent connections.
+        :param queries: list of node names or dicts of filters (`name`, `id`, `class_name`),
+            or dict of key -> node name or dict of filters.
+        :param max_workers: maximum number of requests sent concurrently. It should not exceed `pool_size` of the client.
+        :return: dict of list of node properties, keyed by the keys of the queries dict. If queries is a list then
+            results are keyed by the node names, or by the tuple of sorted items of the filter dicts
+            (e.g., `(("class_name", "vtkMRMLScalarVolumeNode"), ("name", "MRHead"))`).
+        :raises BatchRequestError: if any of the queries failed (after all the queries are completed)
+        """
+        return self._run_batch(lambda query: self.node_properties(**_node_filter(query)), queries, max_workers)
+
+    def node_ids_batch(self, queries, max_workers=4):
+        """Get list of node ids for many node queries. See `node_properties_batch` for description of the parameters."""
+        return self._run_batch(lambda query: self.node_ids(**_node_filter(query)), queries, max_workers)
+
+    def node_names_batch(self, queries, max_workers=4):
+        """Get list of node names for many node queries. See `node_properties_batch` for description of the parameters."""
+        return self._run_batch(lambda query: self.node_names(**_node_filter(query)), queries, max_workers)
+
+    def file_load_batch(self, file_paths, file_type=None, properties=None, auto_start=True, timeout_sec=60, slicer_executable=None, max_workers=4):
+        """Load many files into the Slicer server, using concurrent requests over the persistent connections.
+        If `auto_start` is enabled and the server is not running then the server is started once, before loading the files.
+        See `file_load` for description of the other parameters.
+        :param file_paths: list of file paths or URLs, or dict of key -> file path
+        :param max_workers: maximum number of requests sent concurrently. It should not exceed `pool_size` of the client.
+        :return: dict of list of loaded node IDs, keyed by the file paths (or keys of the file_paths dict)
+        :raises BatchRequestError: if any of the files failed to load (after all the files are processed)
+        """
+        if auto_start and not self.is_server_running():
+            self.start_server(slicer_executable, timeout_sec)
+        return self._run_batch(lambda file_path: self.file_load(file_path, file_type, properties, auto_start=False),
+            file_paths, max_workers)
+
+    def volume_send(self, volume, name="VolumeNode"):
+        """Send a voxel array to the Slicer server, without writing it to a file.
+        Voxels are sent as an uncompressed NRRD request body. If a volume node with the same name exists then
+        its content is replaced, otherwise a new scalar volume node is created.
+        :param volume: dict containing "voxels" and "ijkToLPS" (such as a segmentation returned by `read_segmentation`),
+            or a 3D numpy array. Segmentations with multiple layers are merged into a single labelmap (segments that are
+            listed later overwrite the earlier ones). Voxel values must be integers in the range of a 16-bit signed integer,
+            as the Slicer web server only accepts `short` volumes.
+        :param name: name of the volume node
+        """
+        import urllib
+        response = self._request("POST", "/slicer/volume", f"id={urllib.request.quote(name, safe='')}", data=_NrrdRequestBody(volume))
+        _report_error(response)
+        if response.content and response.json().get("status") == "failed":
+            raise RuntimeError(f"Failed to send volume {name}")
+
+    def volume_receive(self, name=None, id=None):
+        """Get voxels of a volume node from the Slicer server, without writing it to a file.
+        Only `short` (16-bit signed integer) volumes can be retrieved using the Slicer web server.
+        :param name: name of the volume node
+        :param id: id of the volume node. Used if name is not specified.
+        :return: dict containing "voxels" (numpy array) and "ijkToLPS"
+        """
+        import urllib
+        response = self._request("GET", "/slicer/volume", f"id={urllib.request.quote(name or id, safe='')}")
+        _report_error(response)
+        if not response.content:
+            raise RuntimeError(f"Volume {name or id} not found or it is not a short volume")
+        return _read_nrrd_response_body(response.content)
+
+
+class AsyncSlicerClient:
+    """Asynchronous (asyncio) client for the Slicer web server API.
+
+    Requests are sent using asyncio streams, therefore waiting for the server (e.g., while a large volume is loaded)
+    does not block the event loop. Connections are kept alive and reused. Number of concurrent requests
+    (and open connections) to the server is limited by `max_connections`.
+
+    Example:
+
+        async with slicerio.server.AsyncSlicerClient(port=2016) as client:
+            node_ids = await asyncio.gather(*[client.file_load(path) for path in paths])
+
+    :param host: host name or IP address of the Slicer web server
+    :param port: port number of the Slicer web server. If None then `SERVER_PORT` is used.
+    :param timeout: request timeout in seconds. None means no timeout.
+    :param max_connections: maximum number of requests that are sent to the server concurrently
+    """
+
+    def __init__(self, host="127.0.0.1", port=None, timeout=None, max_connections=4):
+        self.host = host
+        self.port = port if port is not None else SERVER_PORT
+        self.timeout = timeout
+        self.max_connections = max_connections
+        # Created when first used, to be bound to the running event loop
+        self._semaphore = None
+        self._idle_connections = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def close(self):
+        """Close all connections of the client."""
+        while self._idle_connections:
+            _, writer = self._idle_connections.pop()
+            writer.close()
+
+    async def _request(self, method, path, query=None, timeout=None, data=None):
+        import asyncio
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_connections)
+        target = path + "?" + query if query else path
+        async with self._semaphore:
+            return await asyncio.wait_for(self._send_request(method, target, data), timeout if timeout is not None else self.timeout)
+
+    async def _send_request(self, method, target, data=None):
+        """Send a request and read the response.
+        :param data: request body. It can be bytes or an object that has a length and can be iterated
+            multiple times (e.g., `_NrrdRequestBody`). Chunks are written directly to the connection.
+        """
+        import asyncio
+        if data is None:
+            data = b""
+        request = (f"{method} {target} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\n"
+            f"Accept: application/json\r\nContent-Length: {len(data)}\r\n\r\n").encode("latin-1")
+        while True:
+            reused = len(self._idle_connections) > 0
+            if reused:
+                reader, writer = self._idle_connections.pop()
+            else:
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+            try:
+                writer.write(request)
+                for chunk in ([data] if isinstance(data, bytes) else data):
+                    writer.write(chunk)
+                    await writer.drain()
+                status_line = await reader.readline()
+                if not status_line:
+                    raise ConnectionResetError("Connection closed by the server")
+                response = await _read_http_response(status_line, reader)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                if reused:
+                    # The server closed the idle connection, send the request again using a new connection
+                    continue
+                raise
+            except BaseException:
+                # Connection is in unknown state (e.g., request was cancelled due to timeout)
+                writer.close()
+                raise
+            if response.keep_alive:
+                self._idle_connections.append((reader, writer))
+            else:
+                writer.close()
+            return response
+
+    async def start_server(self, slicer_executable=None, timeoutSec=60):
+        """Starts Slicer server at the client's port and waits until it responds.
+        Requires slicer_executable argument or `SLICER_EXECUTABLE` environment variable to be set to a Slicer executable (version 5.2 or later).
+        :param slicer_executable: Slicer application main executable.
+        :return: `asyncio.subprocess.Process` of the started application
+        """
+        import asyncio
+        import os
+        if not slicer_executable:
+            if 'SLICER_EXECUTABLE' not in os.environ:
+                raise ValueError('SLICER_EXECUTABLE environment variable is not specified')
+            slicer_executable = os.environ['SLICER_EXECUTABLE']
+        p = await asyncio.create_subprocess_exec(slicer_executable, "--python-code", f"wslogic = getModuleLogic('WebServer'); wslogic.port={self.port}; wslogic.addDefaultRequestHandlers(); wslogic.start()")
+        await self.wait_for_server(timeoutSec)
+        return p
+
+    async def wait_for_server(self, timeoutSec=60, initial_interval=0.05, max_interval=1.0):
+        """Wait until the server responds, polling with exponentially increasing intervals.
+        See `SlicerClient.wait_for_server` for description of the parameters.
+        """
+        import asyncio
+        import time
+        deadline = time.monotonic() + timeoutSec
+        interval = initial_interval
+        while not await self.is_server_running():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise requests.exceptions.ConnectTimeout("Timeout while waiting for application to start")
+            await asyncio.sleep(min(interval, remaining))
+            interval = min(interval * 2, max_interval)
+
+    async def stop_server(self):
+        """Stop Slicer server.
+        """
+        response = await self._request("DELETE", "/system")
+        return response.json()
+
+    async def is_server_running(self):
+        """Check if Slicer server is running.
+        Returns true if a responsive Slicer instance is found with Web Server and Slicer API enabled.
+        """
+        try:
+            response = await self._request("GET", "/slicer/system/version", timeout=3)
+            if 'applicationName' in response.json():
+                # Found a responsive Slicer
+                return True
+        except Exception as e:
+            logging.debug("Application is not available: "+str(e))
+        return False
+
+    async def node_remove(self, name=None, id=None, class_name=None):
+        """Remove data nodes from the Slicer server.
+        Nodes can be selected using name, id, and/or class_name.
+        """
+        response = await self._request("DELETE", "/slicer/mrml", _node_query_parameters(name, id, class_name))
+        _report_error(response)
+
+    async def node_reload(self, name=None, id=None, class_name=None):
+        """Reload the node from that file it was originally loaded from.
+        Nodes can be selected using name, id, and/or class_name.
+        """
+        response = await self._request("PUT", "/slicer/mrml", _node_query_parameters(name, id, class_name))
+        _report_error(response)
+
+    async def node_properties(self, name=None, id=None, class_name=None):
+        """Get properties of data nodes on the Slicer server.
+        Nodes can be selected using name, id, and/or class_name.
+        """
+        response = await self._request("GET", "/slicer/mrml/properties", _node_query_parameters(name, id, class_name))
+        _report_error(response)
+        response_json = response.json()
+        return [response_json[key] for key in response_json]
+
+    async def node_ids(self, name=None, id=None, class_name=None):
+        """Get list of ids of nodes availalbe on the Slicer server.
+        Nodes can be selected using name, id, and/or class_name.
+        """
+        response = await self._request("GET", "/slicer/mrml/ids", _node_query_parameters(name, id, class_name))
+        _report_error(response)
+        return response.json()
+
+    async def node_names(self, name=None, id=None, class_name=None):
+        """Get list of names of nodes availalbe on the Slicer server.
+        Nodes can be selected using name, id, and/or class_name.
+        """
+        response = await self._request("GET", "/slicer/mrml/names", _node_query_parameters(name, id, class_name))
+        _report_error(response)
+        return response.json()
+
+    async def file_save(self, file_path, name=None, id=None, class_name=None, properties=None):
+        """Save node into file on the Slicer server.
+        See `slicerio.server.file_save` for description of the parameters.
+        """
+        response = await self._request("GET", "/slicer/mrml/file", _file_save_query_parameters(file_path, name, id, properties))
+        _report_error(response)
+
+    async def file_load(self, file_path, file_type=None, properties=None, auto_start=True, timeout_sec=60, slicer_executable=None):
+        """Load a file into the Slicer server.
+        See `slicerio.server.file_load` for description of the parameters.
+        :return: list of loaded node IDs (they can be used in further queries).
+        """
+        api_path, query = _file_load_request(file_path, file_type, properties)
+        try:
+            response = await self._request("POST", api_path, query)
+        except ConnectionRefusedError:
+            # Only start a server if there is no server at the port. Other errors (e.g., timeout) are reported,
+            # because the request may have been already processed by the server.
+            if not auto_start:
+                raise
+            # Try again, with starting a server first
+            await self.start_server(slicer_executable, timeout_sec)
+            response = await self._request("POST", api_path, query)
+
+        _report_error(response)
+
+        response_json = response.json()
+        return response_json["loadedNodeIDs"] if "loadedNodeIDs" in response_json else []
+
+    async def volume_send(self, volume, name="VolumeNode"):
+        """Send a voxel array to the Slicer server, without writing it to a file.
+        See `SlicerClient.volume_send` for description of the parameters.
+        """
+        import urllib
+        response = await self._request("POST", "/slicer/volume", f"id={urllib.request.quote(name, safe='')}", data=_NrrdRequestBody(volume))
+        _report_error(response)
+        if response.content and response.json().get("status") == "failed":
+            raise RuntimeError(f"Failed to send volume {name}")
+
+    async def volume_receive(self, name=None, id=None):
+        """Get voxels of a volume node from the Slicer server, without writing it to a file.
+        See `SlicerClient.volume_receive` for description of the parameters.
+        :return: dict containing "voxels" (numpy array) and "ijkToLPS"
+        """
+        import urllib
+        response = await self._request("GET", "/slicer/volume", f"id={urllib.request.quote(name or id, safe='')}")
+        _report_error(response)
+        if not response.content:
+            raise RuntimeError(f"Volume {name or id} not found or it is not a short volume")
+        return _read_nrrd_response_body(response.content)
+
+
+class _HttpResponse:
+    """HTTP response received by `AsyncSlicerClient`, providing the same attributes as `requests.Response` that are used in this module."""
+
+    def __init__(self, status_code, headers, content, keep_alive):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.keep_alive = keep_alive
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    def json(self):
+        import json
+        return json.loads(self.content)
+
+
+async def _read_http_response(status_line, reader):
+    """Read HTTP response headers and body from an asyncio stream reader."""
+    version, status_code = status_line.decode("latin-1").split(None, 2)[:2]
+    headers = requests.structures.CaseInsensitiveDict()
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        key, _, value = line.decode("latin-1").partition(":")
+        headers[key.strip()] = value.strip()
+
+    connection = headers.get("Connection", "").lower()
+    keep_alive = connection == "keep-alive" or (version != "HTTP/1.0" and connection != "close")
+    if headers.get("Transfer-Encoding", "").lower() == "chunked":
+        chunks = []
+        while True:
+            chunk_size = int((await reader.readline()).split(b";")[0], 16)
+            if chunk_size == 0:
+                # Skip trailer
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                break
+            chunks.append(await reader.readexactly(chunk_size))
+            await reader.readexactly(2)
+        content = b"".join(chunks)
+    elif "Content-Length" in headers:
+        content = await reader.readexactly(int(headers["Content-Length"]))
+    else:
+        # Body ends when the server closes the connection
+        content = await reader.read()
+        keep_alive = False
+    return _HttpResponse(int(status_code), headers, content, keep_alive)
+
+
+# Client used by the module-level functions. It is created when first needed and
+# replaced if `SERVER_PORT` is changed.
+_default_client = None
+
+
+def _get_default_client():
+    global _default_client
+    if _default_client is None or _default_client.port != SERVER_PORT:
+        if _default_client is not None:
+            _default_client.close()
+        _default_client = SlicerClient()
+    return _default_client
+
 def start_server(slicer_executable=None, timeoutSec=60):
     """Starts local Slicer server.
     Requires slicer_executable argument or `SLICER_EXECUTABLE` environment variable to be set to a Slicer executable (version 5.2 or later).
     :param slicer_executable: Slicer application main executable.
     """
-    import os
-    import subprocess
-    import time
-    if not slicer_executable:
-        if 'SLICER_EXECUTABLE' not in os.environ:
-            raise ValueError('SLICER_EXECUTABLE environment variable is not specified')
-        slicer_executable = os.environ['SLICER_EXECUTABLE']
-    p = subprocess.Popen([slicer_executable, "--python-code", f"wslogic = getModuleLogic('WebServer'); wslogic.port={SERVER_PORT}; wslogic.addDefaultRequestHandlers(); wslogic.start()"])
-    start = time.time()
-    connected = False
-    while not connected:
-        connected = is_server_running()
-        if time.time() - start > timeoutSec:
-            raise requests.exceptions.ConnectTimeout("Timeout while waiting for application to start")
-    return p
+    return _get_default_client().start_server(slicer_executable, timeoutSec)
 
 def stop_server():
     """Stop local Slicer server.
     """
-    response = requests.delete(f"http://127.0.0.1:{SERVER_PORT}/system")
-    return response.json()
+    return _get_default_client().stop_server()
 
 def is_server_running():
     """Check if a local Slicer server is running.
     Returns true if a responsive Slicer instance is found with Web Server and Slicer API enabled.
     """
-    try:
-        response = requests.get(f"http://127.0.0.1:{SERVER_PORT}/slicer/system/version", timeout=3)
-        if 'applicationName' in response.json():
-            # Found a responsive Slicer
-            return True
-    except Exception as e:
-        logging.debug("Application is not available: "+str(e))
-    return False
+    return _get_default_client().is_server_running()
 
 def _node_query_parameters(name, id, class_name):
     param_list = []
@@ -58,6 +608,130 @@ def _node_query_parameters(name, id, class_name):
         param_list.append(f"class={urllib.request.quote(class_name, safe='')}")
     return '&'.join(param_list)
 
+def _node_filter(query):
+    """Get node selection keyword arguments from a node name or dict of filters."""
+    if isinstance(query, str):
+        return {"name": query}
+    return query
+
+def _properties_query_parameters(properties):
+    """Get query string (with leading &) that specifies the properties."""
+    import urllib
+    query = ""
+    if properties:
+        for key in properties:
+            url_encoded_key = urllib.request.quote(key.encode(), safe='')
+            url_encoded_value = urllib.request.quote(str(properties[key]).encode(), safe='')
+            query += f"&{url_encoded_key}={url_encoded_value}"
+    return query
+
+def _file_save_query_parameters(file_path, name, id, properties):
+    import urllib
+
+    if file_path is not None:
+        file_path = str(file_path)
+
+    url_encoded_path = urllib.request.quote(file_path, safe='')
+    query = f"localfile={url_encoded_path}"
+    node_query = _node_query_parameters(name, id, "")
+    if node_query:
+        query += "&" + node_query
+    return query + _properties_query_parameters(properties)
+
+def _file_load_request(file_path, file_type, properties):
+    """Get API path and query string for loading a file."""
+    import urllib
+
+    if file_path is not None:
+        file_path = str(file_path)
+
+    if file_type is None:
+        file_type = "VolumeFile"
+    p = urllib.parse.urlparse(file_path)
+    if p.scheme == 'slicer':
+        # Slicer URL - use it as is. For example:
+        # slicer://viewer/?studyUID=1.2.826.0.1.3680043.8.498.77209180964150541470378654317482622226&dicomweb_endpoint=http%3A%2F%2F130.15.7.119:2016%2Fdicom&bulk_retrieve=0
+        url_encoded_path = urllib.request.quote(file_path, safe='')
+        return "/slicer/open", f"url={url_encoded_path}"
+    # Local file path or remote download path
+    path_type = 'url' if p.scheme in ['http', 'https'] else 'localfile'
+    url_encoded_path = urllib.request.quote(file_path, safe='')
+    return "/slicer/mrml", f"{path_type}={url_encoded_path}&filetype={file_type}" + _properties_query_parameters(properties)
+
+class _NrrdRequestBody:
+    """Uncompressed NRRD file content, in the format that the Slicer web server accepts (3D, short, little endian, raw).
+
+    Iterating yields the header and then the voxel data in chunks, so that the request body can be streamed
+    without creating a copy of the whole volume in memory. Length of the content is known in advance,
+    therefore it can be sent with a Content-Length header.
+    """
+
+    # Maximum size of a chunk of voxel data, in bytes
+    CHUNK_SIZE = 2**22
+
+    def __init__(self, volume):
+        import numpy as np
+        from .segmentation import _is_sparse, _merge_layers
+
+        if isinstance(volume, dict):
+            if _is_sparse(volume) or volume["voxels"].ndim == 4:
+                volume = _merge_layers(volume)
+            voxels = volume["voxels"]
+            ijkToLPS = np.array(volume.get("ijkToLPS", np.eye(4)), dtype=float)
+        else:
+            voxels = np.asarray(volume)
+            ijkToLPS = np.eye(4)
+        if voxels.ndim != 3:
+            raise ValueError("Voxel array must be 3D")
+        if voxels.dtype.kind not in "iub":
+            raise ValueError("Voxel values must be integers")
+        if voxels.size and (voxels.min() < -32768 or voxels.max() > 32767):
+            raise ValueError("Voxel values must be in the range of 16-bit signed integer")
+
+        space_directions = " ".join("(" + ",".join(repr(float(value)) for value in ijkToLPS[0:3, axis]) + ")" for axis in range(3))
+        space_origin = "(" + ",".join(repr(float(value)) for value in ijkToLPS[0:3, 3]) + ")"
+        self.header = ("NRRD0004\n"
+            "type: short\n"
+            "dimension: 3\n"
+            "space: left-posterior-superior\n"
+            f"sizes: {voxels.shape[0]} {voxels.shape[1]} {voxels.shape[2]}\n"
+            f"space directions: {space_directions}\n"
+            "kinds: domain domain domain\n"
+            "endian: little\n"
+            "encoding: raw\n"
+            f"space origin: {space_origin}\n"
+            "\n").encode()
+        self.voxels = voxels
+
+    def __len__(self):
+        return len(self.header) + self.voxels.size * 2
+
+    def __iter__(self):
+        import numpy as np
+        yield self.header
+        slice_size = max(self.voxels.shape[0] * self.voxels.shape[1] * 2, 1)
+        slices_per_chunk = max(self.CHUNK_SIZE // slice_size, 1)
+        for k in range(0, self.voxels.shape[2], slices_per_chunk):
+            # Slabs of a Fortran-ordered little endian short array are used without making a copy
+            chunk = np.asfortranarray(self.voxels[:, :, k:k + slices_per_chunk], dtype="<i2")
+            yield memoryview(chunk.T).cast("B")
+
+def _read_nrrd_response_body(content):
+    """Get voxels and IJK to LPS matrix from uncompressed NRRD file content."""
+    import io
+    import nrrd
+    import numpy as np
+
+    fh = io.BytesIO(content)
+    header = nrrd.read_header(fh)
+    voxels = nrrd.read_data(header, fh)
+    ijkToLPS = np.eye(4)
+    ijkToLPS[0:3, 0:3] = np.array(header["space directions"], dtype=float).T
+    ijkToLPS[0:3, 3] = header["space origin"]
+    if header.get("space") in ["right-anterior-superior", "RAS"]:
+        ijkToLPS = np.diag([-1, -1, 1, 1]).dot(ijkToLPS)
+    return {"voxels": voxels, "ijkToLPS": ijkToLPS}
+
 def _report_error(response):
     if response.ok:
         return
@@ -70,12 +744,7 @@ def node_remove(name=None, id=None, class_name=None):
     """Remove data nodes from the local Slicer server.
     Nodes can be selected using name, id, and/or class_name.
     """
-    api_url = f"http://127.0.0.1:{SERVER_PORT}/slicer/mrml"
-    node_query = _node_query_parameters(name, id, class_name)
-    if node_query:
-        api_url += "?" + node_query
-    response = requests.delete(api_url)
-    _report_error(response)
+    _get_default_client().node_remove(name, id, class_name)
 
 def node_reload(name=None, id=None, class_name=None):
     """Reload the node from that file it was originally loaded from.
@@ -83,73 +752,32 @@ def node_reload(name=None, id=None, class_name=None):
     to prevent proliferation of displayed nodes.
     Nodes can be selected using name, id, and/or class_name.
     """
-    api_url = f"http://127.0.0.1:{SERVER_PORT}/slicer/mrml"
-    node_query = _node_query_parameters(name, id, class_name)
-    if node_query:
-        api_url += "?" + node_query
-    response = requests.put(api_url)
-    _report_error(response)
+    _get_default_client().node_reload(name, id, class_name)
 
 def node_properties(name=None, id=None, class_name=None):
     """Get properties of data nodes on the local Slicer server.
     Nodes can be selected using name, id, and/or class_name.
     """
-    api_url = f"http://127.0.0.1:{SERVER_PORT}/slicer/mrml/properties"
-    node_query = _node_query_parameters(name, id, class_name)
-    if node_query:
-        api_url += "?" + node_query
-    response = requests.get(api_url)
-    _report_error(response)
-    response_json = response.json()
-    properties = [response_json[key] for key in response_json]
-    return properties
+    return _get_default_client().node_properties(name, id, class_name)
 
 def node_ids(name=None, id=None, class_name=None):
     """Get list of ids of nodes availalbe on the local Slicer server.
     Nodes can be selected using name, id, and/or class_name.
     """
-    api_url = f"http://127.0.0.1:{SERVER_PORT}/slicer/mrml/ids"
-    node_query = _node_query_parameters(name, id, class_name)
-    if node_query:
-        api_url += "?" + node_query
-    response = requests.get(api_url)
-    _report_error(response)
-    return response.json()
+    return _get_default_client().node_ids(name, id, class_name)
 
 def node_names(name=None, id=None, class_name=None):
     """Get list of names of nodes availalbe on the local Slicer server.
     Nodes can be selected using name, id, and/or class_name.
     """
-    api_url = f"http://127.0.0.1:{SERVER_PORT}/slicer/mrml/names"
-    node_query = _node_query_parameters(name, id, class_name)
-    if node_query:
-        api_url += "?" + node_query
-    response = requests.get(api_url)
-    _report_error(response)
-    return response.json()
+    return _get_default_client().node_names(name, id, class_name)
 
 def file_save(file_path, name=None, id=None, class_name=None, properties=None):
     """Save node into file on the local Slicer server.
     :param path: local filename or URL of the file to write
     :param properties: dictionary of additional properties. For example, `useCompression` specifies if the written file will be compressed.
     """
-    import urllib
-
-    if file_path is not None:
-        file_path = str(file_path)
-
-    url_encoded_path = urllib.request.quote(file_path, safe='')
-    api_url = f"http://127.0.0.1:{SERVER_PORT}/slicer/mrml/file?localfile={url_encoded_path}"
-    node_query = _node_query_parameters(name, id, "")
-    if node_query:
-        api_url += "&" + node_query
-    if properties:
-        for key in properties:
-            url_encoded_key = urllib.request.quote(key.encode(), safe='')
-            url_encoded_value = urllib.request.quote(str(properties[key]).encode(), safe='')
-            api_url += f"&{url_encoded_key}={url_encoded_value}"
-    response = requests.get(api_url)
-    _report_error(response)
+    _get_default_client().file_save(file_path, name, id, class_name, properties)
 
 def file_load(file_path, file_type=None, properties=None, auto_start=True, timeout_sec=60, slicer_executable=None):
     """Load a file into the local Slicer server.
@@ -165,44 +793,41 @@ def file_load(file_path, file_type=None, properties=None, auto_start=True, timeo
     :param slicer_executable: Slicer application main executable. Used if `auto_start` is enabled.
     :return: list of loaded node IDs (they can be used in further queries).
     """
-    import urllib
+    return _get_default_client().file_load(file_path, file_type, properties, auto_start, timeout_sec, slicer_executable)
 
-    if file_path is not None:
-        file_path = str(file_path)
+def node_properties_batch(queries, max_workers=4):
+    """Get properties of data nodes for many node queries on the local Slicer server.
+    See `SlicerClient.node_properties_batch` for description of the parameters.
+    """
+    return _get_default_client().node_properties_batch(queries, max_workers)
 
-    if file_type is None:
-        file_type = "VolumeFile"
-    p = urllib.parse.urlparse(file_path)
-    if p.scheme == 'slicer':
-        # Slicer URL - use it as is. For example:
-        # slicer://viewer/?studyUID=1.2.826.0.1.3680043.8.498.77209180964150541470378654317482622226&dicomweb_endpoint=http%3A%2F%2F130.15.7.119:2016%2Fdicom&bulk_retrieve=0
-        url_encoded_path = urllib.request.quote(file_path, safe='')
-        api_url = f"http://127.0.0.1:{SERVER_PORT}/slicer/open?url={url_encoded_path}"
-    else:
-        # Local file path or remote download path
-        path_type = 'url' if p.scheme in ['http', 'https'] else 'localfile'
-        url_encoded_path = urllib.request.quote(file_path, safe='')
-        api_url = f"http://127.0.0.1:{SERVER_PORT}/slicer/mrml?{path_type}={url_encoded_path}&filetype={file_type}"
-        if properties:
-            for key in properties:
-                url_encoded_key = urllib.request.quote(key.encode(), safe='')
-                url_encoded_value = urllib.request.quote(str(properties[key]).encode(), safe='')
-                api_url += f"&{url_encoded_key}={url_encoded_value}"
-
-    retry_after_starting_server = True
-    try:
-        response = requests.post(api_url)
-        retry_after_starting_server = False
-    except requests.exceptions.ConnectionError as e:
-        if not auto_start:
-            raise
-
-    if retry_after_starting_server:
-        # Try again, with starting a server first
-        server_process = start_server(slicer_executable)
-        response = requests.post(api_url)
-
-    _report_error(response)
-
-    response_json = response.json()
-    return response_json["loadedNodeIDs"] if "loadedNodeIDs" in response_json else []
+def node_ids_batch(queries, max_workers=4):
+    """Get list of node ids for many node queries on the local Slicer server.
+    See `SlicerClient.node_properties_batch` for description of the parameters.
+    """
+    return _get_default_client().node_ids_batch(queries, max_workers)
+
+def node_names_batch(queries, max_workers=4):
+    """Get list of node names for many node queries on the local Slicer server.
+    See `SlicerClient.node_properties_batch` for description of the parameters.
+    """
+    return _get_default_client().node_names_batch(queries, max_workers)
+
+def file_load_batch(file_paths, file_type=None, properties=None, auto_start=True, timeout_sec=60, slicer_executable=None, max_workers=4):
+    """Load many files into the local Slicer server.
+    See `SlicerClient.file_load_batch` for description of the parameters.
+    """
+    return _get_default_client().file_load_batch(file_paths, file_type, properties, auto_start, timeout_sec, slicer_executable, max_workers)
+
+def volume_send(volume, name="VolumeNode"):
+    """Send a voxel array (or segmentation) to the local Slicer server, without writing it to a file.
+    See `SlicerClient.volume_send` for description of the parameters.
+    """
+    _get_default_client().volume_send(volume, name)
+
+def volume_receive(name=None, id=None):
+    """Get voxels of a volume node from the local Slicer server, without writing it to a file.
+    See `SlicerClient.volume_receive` for description of the parameters.
+    :return: dict containing "voxels" (numpy array) and "ijkToLPS"
+    """
+    return _get_default_client().volume_receive(name, id)
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+
+"""Pool of Slicer application instances for processing many data sets in parallel.
+
+Each Slicer instance runs a web server on a separate port. Jobs are dispatched to idle instances:
+a job is a function that receives a `slicerio.server.SlicerClient` that is connected to the instance
+(and optionally additional arguments), therefore all requests of a job (e.g., loading a file, processing it,
+and saving the result) are sent to the same instance.
+
+Example:
+
+    import slicerio.server_pool
+
+    def convert(client, input_path, output_path):
+        node_ids = client.file_load(input_path, auto_start=False)
+        client.file_save(output_path, id=node_ids[0])
+        client.node_remove(id=node_ids[0])
+
+    with slicerio.server_pool.SlicerServerPool(4) as pool:
+        for _ in pool.map(convert, input_paths, output_paths):
+            pass
+"""
+
+import logging
+import requests
+
+
+def slicer_server_launcher(slicer_executable=None, headless=True):
+    """Get a function that starts a Slicer application with web server enabled at the specified port.
+
+    :param slicer_executable: Slicer application main executable. If not specified then `SLICER_EXECUTABLE`
+        environment variable is used.
+    :param headless: if True then the application is started without showing the main window
+    :return: function that takes a port number and returns the started `subprocess.Popen` object
+    """
+    import os
+
+    if not slicer_executable:
+        if 'SLICER_EXECUTABLE' not in os.environ:
+            raise ValueError('SLICER_EXECUTABLE environment variable is not specified')
+        slicer_executable = os.environ['SLICER_EXECUTABLE']
+
+    def launch(port):
+        import subprocess
+        args = [slicer_executable]
+        if headless:
+            args += ["--no-splash", "--no-main-window"]
+        args += ["--python-code", f"wslogic = getModuleLogic('WebServer'); wslogic.port={port}; wslogic.addDefaultRequestHandlers(); wslogic.start()"]
+        return subprocess.Popen(args)
+
+    return launch
+
+
+class _PoolWorker:
+    """Slicer instance of the pool."""
+
+    def __init__(self, port, client):
+        self.port = port
+        self.client = client
+        self.process = None
+        self.restart_count = 0
+        self.retired = False
+
+
+class SlicerServerPool:
+    """Manage multiple Slicer application instances and dispatch jobs to idle instances.
+
+    Crashed instances are restarted (detected when a job is dispatched to the instance, when a job fails
+    with connection error, or when `check_health` is called). A job that fails with connection error because
+    its instance crashed is run once more after the instance is restarted.
+    Instances that cannot be restarted (failed to start or restarted `max_restarts` times already) are removed
+    from the pool and their jobs are run on the remaining instances. Jobs fail only if no instances remain.
+
+    :param size: number of Slicer instances
+    :param slicer_executable: Slicer application main executable. Used if `launcher` is not specified.
+    :param ports: list of port numbers, one for each instance. Default is consecutive ports after `slicerio.server.SERVER_PORT`.
+    :param launcher: function that takes a port number and starts a server process at that port,
+        returning a `subprocess.Popen`-like object (with `poll`, `terminate`, `kill`, and `wait` methods).
+        Default is `slicer_server_launcher(slicer_executable)`.
+    :param startup_timeout_sec: maximum time to wait for an instance to start responding
+    :param request_timeout: timeout of requests sent to the instances. See `slicerio.server.SlicerClient`.
+    :param max_restarts: maximum number of times each instance is restarted
+    """
+
+    def __init__(self, size, slicer_executable=None, ports=None, launcher=None, startup_timeout_sec=60, request_timeout=None, max_restarts=3):
+        from concurrent.futures import ThreadPoolExecutor
+        import queue
+        import threading
+        from . import server
+
+        if ports is None:
+            ports = [server.SERVER_PORT + 1 + index for index in range(size)]
+        if len(ports) != size or len(set(ports)) != size:
+            raise ValueError("A distinct port number must be specified for each instance")
+        self.launcher = launcher if launcher is not None else slicer_server_launcher(slicer_executable)
+        self.startup_timeout_sec = startup_timeout_sec
+        self.max_restarts = max_restarts
+        self.workers = [_PoolWorker(port, server.SlicerClient(port=port, timeout=request_timeout)) for port in ports]
+        self._idle_workers = queue.Queue()
+        self._live_worker_count = len(self.workers)
+        self._lock = threading.Lock()
+        # Each job is run in a separate thread, there are never more running jobs than instances
+        self._executor = ThreadPoolExecutor(max_workers=size)
+
+        try:
+            for worker in self.workers:
+                worker.process = self.launcher(worker.port)
+            for worker in self.workers:
+                worker.client.wait_for_server(self.startup_timeout_sec)
+                self._idle_workers.put(worker)
+        except BaseException:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def ports(self):
+        """Port numbers of the instances."""
+        return [worker.port for worker in self.workers]
+
+    @property
+    def live_ports(self):
+        """Port numbers of the instances that have not been removed from the pool."""
+        return [worker.port for worker in self.workers if not worker.retired]
+
+    def submit(self, job, *args, **kwargs):
+        """Run a job on an idle instance.
+        :param job: function that is called with a `slicerio.server.SlicerClient` (connected to the instance),
+            followed by args and kwargs
+        :return: `concurrent.futures.Future` of the return value of the job
+        """
+        return self._executor.submit(self._run_job, job, args, kwargs)
+
+    def map(self, job, *iterables):
+        """Run a job for each item of the iterables, on idle instances.
+        :param job: function that is called with a `slicerio.server.SlicerClient` (connected to the instance),
+            followed by one item from each iterable
+        :return: iterator of the return values, in the order of the items
+        """
+        futures = [self.submit(job, *args) for args in zip(*iterables)]
+        return (future.result() for future in futures)
+
+    def check_health(self):
+        """Check all idle instances and restart those that are not responding.
+        :return: number of restarted instances
+        """
+        import queue
+        idle_workers = []
+        while True:
+            try:
+                idle_workers.append(self._idle_workers.get_nowait())
+            except queue.Empty:
+                break
+        restarted_count = 0
+        try:
+            for worker in idle_workers:
+                if worker is None:
+                    # No instances remain
+                    continue
+                if worker.process.poll() is not None or not worker.client.is_server_running():
+                    if self._restart(worker):
+                        restarted_count += 1
+        finally:
+            for worker in idle_workers:
+                if worker is None or not worker.retired:
+                    self._idle_workers.put(worker)
+        return restarted_count
+
+    def close(self):
+        """Stop all instances."""
+        self._executor.shutdown(wait=True)
+        for worker in self.workers:
+            if worker.process is not None and worker.process.poll() is None:
+                try:
+                    worker.client.stop_server()
+                except Exception as e:
+                    logging.debug(f"Failed to stop server at port {worker.port}: {e}")
+            worker.client.close()
+        for worker in self.workers:
+            if worker.process is not None:
+                _stop_process(worker.process)
+                worker.process = None
+
+    def _run_job(self, job, args, kwargs):
+        while True:
+            worker = self._idle_workers.get()
+            if worker is None:
+                # All instances have been removed from the pool, let other waiting jobs know, too
+                self._idle_workers.put(None)
+                raise RuntimeError("No Slicer instances are available in the pool")
+            try:
+                if worker.process.poll() is not None:
+                    logging.warning(f"Slicer instance at port {worker.port} exited, restarting it")
+                    if not self._restart(worker):
+                        # Run the job on another instance
+                        continue
+                try:
+                    return job(worker.client, *args, **kwargs)
+                except requests.exceptions.ConnectionError:
+                    if worker.process.poll() is None and worker.client.is_server_running():
+                        # The instance is working, the error is not caused by a crash
+                        raise
+                    logging.warning(f"Slicer instance at port {worker.port} stopped responding, restarting it and running the job again")
+                    if not self._restart(worker):
+                        continue
+                    return job(worker.client, *args, **kwargs)
+            finally:
+                if not worker.retired:
+                    self._idle_workers.put(worker)
+
+    def _restart(self, worker):
+        """Restart the instance. If it cannot be restarted then it is removed from the pool.
+        :return: True if the instance was restarted successfully
+        """
+        if worker.restart_count >= self.max_restarts:
+            logging.error(f"Slicer instance at port {worker.port} was restarted too many times, removing it from the pool")
+            self._retire(worker)
+            return False
+        worker.restart_count += 1
+        _stop_process(worker.process)
+        try:
+            worker.process = self.launcher(worker.port)
+            worker.client.wait_for_server(self.startup_timeout_sec)
+        except Exception as e:
+            logging.error(f"Failed to restart Slicer instance at port {worker.port}, removing it from the pool: {e}")
+            self._retire(worker)
+            return False
+        return True
+
+    def _retire(self, worker):
+        """Remove the instance from the pool (it is not put back to the idle instances)."""
+        if worker.process is not None:
+            _stop_process(worker.process)
+        worker.retired = True
+        with self._lock:
+            self._live_worker_count -= 1
+            if self._live_worker_count == 0:
+                # Wake up jobs that are waiting for an idle instance
+                self._idle_workers.put(None)
+
+
+def _stop_process(process, timeout_sec=10):
+    """Terminate process (if it has not exited yet) and wait for it to exit."""
+    import subprocess
+    if process.poll() is None:
+        process.terminate()
+    try:
+        process.wait(timeout_sec)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
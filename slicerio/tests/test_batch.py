@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import slicerio
+import slicerio.batch
+
+
+class TestBatchProcessing(unittest.TestCase):
+    """
+    Test processing of multiple segmentation files.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.input_filepaths = [slicerio.get_testdata_file(filename) for filename in ['Segmentation.seg.nrrd', 'SegmentationOverlapping.seg.nrrd']]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_process_segmentations(self):
+        output_directory = os.path.join(self.directory, 'output')
+        missing_filepath = os.path.join(self.directory, 'Missing.seg.nrrd')
+        progress = []
+        results = slicerio.batch.process_segmentations(
+            self.input_filepaths + [missing_filepath], output_directory, [('ribs', 1), ('right lung', 3)],
+            processes=2, max_in_flight=2, compression_level=1,
+            progress_callback=lambda processed_count, total_count, result: progress.append((processed_count, total_count)))
+
+        self.assertEqual(sorted(progress), [(1, 3), (2, 3), (3, 3)])
+        self.assertEqual([result["input"] for result in results], self.input_filepaths + [missing_filepath])
+
+        # Errors are collected per file
+        self.assertIsNone(results[0]["error"])
+        self.assertIsNone(results[1]["error"])
+        self.assertIsNotNone(results[2]["error"])
+        self.assertIsNone(results[2]["output"])
+
+        for result in results[:2]:
+            self.assertEqual(result["output"], os.path.join(output_directory, os.path.basename(result["input"])))
+            expected_segmentation = slicerio.extract_segments(slicerio.read_segmentation(result["input"]), [('ribs', 1), ('right lung', 3)])
+            segmentation = slicerio.read_segmentation(result["output"])
+            self.assertTrue(np.array_equal(segmentation["voxels"], expected_segmentation["voxels"]))
+            self.assertEqual(slicerio.segment_names(segmentation), ['ribs', 'right lung'])
+
+    def test_same_file_names_in_subfolders(self):
+        input_directory = os.path.join(self.directory, 'input')
+        for subfolder, input_filepath in zip(['a', 'b'], self.input_filepaths):
+            os.makedirs(os.path.join(input_directory, subfolder))
+            shutil.copy(input_filepath, os.path.join(input_directory, subfolder, 'case.seg.nrrd'))
+        output_directory = os.path.join(self.directory, 'output')
+
+        # Subfolders are kept in the output directory
+        results = slicerio.batch.process_segmentations([os.path.join(input_directory, '**', '*.seg.nrrd')], output_directory, processes=1)
+        self.assertEqual([result["error"] for result in results], [None, None])
+        self.assertEqual([result["output"] for result in results],
+            [os.path.join(output_directory, subfolder, 'case.seg.nrrd') for subfolder in ['a', 'b']])
+        for result in results:
+            self.assertEqual(slicerio.segment_names(slicerio.read_segmentation(result["output"])),
+                slicerio.segment_names(slicerio.read_segmentation(result["input"])))
+
+        # Files that would be written to the same output file are reported as errors
+        input_filepaths = [os.path.join(input_directory, subfolder, 'case.seg.nrrd') for subfolder in ['a', 'b']]
+        results = slicerio.batch.process_segmentations(input_filepaths, output_directory, processes=2)
+        self.assertIsNone(results[0]["error"])
+        self.assertIsNone(results[1]["output"])
+        self.assertIn("would overwrite the output of", results[1]["error"])
+
+    def test_command_line(self):
+        output_directory = os.path.join(self.directory, 'output')
+        mapping_filepath = os.path.join(self.directory, 'mapping.json')
+        with open(mapping_filepath, 'w') as f:
+            json.dump([["ribs", 1]], f)
+        input_pattern = os.path.join(os.path.dirname(self.input_filepaths[0]), '*.seg.nrrd')
+        exit_code = slicerio.batch.main([input_pattern, '-o', output_directory, '-m', mapping_filepath, '-p', '1'])
+        self.assertEqual(exit_code, 0)
+        self.assertEqual(sorted(os.listdir(output_directory)), ['Segmentation.seg.nrrd', 'SegmentationOverlapping.seg.nrrd'])
+
+
+if __name__ == '__main__':
+    unittest.main()
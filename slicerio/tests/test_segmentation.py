@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import importlib.util
 import nrrd
 import slicerio
 import unittest
@@ -55,6 +56,342 @@ class TestSegmentationRoundtrip(unittest.TestCase):
         self.assertEqual('anatomicRegion' in terminology, False)
         self.assertEqual('anatomicRegionModifier' in terminology, False)
 
+    def test_segmentation_header_parsing(self):
+        """Test that segmentation header parsing gives the same result as parsing with pynrrd"""
+        import numpy as np
+        from slicerio.segmentation import _read_segmentation_header
+
+        for input_segmentation_filename in ['Segmentation.seg.nrrd', 'SegmentationOverlapping.seg.nrrd']:
+            input_segmentation_filepath = slicerio.get_testdata_file(input_segmentation_filename)
+            expected_header = nrrd.read_header(input_segmentation_filepath)
+            with open(input_segmentation_filepath, 'rb') as fh:
+                header, segments_fields = _read_segmentation_header(fh)
+                data_offset = fh.tell()
+            with open(input_segmentation_filepath, 'rb') as fh:
+                nrrd.read_header(fh)
+                self.assertEqual(data_offset, fh.tell())
+
+            for key in expected_header:
+                if key.startswith('Segment') and key[7].isdigit():
+                    segment_index, segment_key = key[7:].split('_', 1)
+                    self.assertEqual(segments_fields[int(segment_index)][segment_key], expected_header[key])
+                elif isinstance(expected_header[key], np.ndarray):
+                    self.assertTrue(np.array_equal(header[key], expected_header[key], equal_nan=True))
+                else:
+                    self.assertEqual(header[key], expected_header[key])
+            self.assertEqual(len(header) + sum(len(fields) for fields in segments_fields.values()), len(expected_header))
+
+        # Terminology of segments must be independent objects, even if they are parsed from the same string
+        segmentation = slicerio.read_segmentation(input_segmentation_filepath, skip_voxels=True)
+        segmentation["segments"][0]["terminology"]["type"][1] = "modified"
+        segmentation = slicerio.read_segmentation(input_segmentation_filepath, skip_voxels=True)
+        self.assertEqual(segmentation["segments"][0]["terminology"]["type"], ['SCT', '113197003', 'Rib'])
+
+    def test_nifti_segment_descriptions(self):
+        """Test label value discovery and sidecar file parsing that are used for reading NIFTI files"""
+        import json
+        import numpy as np
+        import os
+        import tempfile
+        from slicerio.segmentation import _label_values_in_voxels, _read_label_descriptions
+
+        segmentation = slicerio.read_segmentation(slicerio.get_testdata_file('Segmentation.seg.nrrd'))
+        voxels = segmentation["voxels"]
+        expected_label_values = np.unique(voxels).tolist()
+        for dtype in [np.uint8, np.int16, np.uint32, np.int64]:
+            self.assertEqual(_label_values_in_voxels(voxels.astype(dtype)), expected_label_values)
+        self.assertEqual(_label_values_in_voxels(np.array([[-3, 0], [7, 0]], dtype=np.int8)), [-3, 0, 7])
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            json_filename = os.path.join(temp_dir, "Segmentation.json")
+            with open(json_filename, "w") as f:
+                json.dump({"segments": segmentation["segments"]}, f)
+            self.assertEqual(_read_label_descriptions(json_filename), json.loads(json.dumps(segmentation["segments"])))
+
+            with open(json_filename, "w") as f:
+                json.dump({"labels": {"background": 0, "liver": 1, "spleen": 2}}, f)
+            segments = _read_label_descriptions(json_filename)
+            self.assertEqual([(segment["labelValue"], segment["name"]) for segment in segments], [(1, "liver"), (2, "spleen")])
+
+            # Regions of nnU-Net region-based training are ignored
+            with open(json_filename, "w") as f:
+                json.dump({"labels": {"background": 0, "kidney": 1, "tumor": 2, "kidney and tumor": [1, 2]}}, f)
+            with self.assertLogs(level="WARNING"):
+                segments = _read_label_descriptions(json_filename)
+            self.assertEqual([(segment["labelValue"], segment["name"]) for segment in segments], [(1, "kidney"), (2, "tumor")])
+            with open(json_filename, "w") as f:
+                json.dump({"labels": {"liver": "first"}}, f)
+            with self.assertRaisesRegex(ValueError, "Invalid label value"):
+                _read_label_descriptions(json_filename)
+
+            color_table_filename = os.path.join(temp_dir, "Segmentation.ctbl")
+            with open(color_table_filename, "w") as f:
+                f.write("# Color table file\n0 background 0 0 0 0\n")
+                f.write("1 ribs 255 0 0 255 Segmentation category and type - 3D Slicer General Anatomy list"
+                    "~SCT^123037004^Anatomical  Structure~SCT^113197003^Rib~^^~Anatomic codes - DICOM master list~^^~^^\n")
+                f.write("3 lung 0 255 0 255\n")
+            segments = _read_label_descriptions(color_table_filename)
+            self.assertEqual([(segment["labelValue"], segment["name"]) for segment in segments], [(1, "ribs"), (3, "lung")])
+            self.assertEqual(segments[0]["color"], [1.0, 0.0, 0.0])
+            self.assertEqual(segments[0]["terminology"]["type"], ["SCT", "113197003", "Rib"])
+            # Spaces in the terminology entry string are kept
+            self.assertEqual(segments[0]["terminology"]["category"], ["SCT", "123037004", "Anatomical  Structure"])
+            self.assertNotIn("terminology", segments[1])
+        finally:
+            import shutil
+            shutil.rmtree(temp_dir)
+
+    def test_segmentation_write_nifti(self):
+        import gzip
+        import json
+        import numpy as np
+        import os
+        import shutil
+        import struct
+        import tempfile
+        import slicerio.segmentation
+        from slicerio.segmentation import _read_label_descriptions
+
+        def read_nifti(filename):
+            with gzip.open(filename, "rb") as f:
+                data = f.read()
+            self.assertEqual(struct.unpack("<i", data[0:4])[0], 348)
+            self.assertEqual(data[344:348], b"n+1\x00")
+            dim = struct.unpack("<8h", data[40:56])
+            datatype, bitpix = struct.unpack("<2h", data[70:74])
+            srow = np.array(struct.unpack("<12f", data[280:328])).reshape(3, 4)
+            quatern = struct.unpack("<6f", data[256:280])
+            qfac = struct.unpack("<f", data[76:80])[0]
+            dtype = {2: np.uint8, 512: np.uint16, 256: np.int8}[datatype]
+            self.assertEqual(bitpix, np.dtype(dtype).itemsize * 8)
+            voxels = np.frombuffer(data[352:], dtype=dtype).reshape(dim[1:dim[0]+1], order="F")
+            return voxels, srow, quatern, qfac
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            segmentation = slicerio.read_segmentation(slicerio.get_testdata_file('SegmentationOverlapping.seg.nrrd'))
+            voxels = segmentation["voxels"]
+            ijkToRAS = np.diag([-1, -1, 1, 1]).dot(segmentation["ijkToLPS"])
+            output_filename = os.path.join(temp_dir, "Segmentation.nii.gz")
+
+            # Layers are written along the 4th axis, using small chunks and multiple threads
+            default_chunk_size = slicerio.segmentation._COMPRESSION_CHUNK_SIZE
+            slicerio.segmentation._COMPRESSION_CHUNK_SIZE = 10000
+            try:
+                slicerio.write_segmentation(output_filename, segmentation, compression_threads=2)
+            finally:
+                slicerio.segmentation._COMPRESSION_CHUNK_SIZE = default_chunk_size
+            nifti_voxels, srow, quatern, qfac = read_nifti(output_filename)
+            self.assertEqual(nifti_voxels.dtype, np.uint8)
+            self.assertTrue(np.array_equal(np.moveaxis(nifti_voxels, 3, 0), voxels))
+            self.assertTrue(np.allclose(srow, ijkToRAS[0:3, :], rtol=1e-5))
+            # Axes are aligned, therefore only one of the quaternion components is non-zero
+            self.assertTrue(np.allclose(quatern[3:6], ijkToRAS[0:3, 3], rtol=1e-5))
+            self.assertEqual(qfac, 1.0 if np.linalg.det(ijkToRAS[0:3, 0:3]) > 0 else -1.0)
+
+            segments = _read_label_descriptions(os.path.join(temp_dir, "Segmentation.json"))
+            self.assertEqual([segment["layer"] for segment in segments], [segment["layer"] for segment in segmentation["segments"]])
+            self.assertEqual(segments[0]["terminology"], json.loads(json.dumps(segmentation["segments"][0]["terminology"])))
+
+            # Merge layers: the sphere (listed last) overwrites the other segments.
+            # Label values are not unique, therefore new label values are assigned.
+            slicerio.write_segmentation_nifti(output_filename, segmentation, merge_layers=True, compression_threads=1)
+            nifti_voxels, _, _, _ = read_nifti(output_filename)
+            self.assertEqual(nifti_voxels.shape, voxels.shape[1:])
+            segments = _read_label_descriptions(os.path.join(temp_dir, "Segmentation.json"))
+            self.assertEqual([segment["labelValue"] for segment in segments], list(range(1, 9)))
+            self.assertTrue(np.array_equal(nifti_voxels == 8, voxels[1] == 1))
+            self.assertTrue(np.array_equal(nifti_voxels == 1, (voxels[0] == 1) & (voxels[1] != 1)))
+
+            # Extent computation and index order are applied when writing NIFTI using write_segmentation
+            slicerio.write_segmentation(output_filename, segmentation, compute_extent=True)
+            segments = _read_label_descriptions(os.path.join(temp_dir, "Segmentation.json"))
+            self.assertEqual(segments[-1]["extent"], [16, 64, 61, 109, 16, 30])
+            self.assertEqual(segmentation["segments"][0]["extent"], [0, 124, 0, 127, 0, 33])
+            with self.assertRaises(ValueError):
+                slicerio.write_segmentation(output_filename, segmentation, index_order='C')
+        finally:
+            shutil.rmtree(temp_dir)
+
+    @unittest.skipUnless(importlib.util.find_spec("nibabel"), "nibabel is required to read NIFTI files")
+    def test_segmentation_read_nifti(self):
+        """Test NIFTI writing/reading roundtrip"""
+        import json
+        import nibabel as nib
+        import numpy as np
+        import os
+        import shutil
+        import tempfile
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            segmentation = slicerio.read_segmentation(slicerio.get_testdata_file('Segmentation.seg.nrrd'))
+            voxels = segmentation["voxels"]
+            nifti_filename = os.path.join(temp_dir, "Segmentation.nii.gz")
+            slicerio.write_segmentation(nifti_filename, segmentation)
+            segmentation_read = slicerio.read_segmentation(nifti_filename)
+            self.assertEqual(segmentation_read["voxels"].dtype, np.uint8)
+            self.assertTrue(np.array_equal(segmentation_read["voxels"], voxels))
+            self.assertTrue(np.allclose(segmentation_read["ijkToLPS"], segmentation["ijkToLPS"], rtol=1e-5))
+            self.assertEqual([segment["name"] for segment in segmentation_read["segments"]],
+                [segment["name"] for segment in segmentation["segments"]])
+
+            # Integer voxels are downcast to the smallest type that can store all label values,
+            # floating-point voxels are rounded
+            ijkToRAS = np.diag([-1, -1, 1, 1]).dot(segmentation["ijkToLPS"])
+            for dtype in [np.int16, np.uint32, np.float32]:
+                image_filename = os.path.join(temp_dir, f"Labels_{np.dtype(dtype).name}.nii")
+                nib.save(nib.Nifti1Image(voxels.astype(dtype), ijkToRAS), image_filename)
+                segmentation_read = slicerio.read_segmentation(image_filename)
+                self.assertEqual(segmentation_read["voxels"].dtype, np.uint8)
+                self.assertTrue(np.array_equal(segmentation_read["voxels"], voxels))
+                self.assertEqual([segment["name"] for segment in segmentation_read["segments"]],
+                    [f"Segment_{label_value}" for label_value in np.unique(voxels) if label_value != 0])
+
+            # Only the header and the automatically found JSON sidecar file are read
+            segmentation_read = slicerio.read_segmentation(nifti_filename, skip_voxels=True)
+            self.assertIsNone(segmentation_read["voxels"])
+            self.assertEqual([segment["name"] for segment in segmentation_read["segments"]],
+                [segment["name"] for segment in segmentation["segments"]])
+            self.assertEqual(segmentation_read["segments"][0]["terminology"]["type"], ["SCT", "113197003", "Rib"])
+
+            # Slicer color table sidecar file is found automatically
+            os.remove(os.path.join(temp_dir, "Segmentation.json"))
+            with open(os.path.join(temp_dir, "Segmentation.ctbl"), "w") as f:
+                f.write("0 background 0 0 0 0\n1 ribs 255 0 0 255\n5 lung 0 255 0 255\n")
+            segmentation_read = slicerio.read_segmentation(nifti_filename)
+            self.assertEqual([(segment["labelValue"], segment["name"]) for segment in segmentation_read["segments"]],
+                [(1, "ribs"), (5, "lung"), (2, "Segment_2"), (3, "Segment_3"), (4, "Segment_4"), (6, "Segment_6"), (7, "Segment_7")])
+            self.assertEqual(segmentation_read["segments"][1]["color"], [0.0, 1.0, 0.0])
+
+            # Sidecar file can be specified explicitly
+            sidecar_filename = os.path.join(temp_dir, "dataset.json")
+            with open(sidecar_filename, "w") as f:
+                json.dump({"labels": {"background": 0, "ribs": 1, "tissue": 7}}, f)
+            segmentation_read = slicerio.read_segmentation(nifti_filename, skip_voxels=True, sidecar_filename=sidecar_filename)
+            self.assertIsNone(segmentation_read["voxels"])
+            self.assertEqual([(segment["labelValue"], segment["name"]) for segment in segmentation_read["segments"]],
+                [(1, "ribs"), (7, "tissue")])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_segmentation_write_zarr(self):
+        import json
+        import numpy as np
+        import os
+        import shutil
+        import tempfile
+        from slicerio.segmentation_zarr import write_segmentation_zarr
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            segmentation = slicerio.read_segmentation(slicerio.get_testdata_file('SegmentationOverlapping.seg.nrrd'))
+            voxels = segmentation["voxels"]
+            for output_name in ["Segmentation.zarr", "Segmentation.zarr.zip"]:
+                output_path = os.path.join(temp_dir, output_name)
+                slicerio.write_segmentation(output_path, segmentation)
+                # Overwrite the store using chunks that are padded at the edges of the voxel array, using multiple threads
+                write_segmentation_zarr(output_path, segmentation, chunk_shape=(20, 30, 40), threads=2)
+
+                segmentation_read = slicerio.read_segmentation(output_path)
+                self.assertTrue(np.array_equal(segmentation_read["voxels"], voxels))
+                self.assertEqual(segmentation_read["voxels"].dtype, voxels.dtype)
+                self.assertTrue(np.allclose(segmentation_read["ijkToLPS"], segmentation["ijkToLPS"]))
+                self.assertEqual(segmentation_read["segments"], json.loads(json.dumps(segmentation["segments"])))
+                self.assertEqual(segmentation_read["conversionParameters"], segmentation["conversionParameters"])
+
+                # Only the chunks that intersect with the sphere extent [16, 64, 61, 109, 16, 30] are read
+                cropped_segmentation = slicerio.read_segmentation(output_path, crop_to_segments=['overlapping sphere'])
+                self.assertTrue(np.array_equal(cropped_segmentation["voxels"], voxels[:, 16:65, 61:110, 16:31]))
+                self.assertEqual(cropped_segmentation["referenceImageExtentOffset"], [16, 61, 16])
+                self.assertEqual(slicerio.segment_from_name(cropped_segmentation, 'overlapping sphere')['extent'], [0, 48, 0, 48, 0, 14])
+
+            # Chunks that only contain background are not stored
+            write_segmentation_zarr(os.path.join(temp_dir, "Segmentation.zarr"), segmentation, chunk_shape=(16, 16, 16))
+            chunk_names = [name for name in os.listdir(os.path.join(temp_dir, "Segmentation.zarr")) if not name.startswith(".")]
+            self.assertLess(len(chunk_names), np.prod([-(-size // 16) for size in voxels.shape[1:]]))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def _read_segmentation_with_anatomic_region_modifiers(self):
+        """Read segmentation metadata and add segments that only differ in anatomic region modifier."""
+        import copy
+
+        segmentation = slicerio.read_segmentation(slicerio.get_testdata_file('Segmentation.seg.nrrd'), skip_voxels=True)
+        for modifier in [None, ["SCT", "7771000", "Left"], ["SCT", "24028007", "Right"]]:
+            segment = copy.deepcopy(segmentation["segments"][0])
+            segment["name"] = f"rib {modifier}"
+            segment["terminology"]["anatomicRegion"] = ["SCT", "51185008", "Thorax"]
+            if modifier:
+                segment["terminology"]["anatomicRegionModifier"] = modifier
+            segmentation["segments"].append(segment)
+        return segmentation
+
+    def test_segment_index(self):
+        from slicerio.segmentation import terminology_entry_matches
+
+        segmentation = self._read_segmentation_with_anatomic_region_modifiers()
+
+        # Index gives the same result as comparing the terminology with all segments
+        segment_index = slicerio.SegmentIndex(segmentation)
+        for segment in segmentation["segments"]:
+            expected_segments = [other for other in segmentation["segments"] if terminology_entry_matches(other["terminology"], segment["terminology"])]
+            self.assertEqual(segment_index.segments_from_terminology(segment["terminology"]), expected_segments)
+            self.assertEqual(slicerio.segmentation.segments_from_terminology(segmentation, segment["terminology"]), expected_segments)
+            self.assertEqual(segment_index.segments_from_name(segment["name"]), [segment])
+            self.assertIs(segment_index.segment_from_id(segment["id"]), segmentation["segments"][0] if segment["id"] == "Segment_1" else segment)
+        self.assertEqual(len(segment_index.segments_from_terminology(segmentation["segments"][-1]["terminology"])), 1)
+
+        # Segments are found after the segmentation is modified
+        self.assertEqual(slicerio.segment_from_name(segmentation, "ribs")["id"], "Segment_1")
+        segmentation["segments"][0]["name"] = "renamed ribs"
+        self.assertEqual(slicerio.segmentation.segments_from_name(segmentation, "ribs"), [])
+        self.assertEqual(slicerio.segment_from_name(segmentation, "renamed ribs")["id"], "Segment_1")
+        segmentation["segments"][1] = {"name": "new", "terminology": segmentation["segments"][5]["terminology"]}
+        self.assertEqual(slicerio.segment_from_name(segmentation, "new"), segmentation["segments"][1])
+        self.assertEqual(len(slicerio.segmentation.segments_from_terminology(segmentation, segmentation["segments"][5]["terminology"])), 2)
+        segmentation["segments"].pop()
+        with self.assertRaises(KeyError):
+            slicerio.segment_from_name(segmentation, "rib ['SCT', '24028007', 'Right']")
+        segmentation["segments"][2]["name"] = "renamed ribs"
+        self.assertEqual(len(slicerio.segmentation.segments_from_name(segmentation, "renamed ribs")), 2)
+
+    def test_terminology_matcher(self):
+        import copy
+        from slicerio.segmentation import terminology_entry_matches
+
+        segmentation = self._read_segmentation_with_anatomic_region_modifiers()
+        segments = segmentation["segments"]
+
+        # Without wildcards the matcher gives the same result as terminology_entry_matches
+        for segment in segments:
+            matcher = slicerio.TerminologyMatcher(segment["terminology"])
+            expected_segments = [other for other in segments if terminology_entry_matches(other["terminology"], segment["terminology"])]
+            self.assertEqual(matcher.filter_segments(segments), expected_segments)
+
+        # Any type modifier: left and right lung
+        lung = {"category": ["SCT", "123037004", "Anatomical Structure"], "type": ["SCT", "39607008", "Lung"], "typeModifier": "*"}
+        self.assertEqual([segment["name"] for segment in slicerio.TerminologyMatcher(lung).filter_segments(segments)], ["right lung", "left lung"])
+
+        # Any anatomic region modifier, multiple queries
+        ribs = copy.deepcopy(segments[0]["terminology"])
+        ribs["anatomicRegion"] = ["SCT", "51185008", "Thorax"]
+        ribs["anatomicRegionModifier"] = "*"
+        matcher = slicerio.TerminologyMatcher([lung, ribs])
+        self.assertEqual(len(matcher.filter_segments(segments)), 5)
+        self.assertEqual(slicerio.SegmentIndex(segmentation).segments_from_terminology(matcher), matcher.filter_segments(segments))
+        self.assertEqual(slicerio.segmentation.segments_from_terminology(segmentation, matcher), matcher.filter_segments(segments))
+        self.assertFalse(matcher.matches(segments[0]["terminology"]))
+
+        # Any anatomic region implies any anatomic region modifier
+        any_ribs = {"category": ribs["category"], "type": ribs["type"], "anatomicRegion": "*"}
+        self.assertEqual(len(slicerio.TerminologyMatcher(any_ribs).filter_segments(segments)), 4)
+
+        # Matcher can be used for cropping
+        cropped = slicerio.read_segmentation(slicerio.get_testdata_file('Segmentation.seg.nrrd'), crop_to_segments=[slicerio.TerminologyMatcher(lung)])
+        self.assertEqual(cropped["voxels"].shape[-3:], (125, 128, 34))
+
     def test_extract_segments(self):
         input_segmentation_filenames = ['Segmentation.seg.nrrd', 'SegmentationOverlapping.seg.nrrd']
         for input_segmentation_filename in input_segmentation_filenames:
@@ -100,6 +437,220 @@ class TestSegmentationRoundtrip(unittest.TestCase):
             self.assertEqual(len(np.where(extracted_segmentation_by_terminology["voxels"] == 3)[0]), 34450) # right lung
             self.assertEqual(len(np.where(extracted_segmentation_by_terminology["voxels"] == 4)[0]), 0) # unused label
 
+    def test_extract_segments_label_value_out_of_range(self):
+        import numpy as np
+        from slicerio.segmentation import _remap_labels
+
+        segmentation = slicerio.read_segmentation(slicerio.get_testdata_file('Segmentation.seg.nrrd'))
+        self.assertEqual(segmentation["voxels"].dtype, np.uint8)
+        # Label value that cannot occur in uint8 voxels matches no voxels
+        segmentation["segments"][1]["labelValue"] = 300
+        extracted_segmentation = slicerio.extract_segments(segmentation, [('ribs', 1), ('cervical vertebral column', 2)])
+        self.assertEqual(len(np.where(extracted_segmentation["voxels"] == 1)[0]), 8487)
+        self.assertEqual(len(np.where(extracted_segmentation["voxels"] == 2)[0]), 0)
+
+        voxels = np.array([[0, 1], [2, -1]], dtype=np.int32)
+        self.assertTrue(np.array_equal(_remap_labels(voxels, {2: 5, 2**40: 6, -2**40: 7}, np.uint8), [[0, 0], [5, 0]]))
+
+    def test_extract_segments_overlapping(self):
+        import numpy as np
+
+        input_segmentation_filepath = slicerio.get_testdata_file('SegmentationOverlapping.seg.nrrd')
+        segmentation = slicerio.read_segmentation(input_segmentation_filepath)
+        voxels = segmentation["voxels"]
+        ribs = voxels[0] == 1
+        sphere = voxels[1] == 1
+        self.assertTrue(np.any(ribs & sphere))
+
+        # Segments listed later overwrite the earlier ones
+        extracted_segmentation = slicerio.extract_segments(segmentation, [('ribs', 1), ('overlapping sphere', 2)])
+        expected_voxels = np.zeros(voxels.shape[1:], dtype=voxels.dtype)
+        expected_voxels[ribs] = 1
+        expected_voxels[sphere] = 2
+        self.assertTrue(np.array_equal(extracted_segmentation["voxels"], expected_voxels))
+
+        extracted_segmentation = slicerio.extract_segments(segmentation, [('overlapping sphere', 2), ('ribs', 1)])
+        expected_voxels[ribs] = 1
+        self.assertTrue(np.array_equal(extracted_segmentation["voxels"], expected_voxels))
+
+        # Voxel types that are too large for a full lookup table
+        segmentation["voxels"] = voxels.astype(np.int32)
+        extracted_segmentation = slicerio.extract_segments(segmentation, [('overlapping sphere', 2), ('ribs', 1)])
+        self.assertTrue(np.array_equal(extracted_segmentation["voxels"], expected_voxels))
+
+        # Output uses the smallest integer type that can store the label values
+        self.assertEqual(extracted_segmentation["voxels"].dtype, np.uint8)
+        extracted_segmentation = slicerio.extract_segments(segmentation, [('overlapping sphere', 2), ('ribs', 300)])
+        self.assertEqual(extracted_segmentation["voxels"].dtype, np.uint16)
+        self.assertEqual(np.count_nonzero(extracted_segmentation["voxels"] == 300), np.count_nonzero(ribs))
+        extracted_segmentation = slicerio.extract_segments(segmentation, [('overlapping sphere', -2), ('ribs', 1)])
+        self.assertEqual(extracted_segmentation["voxels"].dtype, np.int8)
+
+    def test_collapse_layers(self):
+        import numpy as np
+        import os
+        import tempfile
+
+        input_segmentation_filepath = slicerio.get_testdata_file('SegmentationOverlapping.seg.nrrd')
+        segmentation = slicerio.read_segmentation(input_segmentation_filepath)
+        voxels = segmentation["voxels"]
+        masks = [voxels[segment["layer"]] == segment["labelValue"] for segment in segmentation["segments"]]
+
+        def assert_masks_equal(collapsed_segmentation, masks):
+            collapsed_voxels = collapsed_segmentation["voxels"]
+            for segment, mask in zip(collapsed_segmentation["segments"], masks):
+                layer_voxels = collapsed_voxels if collapsed_voxels.ndim == 3 else collapsed_voxels[segment["layer"]]
+                self.assertTrue(np.array_equal(layer_voxels == segment["labelValue"], mask))
+
+        # The sphere overlaps with the ribs, so it must be in a separate layer
+        collapsed_segmentation = slicerio.collapse_layers(segmentation)
+        self.assertEqual(collapsed_segmentation["voxels"].shape, voxels.shape)
+        self.assertEqual([segment["layer"] for segment in collapsed_segmentation["segments"]], [0] * 7 + [1])
+        self.assertEqual([segment["labelValue"] for segment in collapsed_segmentation["segments"]], list(range(1, 8)) + [1])
+        assert_masks_equal(collapsed_segmentation, masks)
+
+        # Segments that do not overlap with the sphere are packed into the sphere's layer
+        segmentation["segments"] = segmentation["segments"][7:] + segmentation["segments"][:7]
+        masks = masks[7:] + masks[:7]
+        collapsed_segmentation = slicerio.collapse_layers({"ijkToLPS": segmentation["ijkToLPS"], "segments": segmentation["segments"]}, masks)
+        expected_layers = [0] + [1 if np.any(mask & masks[0]) else 0 for mask in masks[1:]]
+        self.assertEqual(expected_layers[:2], [0, 1])
+        self.assertIn(0, expected_layers[2:])
+        self.assertEqual([segment["layer"] for segment in collapsed_segmentation["segments"]], expected_layers)
+        assert_masks_equal(collapsed_segmentation, masks)
+
+        # Written file can be read back
+        output_segmentation_filepath = tempfile.mktemp() + '.seg.nrrd'
+        slicerio.write_segmentation(output_segmentation_filepath, collapsed_segmentation)
+        assert_masks_equal(slicerio.read_segmentation(output_segmentation_filepath), masks)
+        os.remove(output_segmentation_filepath)
+
+        # Without overlap all segments fit in a single 3D layer
+        collapsed_segmentation = slicerio.collapse_layers({"ijkToLPS": segmentation["ijkToLPS"], "segments": segmentation["segments"][2:]}, masks[2:])
+        self.assertEqual(collapsed_segmentation["voxels"].shape, voxels.shape[1:])
+        assert_masks_equal(collapsed_segmentation, masks[2:])
+
+    def test_sparse_segmentation(self):
+        import numpy as np
+        import os
+        import tempfile
+        import slicerio.segmentation
+
+        for input_segmentation_filename in ['Segmentation.seg.nrrd', 'SegmentationOverlapping.seg.nrrd']:
+            input_segmentation_filepath = slicerio.get_testdata_file(input_segmentation_filename)
+            segmentation = slicerio.read_segmentation(input_segmentation_filepath)
+            voxels = segmentation["voxels"]
+
+            # Use small slabs to make sure that the sparse masks are assembled from multiple slabs
+            default_chunk_size = slicerio.segmentation._READ_CHUNK_SIZE
+            slicerio.segmentation._READ_CHUNK_SIZE = 100000
+            try:
+                sparse_segmentation = slicerio.read_segmentation(input_segmentation_filepath, sparse=True)
+            finally:
+                slicerio.segmentation._READ_CHUNK_SIZE = default_chunk_size
+
+            self.assertIsNone(sparse_segmentation["voxels"])
+            self.assertEqual(sparse_segmentation["voxelsShape"], list(voxels.shape[-3:]))
+            converted_sparse_segmentation = slicerio.sparse_segmentation(segmentation)
+            statistics = slicerio.segment_statistics(segmentation)
+            for segment, converted_segment, segment_stats in zip(
+                    sparse_segmentation["segments"], converted_sparse_segmentation["segments"], statistics):
+                self.assertEqual(segment["extent"], segment_stats["extent"])
+                self.assertEqual(converted_segment["extent"], segment_stats["extent"])
+                self.assertTrue(np.array_equal(segment["mask"], converted_segment["mask"]))
+            self.assertEqual(slicerio.segment_statistics(sparse_segmentation), statistics)
+
+            # Convert back to dense representation
+            self.assertTrue(np.array_equal(slicerio.dense_segmentation(sparse_segmentation)["voxels"], voxels))
+
+            # Extract segments
+            segments_to_labels = [('ribs', 1), ('right lung', 3), ('overlapping sphere', 2)] if voxels.ndim == 4 else [('ribs', 1), ('right lung', 3)]
+            extracted_segmentation = slicerio.extract_segments(segmentation, segments_to_labels)
+            extracted_sparse_segmentation = slicerio.extract_segments(sparse_segmentation, segments_to_labels)
+            self.assertTrue(np.array_equal(slicerio.dense_segmentation(extracted_sparse_segmentation)["voxels"], extracted_segmentation["voxels"]))
+
+            # Write
+            output_segmentation_filepath = tempfile.mktemp() + '.seg.nrrd'
+            slicerio.write_segmentation(output_segmentation_filepath, sparse_segmentation)
+            segmentation_stored = slicerio.read_segmentation(output_segmentation_filepath)
+            os.remove(output_segmentation_filepath)
+            self.assertTrue(np.array_equal(segmentation_stored["voxels"], voxels))
+            self.assertTrue(all("mask" not in segment for segment in segmentation_stored["segments"]))
+
+        # Cropped sparse read
+        cropped_segmentation = slicerio.read_segmentation(input_segmentation_filepath, crop_to_segments=["overlapping sphere"])
+        cropped_sparse_segmentation = slicerio.read_segmentation(input_segmentation_filepath, crop_to_segments=["overlapping sphere"], sparse=True)
+        self.assertEqual(cropped_sparse_segmentation["voxelsShape"], list(cropped_segmentation["voxels"].shape[-3:]))
+        self.assertTrue(np.array_equal(slicerio.dense_segmentation(cropped_sparse_segmentation)["voxels"], cropped_segmentation["voxels"]))
+
+    def test_segment_statistics(self):
+        import numpy as np
+
+        input_segmentation_filepath = slicerio.get_testdata_file('SegmentationOverlapping.seg.nrrd')
+        segmentation = slicerio.read_segmentation(input_segmentation_filepath)
+        voxels = segmentation["voxels"]
+        ijkToLPS = segmentation["ijkToLPS"]
+
+        statistics = slicerio.segment_statistics(segmentation, update_extent=True)
+        self.assertEqual(len(statistics), len(segmentation["segments"]))
+        for segment, segment_statistics in zip(segmentation["segments"], statistics):
+            # Compare to statistics computed for each segment separately
+            segment_voxel_positions = np.array(np.where(voxels[segment["layer"]] == segment["labelValue"]))
+            self.assertEqual(segment_statistics["id"], segment["id"])
+            self.assertEqual(segment_statistics["voxelCount"], segment_voxel_positions.shape[1])
+            self.assertAlmostEqual(segment_statistics["volumeMm3"], segment_voxel_positions.shape[1] * abs(np.linalg.det(ijkToLPS[0:3, 0:3])))
+            expected_centroid = ijkToLPS.dot(list(segment_voxel_positions.mean(axis=1)) + [1])[0:3]
+            self.assertTrue(np.allclose(segment_statistics["centroid"], expected_centroid))
+            expected_extent = []
+            for axis in range(3):
+                expected_extent += [segment_voxel_positions[axis].min(), segment_voxel_positions[axis].max()]
+            self.assertEqual(segment_statistics["extent"], expected_extent)
+            self.assertEqual(segment["extent"], expected_extent)
+
+        # Empty segment
+        segmentation["segments"][0]["labelValue"] = 100
+        statistics = slicerio.segment_statistics(segmentation)
+        self.assertEqual(statistics[0]["voxelCount"], 0)
+        self.assertIsNone(statistics[0]["centroid"])
+        self.assertEqual(statistics[0]["extent"], [0, -1, 0, -1, 0, -1])
+
+    def test_resample_segmentation(self):
+        import numpy as np
+
+        segmentation = slicerio.read_segmentation(slicerio.get_testdata_file('SegmentationOverlapping.seg.nrrd'))
+
+        # Resampling to the same grid does not change the voxels
+        resampled = slicerio.resample_segmentation(segmentation, segmentation)
+        self.assertTrue(np.array_equal(resampled["voxels"], segmentation["voxels"]))
+
+        # Grid with half voxel size, shifted by half voxel: each input voxel becomes 2x2x2 output voxels
+        fine_ijkToLPS = segmentation["ijkToLPS"].dot(np.diag([0.5, 0.5, 0.5, 1.0]))
+        fine_ijkToLPS[0:3, 3] = segmentation["ijkToLPS"].dot([-0.25, -0.25, -0.25, 1.0])[0:3]
+        fine_grid = {"ijkToLPS": fine_ijkToLPS, "voxelsShape": [256, 256, 68]}
+        resampled = slicerio.resample_segmentation(segmentation, fine_grid, threads=2)
+        self.assertEqual(resampled["voxels"].shape, (2, 256, 256, 68))
+        self.assertTrue(np.array_equal(resampled["voxels"], segmentation["voxels"].repeat(2, axis=1).repeat(2, axis=2).repeat(2, axis=3)))
+        self.assertEqual(resampled["segments"][-1]["extent"], [32, 129, 122, 219, 32, 61])
+        self.assertEqual([segment["labelValue"] for segment in resampled["segments"]], [segment["labelValue"] for segment in segmentation["segments"]])
+        self.assertTrue(np.array_equal(slicerio.resample_segmentation(resampled, segmentation)["voxels"], segmentation["voxels"]))
+
+        # Sparse representation gives the same result
+        resampled_sparse = slicerio.resample_segmentation(slicerio.sparse_segmentation(segmentation), fine_grid)
+        self.assertTrue(np.array_equal(slicerio.dense_segmentation(resampled_sparse)["voxels"], resampled["voxels"]))
+
+        # Linear interpolation keeps the segment volumes approximately the same
+        resampled_linear = slicerio.resample_segmentation(segmentation, fine_grid, interpolation="linear")
+        for label_value in range(1, 8):
+            expected_voxel_count = (resampled["voxels"][0] == label_value).sum()
+            self.assertAlmostEqual((resampled_linear["voxels"][0] == label_value).sum() / expected_voxel_count, 1.0, delta=0.1)
+
+        # Output is cropped to the segments
+        cropped = slicerio.resample_segmentation(segmentation, fine_grid, minimal_extent=True)
+        self.assertEqual(cropped["voxels"].shape, (2, 250, 190, 68))
+        self.assertEqual(cropped["referenceImageExtentOffset"], [0, 44, 0])
+        self.assertTrue(np.array_equal(cropped["voxels"], resampled["voxels"][:, 0:250, 44:234, :]))
+        self.assertTrue(np.allclose(cropped["ijkToLPS"][0:3, 3], fine_ijkToLPS.dot([0, 44, 0, 1])[0:3]))
+
     def test_segmentation_write(self):
         import numpy as np
         import tempfile
@@ -121,6 +672,216 @@ class TestSegmentationRoundtrip(unittest.TestCase):
         import os
         os.remove(output_segmentation_filepath)
 
+    def test_segmentation_write_computed_extent(self):
+        import numpy as np
+        import os
+        import tempfile
+
+        input_segmentation_filepath = slicerio.get_testdata_file('SegmentationOverlapping.seg.nrrd')
+        segmentation = slicerio.read_segmentation(input_segmentation_filepath)
+        voxels = segmentation["voxels"]
+        for segment in segmentation["segments"]:
+            del segment["extent"]
+        output_segmentation_filepath = tempfile.mktemp() + '.seg.nrrd'
+
+        slicerio.write_segmentation(output_segmentation_filepath, segmentation, compute_extent=True)
+        segmentation_stored = slicerio.read_segmentation(output_segmentation_filepath)
+        os.remove(output_segmentation_filepath)
+
+        # Input segmentation is not modified
+        self.assertTrue(all("extent" not in segment for segment in segmentation["segments"]))
+        for segment in segmentation_stored["segments"]:
+            segment_voxel_positions = np.array(np.where(voxels[segment["layer"]] == segment["labelValue"]))
+            expected_extent = []
+            for axis in range(3):
+                expected_extent += [segment_voxel_positions[axis].min(), segment_voxel_positions[axis].max()]
+            self.assertEqual(segment["extent"], expected_extent)
+
+    def test_segmentation_write_parallel_compression(self):
+        import numpy as np
+        import os
+        import tempfile
+        import slicerio.segmentation
+
+        input_segmentation_filepath = slicerio.get_testdata_file('SegmentationOverlapping.seg.nrrd')
+        segmentation = slicerio.read_segmentation(input_segmentation_filepath)
+        output_segmentation_filepath = tempfile.mktemp() + '.seg.nrrd'
+
+        # Use small chunks to make sure that data is split between multiple threads
+        default_chunk_size = slicerio.segmentation._COMPRESSION_CHUNK_SIZE
+        slicerio.segmentation._COMPRESSION_CHUNK_SIZE = 100000
+        try:
+            slicerio.write_segmentation(output_segmentation_filepath, segmentation, compression_threads=3)
+        finally:
+            slicerio.segmentation._COMPRESSION_CHUNK_SIZE = default_chunk_size
+
+        # The file must be readable by pynrrd as well
+        voxels, header = nrrd.read(output_segmentation_filepath)
+        self.assertEqual(header["encoding"], "gzip")
+        self.assertTrue(np.array_equal(voxels, segmentation["voxels"]))
+        self._assert_segmentations_equal(segmentation, slicerio.read_segmentation(output_segmentation_filepath))
+
+        # Header is the same as the one written by pynrrd
+        slicerio.write_segmentation(output_segmentation_filepath, segmentation, compression_threads=1)
+        expected_header = nrrd.read_header(output_segmentation_filepath)
+        self.assertEqual(list(header.keys()), list(expected_header.keys()))
+        for key in expected_header:
+            if isinstance(expected_header[key], np.ndarray):
+                self.assertTrue(np.array_equal(header[key], expected_header[key], equal_nan=True), key)
+            else:
+                self.assertEqual(header[key], expected_header[key], key)
+
+        # Multi-byte voxels in C index order
+        voxels = np.ascontiguousarray(segmentation["voxels"].astype(">u2").transpose())
+        segmentation_c_order = dict(segmentation, voxels=voxels)
+        slicerio.write_segmentation(output_segmentation_filepath, segmentation_c_order, index_order='C', compression_threads=2)
+        voxels_read, header = nrrd.read(output_segmentation_filepath, index_order='C')
+        self.assertEqual((header["type"], header["endian"]), ("uint16", "big"))
+        self.assertTrue(np.array_equal(voxels_read, voxels))
+
+        os.remove(output_segmentation_filepath)
+
+    def test_segmentation_read_memory_mapped(self):
+        import numpy as np
+        import tempfile
+
+        input_segmentation_filepath = slicerio.get_testdata_file('SegmentationOverlapping.seg.nrrd')
+        segmentation = slicerio.read_segmentation(input_segmentation_filepath)
+
+        # Compressed files are read into memory
+        segmentation_compressed = slicerio.read_segmentation(input_segmentation_filepath, memory_map=True)
+        self.assertNotIsInstance(segmentation_compressed["voxels"], np.memmap)
+
+        # Uncompressed files are memory mapped
+        output_segmentation_filepath = tempfile.mktemp() + '.seg.nrrd'
+        segmentation["encoding"] = "raw"
+        slicerio.write_segmentation(output_segmentation_filepath, segmentation)
+        segmentation_mapped = slicerio.read_segmentation(output_segmentation_filepath, memory_map=True)
+        self.assertIsInstance(segmentation_mapped["voxels"], np.memmap)
+        self._assert_segmentations_equal(segmentation, segmentation_mapped)
+
+        import os
+        del segmentation_mapped
+        os.remove(output_segmentation_filepath)
+
+    def test_segmentation_read_into_output_array(self):
+        import numpy as np
+
+        input_segmentation_filepath = slicerio.get_testdata_file('SegmentationOverlapping.seg.nrrd')
+        voxels, header = nrrd.read(input_segmentation_filepath)
+
+        output_voxels = np.empty(voxels.shape, dtype=voxels.dtype, order='F')
+        segmentation = slicerio.read_segmentation(input_segmentation_filepath, out=output_voxels)
+        self.assertIs(segmentation["voxels"], output_voxels)
+        self.assertTrue(np.array_equal(output_voxels, voxels))
+
+        # Output array must match the voxel array in the file
+        with self.assertRaises(ValueError):
+            slicerio.read_segmentation(input_segmentation_filepath, out=np.empty(voxels.shape, dtype=np.int16, order='F'))
+        with self.assertRaises(ValueError):
+            slicerio.read_segmentation(input_segmentation_filepath, out=np.empty(voxels.shape, dtype=voxels.dtype, order='C'))
+
+    def test_segmentation_read_cached(self):
+        import numpy as np
+        import os
+        import shutil
+        import tempfile
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            segmentation = slicerio.read_segmentation(slicerio.get_testdata_file('SegmentationOverlapping.seg.nrrd'))
+            filepaths = [os.path.join(temp_dir, f"Segmentation{index}.seg.nrrd") for index in range(3)]
+            for filepath in filepaths:
+                slicerio.write_segmentation(filepath, segmentation)
+
+            slicerio.clear_segmentation_cache()
+            first = slicerio.read_segmentation(filepaths[0], cache=True)
+            second = slicerio.read_segmentation(filepaths[0], cache=True)
+            self.assertTrue(np.array_equal(first["voxels"], segmentation["voxels"]))
+            self.assertTrue(np.shares_memory(first["voxels"], second["voxels"]))
+            self.assertFalse(second["voxels"].flags.writeable)
+            with self.assertRaises(ValueError):
+                second["voxels"][0, 0, 0, 0] = 1
+
+            # Metadata is copied, therefore modifying the returned segmentation does not change the cached segmentation
+            first["segments"][0]["name"] = "changed"
+            self.assertEqual(slicerio.read_segmentation(filepaths[0], cache=True, skip_voxels=True)["segments"][0]["name"], "ribs")
+
+            # Cropped and sparse segmentations are created from the cached voxels
+            cropped = slicerio.read_segmentation(filepaths[0], cache=True, crop_to_segments=['overlapping sphere'])
+            self.assertTrue(np.array_equal(cropped["voxels"], segmentation["voxels"][:, 16:65, 61:110, 16:31]))
+            self.assertTrue(np.shares_memory(cropped["voxels"], first["voxels"]))
+            sparse = slicerio.read_segmentation(filepaths[0], cache=True, sparse=True)
+            self.assertTrue(np.array_equal(slicerio.dense_segmentation(sparse)["voxels"], segmentation["voxels"]))
+
+            # Modified file is read again
+            os.utime(filepaths[0], ns=(0, 0))
+            third = slicerio.read_segmentation(filepaths[0], cache=True)
+            self.assertFalse(np.shares_memory(third["voxels"], first["voxels"]))
+
+            # NIFTI file is read again if its sidecar file is modified
+            from slicerio.segmentation import _segmentation_cache_signature
+            nifti_filepath = os.path.join(temp_dir, "Segmentation.nii.gz")
+            slicerio.write_segmentation_nifti(nifti_filepath, segmentation)
+            sidecar_filepath = os.path.join(temp_dir, "Segmentation.json")
+            signatures = [_segmentation_cache_signature(nifti_filepath, None), _segmentation_cache_signature(nifti_filepath, sidecar_filepath)]
+            os.utime(sidecar_filepath, ns=(0, 0))
+            self.assertNotEqual(_segmentation_cache_signature(nifti_filepath, None), signatures[0])
+            self.assertNotEqual(_segmentation_cache_signature(nifti_filepath, sidecar_filepath), signatures[1])
+
+            # Least recently used segmentation is removed when the size limit is reached
+            default_cache_size = slicerio.segmentation._SEGMENTATION_CACHE_MAX_BYTES
+            default_cache_entries = slicerio.segmentation._SEGMENTATION_CACHE_MAX_ENTRIES
+            slicerio.set_segmentation_cache_size(2 * segmentation["voxels"].nbytes)
+            try:
+                slicerio.read_segmentation(filepaths[1], cache=True)
+                slicerio.read_segmentation(filepaths[0], cache=True)
+                slicerio.read_segmentation(filepaths[2], cache=True)
+                self.assertTrue(np.shares_memory(slicerio.read_segmentation(filepaths[0], cache=True)["voxels"], third["voxels"]))
+                self.assertEqual(sorted(slicerio.segmentation._SEGMENTATION_CACHE), sorted([filepaths[0], filepaths[2]]))
+
+                # Segmentations that do not fit into the cache are returned as modifiable arrays
+                slicerio.set_segmentation_cache_size(0)
+                self.assertTrue(slicerio.read_segmentation(filepaths[1], cache=True)["voxels"].flags.writeable)
+
+                # Number of cached segmentations is limited, even if their voxels are not cached
+                slicerio.clear_segmentation_cache()
+                slicerio.set_segmentation_cache_size(0, max_entries=3)
+                metadata_filepaths = [os.path.join(temp_dir, f"Metadata{index}.seg.nrrd") for index in range(6)]
+                for filepath in metadata_filepaths:
+                    shutil.copy(filepaths[0], filepath)
+                    slicerio.read_segmentation(filepath, cache=True, skip_voxels=True)
+                self.assertEqual(sorted(slicerio.segmentation._SEGMENTATION_CACHE), sorted(metadata_filepaths[3:]))
+            finally:
+                slicerio.set_segmentation_cache_size(default_cache_size, default_cache_entries)
+                slicerio.clear_segmentation_cache()
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_segmentation_read_cropped(self):
+        import numpy as np
+        import os
+        import tempfile
+
+        input_segmentation_filepath = slicerio.get_testdata_file('SegmentationOverlapping.seg.nrrd')
+        segmentation = slicerio.read_segmentation(input_segmentation_filepath)
+        raw_segmentation_filepath = tempfile.mktemp() + '.seg.nrrd'
+        segmentation["encoding"] = "raw"
+        slicerio.write_segmentation(raw_segmentation_filepath, segmentation)
+
+        for filepath in [input_segmentation_filepath, raw_segmentation_filepath]:
+            cropped_segmentation = slicerio.read_segmentation(filepath, crop_to_segments=['overlapping sphere'])
+
+            # Sphere extent: [16, 64, 61, 109, 16, 30]
+            self.assertTrue(np.array_equal(cropped_segmentation["voxels"], segmentation["voxels"][:, 16:65, 61:110, 16:31]))
+            self.assertEqual(cropped_segmentation["referenceImageExtentOffset"], [16, 61, 16])
+            expected_origin = np.array(segmentation["ijkToLPS"]).dot([16, 61, 16, 1])[0:3]
+            self.assertTrue(np.allclose(cropped_segmentation["ijkToLPS"][0:3, 3], expected_origin))
+            self.assertEqual(slicerio.segment_from_name(cropped_segmentation, 'overlapping sphere')['extent'], [0, 48, 0, 48, 0, 14])
+            self.assertEqual(slicerio.segment_from_name(cropped_segmentation, 'ribs')['extent'], [0, 48, 0, 48, 0, 14])
+
+        os.remove(raw_segmentation_filepath)
+
     def test_segmentation_create(self):
         import numpy as np
         import tempfile
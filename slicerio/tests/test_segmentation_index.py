@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import slicerio
+import slicerio.segmentation_index
+
+
+class TestSegmentationIndex(unittest.TestCase):
+    """
+    Test indexing segment metadata of multiple segmentation files.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for filename in ['Segmentation.seg.nrrd', 'SegmentationOverlapping.seg.nrrd']:
+            shutil.copy(slicerio.get_testdata_file(filename), os.path.join(self.directory, filename))
+        self.index_filename = os.path.join(self.directory, 'index.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_index_update(self):
+        result = slicerio.segmentation_index.update_index(self.index_filename, self.directory)
+        self.assertEqual(result, {"updated": 2, "unchanged": 0, "removed": 0, "failed": 0})
+
+        # Unchanged files are not read again
+        result = slicerio.segmentation_index.update_index(self.index_filename, self.directory)
+        self.assertEqual(result, {"updated": 0, "unchanged": 2, "removed": 0, "failed": 0})
+
+        # Modified and removed files
+        modified_filepath = os.path.join(self.directory, 'Segmentation.seg.nrrd')
+        segmentation = slicerio.read_segmentation(modified_filepath)
+        segmentation["segments"] = segmentation["segments"][:2]
+        slicerio.write_segmentation(modified_filepath, segmentation)
+        os.remove(os.path.join(self.directory, 'SegmentationOverlapping.seg.nrrd'))
+        result = slicerio.segmentation_index.update_index(self.index_filename, self.directory)
+        self.assertEqual(result, {"updated": 1, "unchanged": 0, "removed": 1, "failed": 0})
+        self.assertEqual(len(slicerio.segmentation_index.find_segments(self.index_filename)), 2)
+
+    def test_index_query(self):
+        slicerio.segmentation_index.update_index(self.index_filename, self.directory)
+        all_files = [os.path.join(self.directory, filename) for filename in ['Segmentation.seg.nrrd', 'SegmentationOverlapping.seg.nrrd']]
+
+        right_lung = {"category": ["SCT", "123037004", "Anatomical Structure"], "type": ["SCT", "39607008", "Lung"], "typeModifier": ["SCT", "24028007", "Right"]}
+        self.assertEqual(slicerio.segmentation_index.find_files(self.index_filename, terminology=right_lung), all_files)
+
+        # Type modifier must match, too
+        lung = {"category": ["SCT", "123037004", "Anatomical Structure"], "type": ["SCT", "39607008", "Lung"]}
+        self.assertEqual(slicerio.segmentation_index.find_files(self.index_filename, terminology=lung), [])
+
+        # Any type modifier (left or right lung)
+        any_lung = slicerio.TerminologyMatcher(dict(lung, typeModifier="*"))
+        self.assertEqual(len(slicerio.segmentation_index.find_segments(self.index_filename, terminology=any_lung)), 4)
+
+        self.assertEqual(slicerio.segmentation_index.find_files(self.index_filename, name='overlapping sphere'), all_files[1:])
+
+        found_segments = slicerio.segmentation_index.find_segments(self.index_filename, name='right lung')
+        self.assertEqual(len(found_segments), 2)
+        path, segment = found_segments[0]
+        self.assertEqual(path, all_files[0])
+        self.assertEqual(segment['labelValue'], 5)
+        self.assertEqual(segment['extent'], [0, 124, 0, 127, 0, 33])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import http.server
+import json
+import socket
+import threading
+import time
+import unittest
+import urllib.parse
+
+import requests
+import slicerio.server
+
+
+class _StubSlicerRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Minimal imitation of the Slicer web server API, serving a fixed set of nodes."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, content, status=200):
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_bytes(self, content):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _handle(self):
+        url = urllib.parse.urlparse(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        self.body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with self.server.lock:
+            self.server.requests.append((self.command, url.path, query, self.client_address))
+            self.server.active_requests += 1
+            self.server.max_active_requests = max(self.server.max_active_requests, self.server.active_requests)
+        try:
+            time.sleep(self.server.delay)
+            self._respond(url, query)
+        finally:
+            with self.server.lock:
+                self.server.active_requests -= 1
+
+    def _respond(self, url, query):
+        nodes = [node for node in self.server.nodes
+            if query.get("name", node["name"]) == node["name"] and query.get("id", node["id"]) == node["id"]
+            and query.get("class", node["className"]) == node["className"]]
+        if url.path == "/slicer/system/version":
+            self._send_json({"applicationName": "Slicer", "applicationVersion": "5.6.0"})
+        elif url.path == "/slicer/mrml/ids":
+            self._send_json([node["id"] for node in nodes])
+        elif url.path == "/slicer/mrml/names":
+            self._send_json([node["name"] for node in nodes])
+        elif url.path == "/slicer/mrml/properties":
+            if not nodes:
+                self._send_json({"success": False, "message": "Node not found"}, status=404)
+            else:
+                self._send_json({node["id"]: node for node in nodes})
+        elif url.path == "/slicer/volume" and self.command == "POST":
+            # Slicer only accepts raw, little endian, 3D short volumes
+            header = dict(line.split(": ", 1) for line in self.body[:self.body.find(b"\n\n")].decode().split("\n")[1:])
+            if (header["type"], header["dimension"], header["endian"], header["encoding"]) != ("short", "3", "little", "raw"):
+                self._send_json({"status": "failed"})
+            else:
+                self.server.volumes[query["id"]] = self.body
+                self._send_json({"status": "success"})
+        elif url.path == "/slicer/volume":
+            self._send_bytes(self.server.volumes.get(query["id"], b""))
+        elif url.path == "/slicer/mrml" and self.command == "POST":
+            if "missing" in query.get("localfile", ""):
+                self._send_json({"success": False, "message": "File not found"}, status=404)
+            else:
+                self._send_json({"success": True, "loadedNodeIDs": ["vtkMRMLScalarVolumeNode1"]})
+        else:
+            self._send_json({"success": True})
+
+    do_GET = _handle
+    do_POST = _handle
+    do_PUT = _handle
+    do_DELETE = _handle
+
+
+class TestSlicerClient(unittest.TestCase):
+    """
+    Test communication with Slicer web server, using a stub server.
+    """
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _StubSlicerRequestHandler)
+        self.server.requests = []
+        self.server.lock = threading.Lock()
+        self.server.active_requests = 0
+        self.server.max_active_requests = 0
+        self.server.delay = 0
+        self.server.volumes = {}
+        self.server.nodes = [
+            {"id": "vtkMRMLScalarVolumeNode1", "name": "MRHead", "className": "vtkMRMLScalarVolumeNode"},
+            {"id": "vtkMRMLSegmentationNode1", "name": "Segmentation", "className": "vtkMRMLSegmentationNode"},
+            ]
+        self.server_thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.server_thread.start()
+        self.port = self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_node_queries(self):
+        with slicerio.server.SlicerClient(port=self.port, timeout=10) as client:
+            self.assertTrue(client.is_server_running())
+            self.assertEqual(client.node_ids(), ["vtkMRMLScalarVolumeNode1", "vtkMRMLSegmentationNode1"])
+            self.assertEqual(client.node_names(class_name="vtkMRMLSegmentationNode"), ["Segmentation"])
+            for _ in range(20):
+                self.assertEqual(client.node_properties(name="MRHead")[0]["id"], "vtkMRMLScalarVolumeNode1")
+            with self.assertRaisesRegex(RuntimeError, "Node not found"):
+                client.node_properties(name="missing")
+            self.assertEqual(client.file_load("/path/to/some file.nrrd", properties={"name": "a&b"}), ["vtkMRMLScalarVolumeNode1"])
+            client.file_save("/path/to/output.nrrd", id="vtkMRMLScalarVolumeNode1", properties={"useCompression": 0})
+            client.node_remove(name="MRHead")
+
+        # All requests are sent through the same connection
+        self.assertEqual(len(set(client_address for _, _, _, client_address in self.server.requests)), 1)
+
+        load_request = self.server.requests[-3]
+        self.assertEqual(load_request[:3], ("POST", "/slicer/mrml", {"localfile": "/path/to/some file.nrrd", "filetype": "VolumeFile", "name": "a&b"}))
+        save_request = self.server.requests[-2]
+        self.assertEqual(save_request[:3], ("GET", "/slicer/mrml/file", {"localfile": "/path/to/output.nrrd", "id": "vtkMRMLScalarVolumeNode1", "useCompression": "0"}))
+        self.assertEqual(self.server.requests[-1][:3], ("DELETE", "/slicer/mrml", {"name": "MRHead"}))
+
+    def test_module_functions(self):
+        default_port = slicerio.server.SERVER_PORT
+        slicerio.server.SERVER_PORT = self.port
+        try:
+            self.assertTrue(slicerio.server.is_server_running())
+            self.assertEqual(slicerio.server.node_names(id="vtkMRMLScalarVolumeNode1"), ["MRHead"])
+        finally:
+            slicerio.server.SERVER_PORT = default_port
+
+    def test_wait_for_server(self):
+        with slicerio.server.SlicerClient(port=self.port) as client:
+            client.wait_for_server(timeoutSec=5)
+        self.assertEqual(len(self.server.requests), 1)
+
+        # Server is not running: polling stops after the timeout
+        with socket.socket() as unused_socket:
+            unused_socket.bind(("127.0.0.1", 0))
+            unused_port = unused_socket.getsockname()[1]
+        with slicerio.server.SlicerClient(port=unused_port) as client:
+            with self.assertRaises(requests.exceptions.ConnectTimeout):
+                client.wait_for_server(timeoutSec=0.3, initial_interval=0.05)
+
+    def test_batch_requests(self):
+        self.server.delay = 0.02
+        with slicerio.server.SlicerClient(port=self.port) as client:
+            names = ["MRHead", "Segmentation"] * 5
+            properties = client.node_properties_batch(names, max_workers=3)
+            self.assertEqual({name: properties[name][0]["name"] for name in properties}, {"MRHead": "MRHead", "Segmentation": "Segmentation"})
+            ids = client.node_ids_batch({"volumes": {"class_name": "vtkMRMLScalarVolumeNode"}, "head": "MRHead"}, max_workers=3)
+            self.assertEqual(ids, {"volumes": ["vtkMRMLScalarVolumeNode1"], "head": ["vtkMRMLScalarVolumeNode1"]})
+            # List of filters
+            names = client.node_names_batch([{"class_name": "vtkMRMLScalarVolumeNode"}, {"id": "vtkMRMLScalarVolumeNode1", "name": "MRHead"}, "Segmentation"])
+            self.assertEqual(names, {(("class_name", "vtkMRMLScalarVolumeNode"),): ["MRHead"],
+                (("id", "vtkMRMLScalarVolumeNode1"), ("name", "MRHead")): ["MRHead"], "Segmentation": ["Segmentation"]})
+
+            # All requests are completed, errors are reported together
+            file_paths = [f"/data/volume{index}.nrrd" for index in range(6)] + ["/data/missing1.nrrd", "/data/missing2.nrrd"]
+            with self.assertRaises(slicerio.server.BatchRequestError) as context:
+                client.file_load_batch(file_paths, max_workers=3)
+            self.assertEqual(sorted(context.exception.results), sorted(file_paths[:6]))
+            self.assertEqual(sorted(context.exception.errors), file_paths[6:])
+            self.assertIn("2 of 8 requests failed", str(context.exception))
+            self.assertIn("File not found", str(context.exception.errors["/data/missing1.nrrd"]))
+
+        self.assertLessEqual(self.server.max_active_requests, 3)
+        self.assertEqual(len([request for request in self.server.requests if request[1] == "/slicer/mrml"]), 8)
+        # Requests are sent through at most as many connections as the number of concurrent requests
+        self.assertLessEqual(len(set(client_address for _, _, _, client_address in self.server.requests)), 3)
+
+    def test_volume_transfer(self):
+        import numpy as np
+
+        segmentation = slicerio.read_segmentation(slicerio.get_testdata_file('SegmentationOverlapping.seg.nrrd'))
+        with slicerio.server.SlicerClient(port=self.port) as client:
+            # Layers are merged, the sphere (listed last) overwrites the other segments
+            client.volume_send(segmentation, name="Segmentation labelmap")
+            volume = client.volume_receive("Segmentation labelmap")
+            self.assertEqual(volume["voxels"].shape, segmentation["voxels"].shape[1:])
+            self.assertTrue(np.allclose(volume["ijkToLPS"], segmentation["ijkToLPS"]))
+            merged_voxels = slicerio.segmentation._merge_layers(segmentation)["voxels"]
+            self.assertTrue(np.array_equal(volume["voxels"], merged_voxels))
+
+            voxels = np.arange(-1000, 1000, dtype=np.int32).reshape((10, 20, 10), order="F")
+            client.volume_send(voxels, name="Ramp")
+            self.assertTrue(np.array_equal(client.volume_receive("Ramp")["voxels"], voxels))
+
+            with self.assertRaises(ValueError):
+                client.volume_send(voxels * 100, name="Ramp")
+            with self.assertRaisesRegex(RuntimeError, "not found"):
+                client.volume_receive("missing")
+
+            # Voxels are streamed in chunks, without copying arrays that are already little endian short in Fortran order
+            body = slicerio.server._NrrdRequestBody(voxels.astype("<i2", order="F"))
+            body.CHUNK_SIZE = 10 * 20 * 2 * 3
+            chunks = list(body)
+            self.assertEqual(len(chunks), 1 + 4)
+            self.assertEqual(len(body), sum(len(chunk) for chunk in chunks))
+            self.assertTrue(np.shares_memory(np.frombuffer(chunks[1], dtype="<i2"), body.voxels))
+            client.volume_send(body.voxels[:, :, ::-1], name="Reversed ramp")
+            self.assertTrue(np.array_equal(client.volume_receive("Reversed ramp")["voxels"], voxels[:, :, ::-1]))
+
+        async def run():
+            async with slicerio.server.AsyncSlicerClient(port=self.port, timeout=10) as client:
+                await client.volume_send(voxels, name="Async ramp")
+                self.assertTrue(np.array_equal((await client.volume_receive("Async ramp"))["voxels"], voxels))
+                with self.assertRaises(ValueError):
+                    await client.volume_send(voxels * 100, name="Async ramp")
+                # Connection is still usable after sending a request body
+                self.assertTrue(await client.is_server_running())
+
+        asyncio.run(run())
+
+        self.assertEqual(self.server.requests[0][:3], ("POST", "/slicer/volume", {"id": "Segmentation labelmap"}))
+
+    def test_async_client(self):
+        async def run():
+            async with slicerio.server.AsyncSlicerClient(port=self.port, timeout=10, max_connections=2) as client:
+                self.assertTrue(await client.is_server_running())
+                self.assertEqual(await client.node_names(class_name="vtkMRMLSegmentationNode"), ["Segmentation"])
+                with self.assertRaisesRegex(RuntimeError, "Node not found"):
+                    await client.node_properties(name="missing")
+                self.assertEqual(await client.file_load("/path/to/some file.nrrd", properties={"name": "a&b"}), ["vtkMRMLScalarVolumeNode1"])
+                await client.file_save("/path/to/output.nrrd", id="vtkMRMLScalarVolumeNode1")
+                await client.node_reload(id="vtkMRMLScalarVolumeNode1")
+
+                # Requests are sent concurrently, but at most max_connections at a time
+                self.server.delay = 0.05
+                results = await asyncio.gather(*[client.node_properties(id="vtkMRMLScalarVolumeNode1") for _ in range(8)])
+                self.assertEqual([properties[0]["name"] for properties in results], ["MRHead"] * 8)
+                self.assertEqual(self.server.max_active_requests, 2)
+
+                # Timeout
+                self.server.delay = 1.0
+                with self.assertRaises(asyncio.TimeoutError):
+                    await client._request("GET", "/slicer/mrml/ids", timeout=0.1)
+
+            # Loading a file is not retried and no server is started if the request times out
+            async with slicerio.server.AsyncSlicerClient(port=self.port, timeout=0.2) as client:
+                request_count = len(self.server.requests)
+                with self.assertRaises(asyncio.TimeoutError):
+                    await client.file_load("/path/to/slow.nrrd", slicer_executable="/nonexistent/Slicer")
+                await asyncio.sleep(1.0)
+                self.assertEqual(len(self.server.requests), request_count + 1)
+
+        asyncio.run(run())
+
+        self.assertEqual(self.server.requests[3][:3], ("POST", "/slicer/mrml", {"localfile": "/path/to/some file.nrrd", "filetype": "VolumeFile", "name": "a&b"}))
+        self.assertEqual(self.server.requests[5][:3], ("PUT", "/slicer/mrml", {"id": "vtkMRMLScalarVolumeNode1"}))
+        # Connections are reused
+        self.assertLessEqual(len(set(client_address for _, _, _, client_address in self.server.requests)), 3)
+
+    def test_read_http_response(self):
+        from slicerio.server import _read_http_response
+
+        async def parse(data):
+            reader = asyncio.StreamReader()
+            reader.feed_data(data)
+            reader.feed_eof()
+            return await _read_http_response(await reader.readline(), reader)
+
+        response = asyncio.run(parse(b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\ncontent-type: application/json\r\n\r\n'
+            b'4\r\n["a"\r\n5;ext=1\r\n, "b"\r\n1\r\n]\r\n0\r\n\r\n'))
+        self.assertEqual(response.json(), ["a", "b"])
+        self.assertEqual(response.headers["Content-Type"], "application/json")
+        self.assertTrue(response.keep_alive)
+
+        response = asyncio.run(parse(b'HTTP/1.0 404 Not Found\r\n\r\n{"message": "missing"}'))
+        self.assertFalse(response.ok)
+        self.assertEqual(response.json(), {"message": "missing"})
+        self.assertFalse(response.keep_alive)
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+import http.server
+import socket
+import threading
+import unittest
+
+import requests
+import slicerio.server_pool
+from slicerio.tests.test_server import _StubSlicerRequestHandler
+
+
+class _FakeSlicerRequestHandler(_StubSlicerRequestHandler):
+    """Drops the connections when the process is stopped, as a crashed application would do."""
+
+    def parse_request(self):
+        if self.server.stopped:
+            self.close_connection = True
+            return False
+        return super().parse_request()
+
+
+class _FakeSlicerProcess:
+    """Imitates a Slicer application process by running a stub web server in a thread."""
+
+    def __init__(self, port):
+        self.port = port
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", port), _FakeSlicerRequestHandler)
+        self.server.stopped = False
+        self.server.requests = []
+        self.server.lock = threading.Lock()
+        self.server.active_requests = 0
+        self.server.max_active_requests = 0
+        self.server.delay = 0.02
+        self.server.volumes = {}
+        self.server.nodes = [{"id": "vtkMRMLScalarVolumeNode1", "name": "MRHead", "className": "vtkMRMLScalarVolumeNode"}]
+        self.returncode = None
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def crash(self):
+        self._stop(1)
+
+    def _stop(self, returncode):
+        if self.returncode is None:
+            self.server.stopped = True
+            self.server.shutdown()
+            self.server.server_close()
+            self.returncode = returncode
+
+    def poll(self):
+        return self.returncode
+
+    def terminate(self):
+        self._stop(0)
+
+    def kill(self):
+        self._stop(-9)
+
+    def wait(self, timeout=None):
+        return self.returncode
+
+
+class TestSlicerServerPool(unittest.TestCase):
+    """
+    Test dispatching jobs to multiple Slicer instances, using fake Slicer processes.
+    """
+
+    def setUp(self):
+        self.ports = []
+        sockets = [socket.socket() for _ in range(3)]
+        for unused_socket in sockets:
+            unused_socket.bind(("127.0.0.1", 0))
+            self.ports.append(unused_socket.getsockname()[1])
+        for unused_socket in sockets:
+            unused_socket.close()
+        self.processes = []
+
+    def launch(self, port):
+        process = _FakeSlicerProcess(port)
+        self.processes.append(process)
+        return process
+
+    def test_dispatch_jobs(self):
+        def load(client, file_path):
+            return client.port, client.file_load(file_path, auto_start=False)
+
+        with slicerio.server_pool.SlicerServerPool(3, ports=self.ports, launcher=self.launch) as pool:
+            file_paths = [f"/data/volume{index}.nrrd" for index in range(12)]
+            results = list(pool.map(load, file_paths))
+            self.assertEqual([node_ids for _, node_ids in results], [["vtkMRMLScalarVolumeNode1"]] * 12)
+            # Jobs are distributed between all instances, each instance runs one job at a time
+            self.assertEqual(set(port for port, _ in results), set(self.ports))
+            for process in self.processes:
+                self.assertEqual(process.server.max_active_requests, 1)
+            loaded_paths = sorted(request[2]["localfile"] for process in self.processes for request in process.server.requests if request[1] == "/slicer/mrml")
+            self.assertEqual(loaded_paths, sorted(file_paths))
+
+            # Errors of a job are reported to the caller
+            with self.assertRaisesRegex(RuntimeError, "File not found"):
+                pool.submit(load, "/data/missing.nrrd").result()
+
+        # All instances are stopped
+        self.assertEqual(len(self.processes), 3)
+        self.assertTrue(all(process.poll() is not None for process in self.processes))
+
+    def test_restart_crashed_instance(self):
+        with slicerio.server_pool.SlicerServerPool(2, ports=self.ports[:2], launcher=self.launch) as pool:
+            # Instance crashes while it is idle
+            self.processes[0].crash()
+            self.assertEqual(list(pool.map(lambda client, index: client.node_names(), range(4))), [["MRHead"]] * 4)
+            self.assertEqual(len(self.processes), 3)
+            self.assertEqual(self.processes[2].port, self.ports[0])
+
+            # Instance crashes while a job is running, the job is run again on the restarted instance
+            attempts = []
+            def crashing_job(client):
+                attempts.append(client.port)
+                if len(attempts) == 1:
+                    next(process for process in self.processes if process.port == client.port and process.poll() is None).crash()
+                return client.node_ids()
+            self.assertEqual(pool.submit(crashing_job).result(), ["vtkMRMLScalarVolumeNode1"])
+            self.assertEqual(attempts[0], attempts[1])
+            self.assertEqual(len(self.processes), 4)
+
+            # Instances that are running but not responding are restarted by health check
+            self.assertEqual(pool.check_health(), 0)
+            self.processes[1].server.stopped = True
+            self.assertEqual(pool.check_health(), 1)
+            self.assertEqual(len(self.processes), 5)
+
+    def test_remove_instance_that_cannot_be_restarted(self):
+        with slicerio.server_pool.SlicerServerPool(2, ports=self.ports[:2], launcher=self.launch, max_restarts=0) as pool:
+            # Jobs are run on the remaining instance
+            self.processes[0].crash()
+            self.assertEqual(list(pool.map(lambda client, index: client.port, range(6))), [self.ports[1]] * 6)
+            self.assertEqual(pool.live_ports, [self.ports[1]])
+            self.assertEqual(len(self.processes), 2)
+
+            # Jobs fail if no instances remain
+            self.processes[1].crash()
+            with self.assertRaisesRegex(RuntimeError, "No Slicer instances"):
+                pool.submit(lambda client: client.node_ids()).result()
+            with self.assertRaisesRegex(RuntimeError, "No Slicer instances"):
+                pool.submit(lambda client: client.node_ids()).result()
+            self.assertEqual(pool.check_health(), 0)
+
+    def test_startup_timeout(self):
+        class NotStartingProcess(_FakeSlicerProcess):
+            def __init__(self, port):
+                super().__init__(port)
+                self.crash()
+
+        with self.assertRaises(requests.exceptions.ConnectTimeout):
+            slicerio.server_pool.SlicerServerPool(1, ports=self.ports[:1], launcher=NotStartingProcess, startup_timeout_sec=0.2)